@@ -43,9 +43,41 @@ Parameters/Options:
     -f  | --file            : define input CSV path 
     -o  | --output_file     : define output CSV path
     -i  | --max_iterations  : define max iterations allowed on a single GUID
-    -v  | --verbose         : show program execution details (may increase execution time)
+    -v  | --verbose         : show program execution details and progress (rows/s, GUIDs/s and ETA)
     -l  | --log             : level of information in log file 
                               (0 - nothing | 1 - over max iterations | 2 - all information)
+    -p  | --profile         : profile the run with cProfile and tracemalloc; writes
+                              exportsuredoneepid-profile_<time>.prof, _profile.txt and
+                              _memory.txt (per stage peak memory) next to the log file
+    -m  | --memstats        : trace the memory of the run with tracemalloc (slower) and write the
+                              current and peak memory and RSS after every stage (read, sort, main
+                              loop, upload, ...) and the top allocation sites to the log file
+    -e  | --engine          : how the rows of a GUID are combined
+                              (groupby - vectorized, default | loop - the original row by row loop)
+    -s  | --external_sort   : sort the input in chunks on disk and combine the GUIDs while merging,
+                              for inputs larger than the memory (peak memory depends on --chunk_rows)
+    -c  | --chunk_rows      : rows per sorted chunk with --external_sort (default 500000)
+    -w  | --workers         : split the GUIDs into this many shards and sort and combine them
+                              in parallel processes (default 1, not used with --external_sort)
+    -r  | --resume          : keep the rows of an existing output file (e.g. of a run that died)
+                              and only write the GUIDs after them (not with --upload)
+    -P  | --presorted       : the input is already sorted by guid and Fitment EPID, skip the
+                              sort without checking (by default sorted input is detected)
+    -a  | --pyarrow         : parse the input with the pyarrow engine of pandas (if installed)
+    -d  | --legacy_dtypes   : read the input with the default pandas types instead of the
+                              compact ones (uses several times more memory)
+    -u  | --upload          : upload the combined rows to SureDone while the transformation runs,
+                              as bulk jobs of --part_rows GUIDs (the output file is only written
+                              if -o is given)
+    -k  | --part_rows       : GUIDs per uploaded bulk job with --upload (default 50000)
+    -U  | --upload_options  : options of suredone_upload.py used by --upload, in quotes (credentials
+                              file, email, selections, max_concurrent, retries, fetch_results, ...)
+    -F  | --fingerprints    : file with a fingerprint of the rows of every GUID; only the GUIDs that are
+                              new or changed since the last upload are written (and logged). The file
+                              is only updated with --upload, once every part was uploaded
+    -E  | --export          : export of suredone_download.py with the ebayepid field, or 'latest' for
+                              the newest one in its download directory; GUIDs whose new ebayepid
+                              is the same as in the export are not written (and not logged)
                               
 Example:
     $ python rearrange.py -f [source.csv]
@@ -57,6 +89,39 @@ Example:
     $ python rearrange.py -f [source.csv] -o [output.csv] -i 1000
     $ python rearrange.py -file [source.csv] --output_file [output.csv] --max_iterations 1000
 
+    $ python rearrange.py -f [source.csv] -p
+    $ python rearrange.py -file [source.csv] --profile
+
+    $ python rearrange.py -f [source.csv] -m
+    $ python rearrange.py -file [source.csv] --memstats
+
+    $ python rearrange.py -f [source.csv] -e loop
+    $ python rearrange.py -file [source.csv] --engine groupby
+
+    $ python rearrange.py -f [source.csv] -s -c 1000000
+    $ python rearrange.py -file [source.csv] --external_sort --chunk_rows 1000000
+
+    $ python rearrange.py -f [source.csv] -w 8
+    $ python rearrange.py -file [source.csv] --workers 8
+
+    $ python rearrange.py -f [source.csv] -o [output.csv] -r
+    $ python rearrange.py -file [source.csv] --output_file [output.csv] --resume
+
+    $ python rearrange.py -f [source.csv] -P
+    $ python rearrange.py -file [source.csv] --presorted
+
+    $ python rearrange.py -f [source.csv] -a
+    $ python rearrange.py -file [source.csv] --pyarrow
+
+    $ python rearrange.py -f [source.csv] -u -U "-c suredone.yaml -s sd-force -v"
+    $ python rearrange.py -file [source.csv] --upload --part_rows 20000 --upload_options "--max_concurrent 2"
+
+    $ python rearrange.py -f [source.csv] -u -F [fingerprints.csv]
+    $ python rearrange.py -file [source.csv] --upload --fingerprints [fingerprints.csv]
+
+    $ python rearrange.py -f [source.csv] -u -E latest
+    $ python rearrange.py -file [source.csv] --upload --export [SureDone_Downloads_export.csv]
+
 Todo:
     * Possibly add a custom logfile location
 
@@ -65,15 +130,42 @@ Exit Statusses:
     - 3 -- Input file problems
     - 4 -- Output file problems
     - 5 -- -h argument used
+    - 6 -- Upload failed
 """
 
 import sys, getopt
+import os
+import shlex
+import threading
+import csv
+import heapq
+import pickle
+import shutil
+import tempfile
+import io
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from  os import path
+import numpy as np
 import pandas as pd
-from datetime import datetime
+from pandas.api.types import is_numeric_dtype, is_integer_dtype
+from datetime import datetime, timedelta
 import time
 from time import sleep
-import tracemalloc
+from suredone_profiler import Profiler
+import suredone_lookup
+
+# pyarrow is optional, without it the input is parsed by the C engine of pandas
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# suredone_upload (and requests) is only needed for --upload
+try:
+    import suredone_upload
+except ImportError:
+    suredone_upload = None
 
 # Debug only
 from  os import system
@@ -81,6 +173,51 @@ from  os import system
 ## Remove all debug variables
 current_milli_time = lambda: int(round(time.time() * 1000)) # For time measurement
 
+# Time suffix of the log and report files of this run, see getRunSuffix()
+RUN_SUFFIX = None
+
+# Engines that combine the rows of a GUID, see mainLoop() and groupbyLoop()
+ENGINES = ('groupby', 'loop')
+
+# Groups of up to this many rows are joined with np.add.reduceat, see joinGroups()
+SHORT_GROUP_SIZE = 32
+
+# Rows per pickled batch in the sorted runs of the external sort
+RUN_BATCH_ROWS = 10000
+
+# Column types of the external sort, see probeColumnKinds()
+KIND_DTYPES = {'int': 'int64', 'float': 'float64', 'empty': 'float64', 'bool': 'bool', 'str': str}
+
+# Header of the output CSV
+OUTPUT_COLUMNS = ['action', 'guid', 'ebayepid']
+
+# Output rows buffered before they are written and flushed, see OutputWriter
+OUTPUT_BUFFER_ROWS = 10000
+
+# GUIDs joined at a time by the groupby engine
+OUTPUT_BLOCK_GUIDS = 100000
+
+# Output rows printed in verbose mode
+PREVIEW_ROWS = 10
+
+# GUIDs per bulk job with --upload, see PartUploader
+PART_ROWS = 50000
+
+# Least time between two progress lines in verbose mode, see ProgressReporter
+PROGRESS_INTERVAL_MS = 500
+
+# Text columns with at most this share of distinct values are read as categoricals, see getCompactColumn()
+CATEGORY_SHARE = 0.5
+
+# Allocation sites listed for every stage with --memstats, see printMemoryStats()
+MEMSTATS_SITES = 10
+
+# Rows of a SureDone export read at a time, see readLiveValues()
+EXPORT_CHUNK_ROWS = 100000
+
+# Below this share of rows in out of order GUIDs only those GUIDs are sorted, see sortRows()
+PARTIAL_SORT_SHARE = 0.5
+
 # Help message
 HELP_MESSAGE = """
 Usage:
@@ -94,9 +231,41 @@ Parameters/Options:
     -f  | --file            : define input CSV path 
     -o  | --output_file     : define output CSV path
     -i  | --max_iterations  : define max iterations allowed on a single GUID
-    -v  | --verbose         : show program execution details (may increase execution time)
+    -v  | --verbose         : show program execution details and progress (rows/s, GUIDs/s and ETA)
     -l  | --log             : level of information in log file 
                               (0 - nothing | 1 - over max iterations | 2 - information of all)
+    -p  | --profile         : profile the run with cProfile and tracemalloc; writes
+                              exportsuredoneepid-profile_<time>.prof, _profile.txt and
+                              _memory.txt (per stage peak memory) next to the log file
+    -m  | --memstats        : trace the memory of the run with tracemalloc (slower) and write the
+                              current and peak memory and RSS after every stage (read, sort, main
+                              loop, upload, ...) and the top allocation sites to the log file
+    -e  | --engine          : how the rows of a GUID are combined
+                              (groupby - vectorized, default | loop - the original row by row loop)
+    -s  | --external_sort   : sort the input in chunks on disk and combine the GUIDs while merging,
+                              for inputs larger than the memory (peak memory depends on --chunk_rows)
+    -c  | --chunk_rows      : rows per sorted chunk with --external_sort (default 500000)
+    -w  | --workers         : split the GUIDs into this many shards and sort and combine them
+                              in parallel processes (default 1, not used with --external_sort)
+    -r  | --resume          : keep the rows of an existing output file (e.g. of a run that died)
+                              and only write the GUIDs after them (not with --upload)
+    -P  | --presorted       : the input is already sorted by guid and Fitment EPID, skip the
+                              sort without checking (by default sorted input is detected)
+    -a  | --pyarrow         : parse the input with the pyarrow engine of pandas (if installed)
+    -d  | --legacy_dtypes   : read the input with the default pandas types instead of the
+                              compact ones (uses several times more memory)
+    -u  | --upload          : upload the combined rows to SureDone while the transformation runs,
+                              as bulk jobs of --part_rows GUIDs (the output file is only written
+                              if -o is given)
+    -k  | --part_rows       : GUIDs per uploaded bulk job with --upload (default 50000)
+    -U  | --upload_options  : options of suredone_upload.py used by --upload, in quotes (credentials
+                              file, email, selections, max_concurrent, retries, fetch_results, ...)
+    -F  | --fingerprints    : file with a fingerprint of the rows of every GUID; only the GUIDs that are
+                              new or changed since the last upload are written (and logged). The file
+                              is only updated with --upload, once every part was uploaded
+    -E  | --export          : export of suredone_download.py with the ebayepid field, or 'latest' for
+                              the newest one in its download directory; GUIDs whose new ebayepid
+                              is the same as in the export are not written (and not logged)
 
 Example:
     $ python rearrange.py -f [source.csv]
@@ -107,44 +276,155 @@ Example:
 
     $ python rearrange.py -f [source.csv] -o [output.csv] -i 1000
     $ python rearrange.py -file [source.csv] --output_file [output.csv] --max_iterations 1000
+
+    $ python rearrange.py -f [source.csv] -p
+    $ python rearrange.py -file [source.csv] --profile
+
+    $ python rearrange.py -f [source.csv] -m
+    $ python rearrange.py -file [source.csv] --memstats
+
+    $ python rearrange.py -f [source.csv] -e loop
+    $ python rearrange.py -file [source.csv] --engine groupby
+
+    $ python rearrange.py -f [source.csv] -s -c 1000000
+    $ python rearrange.py -file [source.csv] --external_sort --chunk_rows 1000000
+
+    $ python rearrange.py -f [source.csv] -w 8
+    $ python rearrange.py -file [source.csv] --workers 8
+
+    $ python rearrange.py -f [source.csv] -o [output.csv] -r
+    $ python rearrange.py -file [source.csv] --output_file [output.csv] --resume
+
+    $ python rearrange.py -f [source.csv] -P
+    $ python rearrange.py -file [source.csv] --presorted
+
+    $ python rearrange.py -f [source.csv] -a
+    $ python rearrange.py -file [source.csv] --pyarrow
+
+    $ python rearrange.py -f [source.csv] -u -U "-c suredone.yaml -s sd-force -v"
+    $ python rearrange.py -file [source.csv] --upload --part_rows 20000 --upload_options "--max_concurrent 2"
+
+    $ python rearrange.py -f [source.csv] -u -F [fingerprints.csv]
+    $ python rearrange.py -file [source.csv] --upload --fingerprints [fingerprints.csv]
+
+    $ python rearrange.py -f [source.csv] -u -E latest
+    $ python rearrange.py -file [source.csv] --upload --export [SureDone_Downloads_export.csv]
 """
 
 def main (argv):
     # Parse arguments
-    inputFilePath, outputFilePath, maxItersPerGUID, VERBOSE, logLevel = parseArgs(argv)
+    inputFilePath, outputFilePath, maxItersPerGUID, VERBOSE, logLevel, profile, engine, externalSort, chunkRows, workers, resume, presorted, legacyDtypes, csvEngine, uploadArgs, partRows, fingerprintPath, exportPath, memstats = parseArgs(argv)
 
     print ("""\nInitiating transformation...
         \rInput File              : {}
         \rOutput File             : {}
         \rMax Iterations per GUID : {}
         \rVerbose                 : {}
-        \rLogging Level           : {}""".format(inputFilePath, outputFilePath, maxItersPerGUID, VERBOSE, logLevel))
+        \rLogging Level           : {}
+        \rProfile                 : {}
+        \rMemory Stats            : {}
+        \rEngine                  : {}
+        \rExternal Sort           : {}
+        \rWorkers                 : {}
+        \rResume                  : {}
+        \rPresorted               : {}
+        \rInput Types             : {}
+        \rUpload                  : {}
+        \rFingerprints            : {}
+        \rLive Values             : {}""".format(inputFilePath, outputFilePath, maxItersPerGUID, VERBOSE, logLevel, profile, memstats, engine, '{} rows per chunk'.format(chunkRows) if externalSort else False, workers, resume, presorted,
+                                         'pandas defaults' if legacyDtypes else 'compact ({} engine)'.format(csvEngine), '{} GUIDs per bulk job'.format(partRows) if uploadArgs else False,
+                                         fingerprintPath or False, exportPath or False))
 
-    # Read CSV and get it sorted
-    csvfile = readAndSortCSV(inputFilePath)
+    # --memstats only traces memory, --profile also runs cProfile
+    profiler = Profiler()
+    if profile or memstats:
+        profiler.start(cpu=profile, stageSites=MEMSTATS_SITES if memstats else 0)
 
-    # Memory usage analysis start
-    # tracemalloc.start()
+    # Bulk jobs are uploaded in the background while the GUIDs are combined
+    uploader = None
+    if uploadArgs:
+        try:
+            uploader = PartUploader(uploadArgs, partRows)
+        except Exception as e:
+            print ("Error: The upload could not be started: {}".format(e))
+            sys.exit(6)
 
-    # Loop through file
-    outputcsv, finalTime, allGUIDs, eachGUIDIters = mainLoop(csvfile, maxItersPerGUID, VERBOSE)
+    # GUIDs whose ebayepid is already live in SureDone are not written
+    liveValues = None
+    if exportPath:
+        with profiler.stage('live_values'):
+            liveValues = readLiveValues(exportPath)
+            print ("\nRead the live ebayepid of {} GUIDs from {}".format(len(liveValues), exportPath))
 
-    # Printing log file
-    printLogFile(allGUIDs, eachGUIDIters, maxItersPerGUID, logLevel)
+    fingerprints = None
+    if externalSort:
+        # Sort on disk, the GUIDs are combined and written while the sorted chunks are merged
+        with profiler.stage('external_sort'):
+            print ("\nStarting external sort...")
+            progress = ProgressReporter('Combined') if VERBOSE else None
+            rows = aggregateSortedRows(externalSortCSV(inputFilePath, chunkRows, VERBOSE, progress), maxItersPerGUID)
+            finalTime = writeOutput(rows, outputFilePath, resume, progress, uploader, liveValues, LogFileWriter(maxItersPerGUID, logLevel))
+            print ("External sort Complete.")
+    else:
+        if workers > 1:
+            # Read CSV, the shards are sorted and combined by the worker processes
+            with profiler.stage('read'):
+                csvfile = readInputCSV(inputFilePath, legacyDtypes, csvEngine)
+        else:
+            # Read CSV and get it sorted
+            with profiler.stage('read'):
+                csvfile = readInputCSV(inputFilePath, legacyDtypes, csvEngine)
+            if not presorted:
+                with profiler.stage('sort'):
+                    csvfile = sortRows(csvfile, VERBOSE)
 
-    # Printing output to console and file
-    outputcsv.to_csv(outputFilePath, index=False);
-    print ("\nPrinting output...")
-    
-    if VERBOSE: print (outputcsv, end='\n\n')
-    print ("Output CSV has been written to: {}".format(outputFilePath))
+        # Only the GUIDs that changed since the last run are combined
+        if fingerprintPath:
+            with profiler.stage('fingerprints'):
+                csvfile, fingerprints = selectChangedRows(csvfile, maxItersPerGUID, fingerprintPath, VERBOSE)
+
+        if workers > 1:
+            rows = parallelLoop(csvfile, maxItersPerGUID, engine, workers, presorted, VERBOSE)
+        else:
+            rows = getEngineRows(csvfile, maxItersPerGUID, engine, VERBOSE)
+
+        # Loop through file, every GUID is written to the output and the log file as soon as it is complete
+        with profiler.stage('main_loop'):
+            progress = ProgressReporter('Combined', csvfile.shape[0]) if VERBOSE else None
+            finalTime = writeOutput(rows, outputFilePath, resume, progress, uploader, liveValues, LogFileWriter(maxItersPerGUID, logLevel))
+        del csvfile, rows
+
+    # Wait for the last bulk jobs
+    uploaded = True
+    if uploader is not None:
+        with profiler.stage('upload'):
+            uploaded = uploader.finish()
+
+    # The next run compares against this run's fingerprints, unless the rows did not get uploaded
+    if fingerprints is not None:
+        if uploader is not None and uploaded:
+            writeFingerprints(fingerprints, fingerprintPath)
+            print ("\nFingerprints written to: {}".format(fingerprintPath))
+        else:
+            print ("\nFingerprints were not updated, the next run writes the same GUIDs again.")
+
+    if outputFilePath:
+        print ("\nPrinting output...")
+        if VERBOSE: print (pd.read_csv(outputFilePath, nrows=PREVIEW_ROWS), end='\n\n')
+        print ("Output CSV has been written to: {}".format(outputFilePath))
     if VERBOSE: print ("\nTime Taken by main loop: {} milliseconds".format(finalTime))
 
-    # Get memory usage peak
-    # if VERBOSE:
-    #     current, peak = tracemalloc.get_traced_memory()
-    #     print(f"\nCurrent memory usage is {current / 10**6}MB; Peak was {peak / 10**6}MB")
-    #     tracemalloc.stop()
+    # Memory of every stage goes to the end of the log file
+    if memstats:
+        printMemoryStats(profiler)
+        print ("Memory stats written to: {}".format(getLogFilePath()))
+
+    # Write profiling reports next to the log file
+    for profilePath in profiler.finish("exportsuredoneepid-profile_{}".format(getRunSuffix())):
+        print ("Profile written to: {}".format(profilePath))
+
+    if not uploaded:
+        sys.exit(6)
 
 def validateFilePath (inputPath, output):
     """
@@ -193,7 +473,7 @@ def validateFilePath (inputPath, output):
             sys.exit(4)
     return output
 
-def readAndSortCSV(csvPath):
+def readAndSortCSV(csvPath, presorted=False, VERBOSE=False, legacyDtypes=False, csvEngine='c'):
     """
     Function that will take a csv path, open it, and sort it based on GUIDs.
     This is to make sure that all the same GUIDs are placed together. Program's
@@ -206,16 +486,121 @@ def readAndSortCSV(csvPath):
     ----------
         - csvPath : str
             A path to the source csv file
+        - presorted : bool
+            Whether the source csv is known to be sorted, it is then used as it is
+        - VERBOSE : bool
+            Whether to print how the csv was sorted
+        - legacyDtypes, csvEngine
+            See readInputCSV()
     
     Returns
     -------
         - csv : Data Frame (pandas)
             A DataFrame object that contains the sorted version of the source csv
     """
-    csv = pd.read_csv(csvPath)
-    csv = csv.sort_values(['guid', 'Fitment EPID'])
+    csv = readInputCSV(csvPath, legacyDtypes, csvEngine)
+    if presorted:
+        return csv
+    return sortRows(csv, VERBOSE)
+
+def readInputCSV(csvPath, legacyDtypes=False, csvEngine='c'):
+    """
+    Function that reads the guid, EPID and note columns of the source csv with compact types.
+    Columns keep the type pd.read_csv infers (e.g. float EPIDs if some are missing), so the
+    engines see the same values, but text columns with repeated values (guids, notes) are
+    turned into categoricals: every distinct string is stored once, and the categories are
+    sorted, so the column still sorts like text.
+
+    Parameters
+    ----------
+        - csvPath : str
+            A path to the source csv file
+        - legacyDtypes : bool
+            Whether to read all columns with the default types instead
+        - csvEngine : str
+            Parser engine of pd.read_csv, 'c' or 'pyarrow'
+
+    Returns
+    -------
+        - csv : pd.dataframe
+            The guid, EPID and note columns of the source csv
+    """
+    if legacyDtypes:
+        return pd.read_csv(csvPath, engine=csvEngine)
+    csv = pd.read_csv(csvPath, usecols=[0, 1, 2], engine=csvEngine)
+    for name in csv.columns:
+        csv[name] = getCompactColumn(csv[name])
     return csv
 
+def getCompactColumn(column):
+    """
+    Function that returns a text column as a categorical with sorted categories, if at most
+    CATEGORY_SHARE of its values are distinct. Other columns are returned as they are.
+    """
+    if is_numeric_dtype(column.dtype) or isinstance(column.dtype, pd.CategoricalDtype):
+        return column
+    try:
+        codes, uniques = pd.factorize(column, sort=True)
+    except TypeError:
+        # Mixed types that can't be sorted
+        return column
+    if len(uniques) > len(column) * CATEGORY_SHARE:
+        return column
+    return pd.Series(pd.Categorical.from_codes(codes, categories=uniques), index=column.index, name=column.name)
+
+def getOrderCodes(column):
+    """
+    Function that numbers the values of a column in their sort order, missing values
+    last like in sort_values().
+    """
+    codes = pd.factorize(column, sort=True)[0]
+    return np.where(codes < 0, codes.max() + 1, codes)
+
+def sortRows(csv, VERBOSE=False):
+    """
+    Function that sorts the rows by guid and EPID in the order of
+    sort_values(['guid', 'Fitment EPID']), without sorting what is already in order.
+    Neighbouring rows are compared to find out of order rows: if there are none the rows
+    are returned as they are, if the GUIDs are in order but the EPIDs of some GUIDs are
+    not, only the rows of those GUIDs are sorted, otherwise all rows are sorted.
+
+    Parameters
+    ----------
+        - csv : pd.dataframe
+            The dataframe of the input CSV file
+        - VERBOSE : bool
+            Whether to print how the rows were sorted
+
+    Returns
+    -------
+        - csv : pd.dataframe
+            The sorted dataframe
+    """
+    if csv.shape[0] < 2:
+        return csv
+    guids = getOrderCodes(csv['guid'])
+    epids = getOrderCodes(csv['Fitment EPID'])
+
+    # Rows that come before the previous row
+    guidDrops = guids[1:] < guids[:-1]
+    epidDrops = (guids[1:] == guids[:-1]) & (epids[1:] < epids[:-1])
+    if not guidDrops.any():
+        if not epidDrops.any():
+            if VERBOSE: print ("Input is sorted, skipping the sort.")
+            return csv
+
+        # The GUIDs are in order, so each out of order GUID is sorted in its place
+        unsorted = np.isin(guids, guids[1:][epidDrops])
+        if unsorted.mean() <= PARTIAL_SORT_SHARE:
+            positions = np.flatnonzero(unsorted)
+            order = np.arange(csv.shape[0])
+            order[positions] = positions[np.lexsort((epids[positions], guids[positions]))]
+            if VERBOSE: print ("Sorted {} out of order GUIDs ({} rows).".format(np.unique(guids[positions]).size, positions.size))
+            return csv.iloc[order]
+
+    if VERBOSE: print ("Sorting all rows.")
+    return csv.iloc[np.lexsort((epids, guids))]
+
 def parseArgs (argv):
     """
     Function that parses the arguments sent from the command line, validates
@@ -234,10 +619,39 @@ def parseArgs (argv):
             File path of the output CSV file after validations
         - maxItersPerGUID : int
             Max iterations allowed per GUID after validations
+        - profile : bool
+            Whether to profile the run with cProfile and tracemalloc
+        - memstats : bool
+            Whether to trace the memory of every stage into the log file
+        - engine : str
+            Engine that combines the rows of a GUID, one of ENGINES
+        - externalSort : bool
+            Whether to sort the input on disk in chunks
+        - chunkRows : int
+            Rows per sorted chunk of the external sort
+        - workers : int
+            Number of worker processes, 1 to run in this process
+        - resume : bool
+            Whether to keep the rows of an existing output file and append the rest
+        - presorted : bool
+            Whether the input is known to be sorted by guid and EPID
+        - legacyDtypes : bool
+            Whether to read the input with the default pandas types
+        - csvEngine : str
+            Parser engine of pd.read_csv, 'c' or 'pyarrow'
+        - uploadArgs : argparse.Namespace
+            Options of suredone_upload.py for --upload, None without --upload
+        - partRows : int
+            GUIDs per uploaded bulk job
+        - fingerprintPath : str
+            A path to the fingerprint file, None to write all GUIDs
+        - exportPath : str
+            A path to the SureDone export with the live ebayepid values, None to write all GUIDs
     """
     # Defining options in for command line arguments
-    options = "hf:o:i:vl:"
-    long_options = ["file=", "output_file=", "max_iterations=", "verbose", "log="]
+    options = "hf:o:i:vl:pme:sc:w:rPaduk:U:F:E:"
+    long_options = ["file=", "output_file=", "max_iterations=", "verbose", "log=", "profile", "memstats", "engine=", "external_sort", "chunk_rows=", "workers=", "resume", "presorted",
+                    "pyarrow", "legacy_dtypes", "upload", "part_rows=", "upload_options=", "fingerprints=", "export="]
     
     # Arguments
     inputFilePath = ''
@@ -245,6 +659,21 @@ def parseArgs (argv):
     maxItersPerGUID = 1000
     VERBOSE = False
     logLevel = 0
+    profile = False
+    memstats = False
+    engine = 'groupby'
+    externalSort = False
+    chunkRows = 500000
+    workers = 1
+    resume = False
+    presorted = False
+    legacyDtypes = False
+    csvEngine = 'c'
+    upload = False
+    partRows = PART_ROWS
+    uploadOptions = ''
+    fingerprintPath = None
+    exportPath = None
     
     # Extracting arguments
     try:
@@ -275,10 +704,100 @@ def parseArgs (argv):
             if logLevel not in (0,1,2):
                 print ("Warning: Wrong log level entered. Permitted log levels are 0, 1, and 2. Using log level 1...")
                 logLevel = 1
+        elif option in ("-p", "--profile"):
+            profile = True
+        elif option in ("-m", "--memstats"):
+            memstats = True
+        elif option in ("-e", "--engine"):
+            engine = value.lower()
+            if engine not in ENGINES:
+                print ("Error: Unknown engine '{}'. Available engines are: {}.".format(value, ', '.join(ENGINES)))
+                print (HELP_MESSAGE)
+                sys.exit(2)
+        elif option in ("-s", "--external_sort"):
+            externalSort = True
+        elif option in ("-c", "--chunk_rows"):
+            chunkRows = int(value)
+            # Make sure that the value is in positive and non-zero
+            if chunkRows < 1:
+                chunkRows = 500000
+        elif option in ("-w", "--workers"):
+            workers = max(1, int(value))
+        elif option in ("-r", "--resume"):
+            resume = True
+        elif option in ("-P", "--presorted"):
+            presorted = True
+        elif option in ("-a", "--pyarrow"):
+            if pyarrow is None:
+                print ("Warning: pyarrow is not installed, using the C engine of pandas.")
+            else:
+                csvEngine = 'pyarrow'
+        elif option in ("-d", "--legacy_dtypes"):
+            legacyDtypes = True
+        elif option in ("-u", "--upload"):
+            upload = True
+        elif option in ("-k", "--part_rows"):
+            partRows = int(value)
+            # Make sure that the value is in positive and non-zero
+            if partRows < 1:
+                partRows = PART_ROWS
+        elif option in ("-U", "--upload_options"):
+            uploadOptions = value
+        elif option in ("-F", "--fingerprints"):
+            fingerprintPath = value
+        elif option in ("-E", "--export"):
+            if value.lower() == 'latest':
+                exportPath = suredone_lookup.getLatestExport()
+                if exportPath is None:
+                    print ("Error: No SureDone_Downloads_*.csv found in {}. Use -E [export.csv] to define the export path.".format(suredone_lookup.getDownloadDirectory()))
+                    sys.exit(3)
+            elif not path.exists(value):
+                print ("Error: The export {} does not exist.".format(value))
+                sys.exit(3)
+            else:
+                exportPath = value
+
+    # A generated output file name is new on every run, there is nothing to resume
+    if resume and outputFilePath == '':
+        print ("Warning: --resume needs an output file (-o), starting a new output file.")
+        resume = False
+
+    # The output file does not tell which of its rows were uploaded, resuming would upload them all again
+    if resume and upload:
+        print ("Error: --resume can not be used with --upload.")
+        sys.exit(2)
+
+    # Options of the upload script, parsed by its own parser
+    uploadArgs = None
+    if upload:
+        if suredone_upload is None:
+            print ("Error: --upload needs suredone_upload.py and the requests package.")
+            sys.exit(2)
+        try:
+            uploadArgs = suredone_upload.get_args(shlex.split(uploadOptions))
+        except SystemExit:
+            print ("Error in --upload_options!")
+            sys.exit(2)
+
+    # With --upload the output file is only written when it was asked for
+    writeOutputFile = not upload or outputFilePath != ''
 
     # Validate paths
     outputFilePath = validateFilePath(inputFilePath, outputFilePath)
-    return inputFilePath, outputFilePath, maxItersPerGUID, VERBOSE, logLevel
+    if not writeOutputFile:
+        outputFilePath = None
+    # The external sort already bounds memory and runs in this process
+    if externalSort and workers > 1:
+        print ("Warning: --workers is not used with --external_sort.")
+        workers = 1
+    # The fingerprints are computed on the rows in memory
+    if externalSort and fingerprintPath:
+        print ("Warning: --fingerprints is not used with --external_sort, writing all GUIDs.")
+        fingerprintPath = None
+    # Nothing tells whether an output file reached SureDone, only an upload moves the fingerprints on
+    if fingerprintPath and not upload:
+        print ("Warning: without --upload the fingerprint file is only read, not updated.")
+    return inputFilePath, outputFilePath, maxItersPerGUID, VERBOSE, logLevel, profile, engine, externalSort, chunkRows, workers, resume, presorted, legacyDtypes, csvEngine, uploadArgs, partRows, fingerprintPath, exportPath, memstats
 
 def mainLoop(csvfile, maxItersPerGUID, VERBOSE):
     """
@@ -292,18 +811,14 @@ def mainLoop(csvfile, maxItersPerGUID, VERBOSE):
         - maxItersPerGUID : int
             Maximum number of iteration allowed per GUID
         - VERBOSE : bool
-            Whether to print looping details or not
+            Not used, the progress is reported by writeOutput()
     
-    Returns
-    -------
-        - outputcsv : pd.dataframe
-            Dataframe that containst the final contents to be saved in the output CSV
-        - finalTime : long
-            Time taken by the whole loop
+    Yields
+    ------
+        - guid, ebayepid, iterations : tuple
+            Combined row of a GUID as soon as the GUID is complete, and its number of rows
+            (including the rows over the max iterations)
     """
-    # Create empty dataframe
-    outputcsv = pd.DataFrame(columns=['action','guid','ebayepid'])
-
     # Read number of lines
     numrows = csvfile.shape[0]
     
@@ -314,39 +829,15 @@ def mainLoop(csvfile, maxItersPerGUID, VERBOSE):
     foundOnce = False
     currentGUIDIters = 0
 
-    # Logging variables
-    logGUIDS = []
-    logIters = []
-    
-    # Time measurement variables
-    forStartTime = current_milli_time()
-    
-    # Progress publishing variables
-    stepDiv = int(numrows / 100)
-    steps = 0
-    progress = 0
-    progressPrefix = "Completed: {}%\t\t|\tIterations of current GUID: {}      "
-
     print ("\nStarting main loop...")
     for i in range (0, numrows):
-        if VERBOSE:
-            steps = steps + 1
-            if (steps >= stepDiv):
-                steps = 0
-                progress = progress + 1
-            
-            if progress < 100:
-                print (progressPrefix.format(progress, currentGUIDIters), end='\r')
-            elif progress == 100 and i == numrows-1:
-                print (progressPrefix.format(progress, currentGUIDIters))
-
         # # Read one row
         row = csvfile.iloc[i]
         
         # Extract columns from row
-        currentGUID = str(row[0])
-        currentEPID = str(row[1])
-        currentNote = str(row[2])
+        currentGUID = str(row.iloc[0])
+        currentEPID = str(row.iloc[1])
+        currentNote = str(row.iloc[2])
         
         # if currentNote is NaN, convert it to NoneType
         if currentNote == 'nan':
@@ -359,12 +850,7 @@ def mainLoop(csvfile, maxItersPerGUID, VERBOSE):
                 if len(RUNNING_EBAYEPID) > 0:
                     RUNNING_EBAYEPID = RUNNING_EBAYEPID[:-1]
                 
-                tempdf = pd.DataFrame([['edit', RUNNING_GUID, RUNNING_EBAYEPID]], columns=['action','guid','ebayepid'])
-                outputcsv = outputcsv.append(tempdf, ignore_index=True)
-
-                # Add in logging variables
-                logGUIDS.append(RUNNING_GUID)
-                logIters.append(currentGUIDIters)
+                yield RUNNING_GUID, RUNNING_EBAYEPID, currentGUIDIters
 
             RUNNING_GUID = currentGUID
             RUNNING_EBAYEPID = ''
@@ -376,26 +862,26 @@ def mainLoop(csvfile, maxItersPerGUID, VERBOSE):
         # Check if iterations on current GUID have crossed the limit
         if currentGUIDIters >= maxItersPerGUID:
             currentGUIDIters = currentGUIDIters + 1 # Keep updating this so iterations can be logged properly
-            continue
-        
-        # Concatenate current row's epid and note (if exists) to the RUNNING ebayepid
-        toconcat = currentEPID
-        if currentNote:
-            toconcat += "::{}*".format(currentNote)
         else:
-            toconcat += "*"
-        RUNNING_EBAYEPID += toconcat
-        currentGUIDIters = currentGUIDIters + 1
+            # Concatenate current row's epid and note (if exists) to the RUNNING ebayepid
+            toconcat = currentEPID
+            if currentNote:
+                toconcat += "::{}*".format(currentNote)
+            else:
+                toconcat += "*"
+            RUNNING_EBAYEPID += toconcat
+            currentGUIDIters = currentGUIDIters + 1
 
-        # If the last row has arrived, add current guid and ebayepid to the output csv
+        # If the last row has arrived, add current guid and ebayepid to the output csv.
+        # This is also done when the last GUID is over the max iterations, and the last
+        # GUID is logged like every other one.
         if i == numrows-1:
             if foundOnce:
                 # Add current guid and ebayepid to the output csv
                 if len(RUNNING_EBAYEPID) > 0:
                     RUNNING_EBAYEPID = RUNNING_EBAYEPID[:-1]
                 
-                tempdf = pd.DataFrame([['edit', RUNNING_GUID, RUNNING_EBAYEPID]], columns=['action','guid','ebayepid'])
-                outputcsv = outputcsv.append(tempdf, ignore_index=True)
+                yield RUNNING_GUID, RUNNING_EBAYEPID, currentGUIDIters
         # Debug message:
         """
         system('cls')
@@ -408,53 +894,968 @@ def mainLoop(csvfile, maxItersPerGUID, VERBOSE):
         print ("------------------------\n\n")
         """
     
-    # Calculate time taken
-    finalTime = current_milli_time() - forStartTime
     print ("Main loop Complete.")
-    return outputcsv, finalTime, logGUIDS, logIters
 
-def printLogFile(allGUIDs, eachGUIDIters, maxIters, logLevel):
+def getRowStrings(csvfile):
+    """
+    Function that converts the guid, EPID and note columns to the strings the row by row
+    loop sees. The loop reads a row with iloc, which turns the row into one Series: when all
+    three columns are numeric, their values are first cast to a common type (e.g. an integer
+    EPID becomes a float next to an all-empty note column), otherwise they keep their own type.
+    Every value is then formatted with str(), so missing values become 'nan'.
+
+    Parameters
+    ----------
+        - csvfile : pd.dataframe
+            The sorted dataframe, guid, EPID and note being its first three columns
+
+    Returns
+    -------
+        - guids, epids, notes : np.ndarray
+            The columns as arrays of python strings
+    """
+    columns = [csvfile.iloc[:, position] for position in range(3)]
+    if all(is_numeric_dtype(column.dtype) for column in columns):
+        commonType = np.result_type(*[column.dtype for column in columns])
+        columns = [column.astype(commonType) for column in columns]
+    return [getColumnStrings(column) for column in columns]
+
+def getColumnStrings(column):
+    """
+    Function that formats every value of a column with str() as an array of python strings.
+    """
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        # Each category is formatted once, missing values (code -1) become 'nan'
+        strings = np.array([str(value) for value in column.cat.categories] + ['nan'], dtype=object)
+        return strings[column.cat.codes.to_numpy()]
+    # Integers are formatted the same way by astype(str), which is much faster than calling str() on each
+    return np.array((column.astype(str) if is_integer_dtype(column.dtype) else column.map(str)).tolist(), dtype=object)
+
+def getRowTokens(epids, notes):
+    """
+    Function that formats every row as epid::note, or only the epid if the note is missing.
+    """
+    hasNote = (notes != 'nan') & (notes != '')
+    tokens = epids.copy()
+    tokens[hasNote] = epids[hasNote] + '::' + notes[hasNote]
+    return tokens
+
+def joinGroups(tokens, sizes, separator='*'):
     """
-    Function that will handle all the logging of GUIDs and their iterations
-    based on the max iterations allowed and the logLevel defined by user.
+    Function that joins consecutive runs of strings with a separator.
+    Short runs are concatenated all at once with np.add.reduceat; adding strings one by one
+    copies the partial result every time, so long runs are joined with str.join instead.
 
     Parameters
     ----------
-        - allGUIDs      : list
-            A list of all GUIDs that were processed by the main loop
-        - eachGUIDIters : list
-            Iterations of each respective GUID in the allGUIDs list
-        - maxIters      : int
-            The max number of iterations that were allowed per GUID
-        - logLevel      : int
-            The level of information that needs to be displayed.
-    """
-    if (logLevel == 0):
+        - tokens : np.ndarray
+            Strings of all runs, one run after another
+        - sizes : np.ndarray
+            Length of each run, every run has at least one string
+        - separator : str
+            Separator placed between the strings of a run
+
+    Returns
+    -------
+        - joined : np.ndarray
+            One joined string per run
+    """
+    joined = np.empty(len(sizes), dtype=object)
+    starts = np.concatenate(([0], np.cumsum(sizes)[:-1])).astype(np.int64)
+
+    short = sizes <= SHORT_GROUP_SIZE
+    if short.any():
+        shortTokens = tokens[np.repeat(short, sizes)] + separator
+        shortStarts = np.concatenate(([0], np.cumsum(sizes[short])[:-1])).astype(np.int64)
+        joined[short] = [value[:-len(separator)] for value in np.add.reduceat(shortTokens, shortStarts)]
+    for group in np.flatnonzero(~short):
+        joined[group] = separator.join(tokens[starts[group]:starts[group] + sizes[group]])
+    return joined
+
+def groupbyLoop(csvfile, maxItersPerGUID, VERBOSE):
+    """
+    Vectorized version of mainLoop that yields the same rows.
+    Consecutive rows with the same GUID form a group, every row is numbered within its
+    group and the first maxItersPerGUID rows are joined with '*', OUTPUT_BLOCK_GUIDS
+    groups at a time.
+
+    Parameters
+    ----------
+        - csvfile : pd.dataframe
+            The dataframe that contains the contents of the input CSV file (sorted by GUID)
+        - maxItersPerGUID : int
+            Maximum number of iteration allowed per GUID
+        - VERBOSE : bool
+            Whether to print details or not
+
+    Yields
+    ------
+        - guid, ebayepid, iterations : tuple
+            Same as mainLoop()
+    """
+    print ("\nStarting main loop (groupby engine)...")
+
+    guids, epids, notes = getRowStrings(csvfile)
+    numrows = len(guids)
+    if numrows == 0:
+        print ("Main loop Complete.")
         return
 
-    # log file naming
-    tempdate = datetime.now()
-    suffix = "yyyy_mm_dd-hh-mm-sec"
-    suffix = "{}_{}_{}-{}-{}-{}".format(tempdate.year, tempdate.month, tempdate.day, tempdate.hour, tempdate.minute, tempdate.second)
-    logFilePath = "exportsuredoneepid-log_{}.csv.log".format(suffix)
-
-    # Temporarily substitute stdout with log file
-    originalstdout = sys.stdout
-    sys.stdout = open (logFilePath, 'w')
-
-    print ("\tGUIDS\t\t|\tIterations")
-    print ("========================|========================")
-    if logLevel == 1:
-        for i in range (0, len(allGUIDs)):
-            if (eachGUIDIters[i] >= maxIters):
-                print ("\t{}\t|\t{}".format(allGUIDs[i], eachGUIDIters[i]))
-
-    elif logLevel == 2:
-        for i in range (0, len(allGUIDs)):
-            print ("\t{}\t|\t{}".format(allGUIDs[i], eachGUIDIters[i]))
-
-    # Return original stdout to sys.stdout for commandline printint
-    sys.stdout = originalstdout
+    # A group starts wherever the GUID differs from the previous row
+    starts = np.flatnonzero(np.concatenate(([True], guids[1:] != guids[:-1])))
+    sizes = np.diff(np.append(starts, numrows))
+    positions = np.arange(numrows) - np.repeat(starts, sizes)
+
+    tokens = getRowTokens(epids, notes)
+
+    # Only the first maxItersPerGUID rows of a group are joined, every group keeps its first row
+    kept = positions < maxItersPerGUID
+    keptTokens = tokens[kept]
+    keptSizes = np.minimum(sizes, maxItersPerGUID)
+    keptStarts = np.concatenate(([0], np.cumsum(keptSizes))).astype(np.int64)
+    allGUIDs = guids[starts]
+    del guids, epids, notes, positions, tokens, kept
+
+    for first in range(0, len(starts), OUTPUT_BLOCK_GUIDS):
+        last = min(first + OUTPUT_BLOCK_GUIDS, len(starts))
+        ebayepids = joinGroups(keptTokens[keptStarts[first]:keptStarts[last]], keptSizes[first:last])
+        yield from zip(allGUIDs[first:last].tolist(), ebayepids.tolist(), sizes[first:last].tolist())
+
+    if VERBOSE: print ("Combined {} rows into {} GUIDs.".format(numrows, len(starts)))
+    print ("Main loop Complete.")
+
+def getColumnKind(column):
+    """
+    Function that returns the kind of values pandas found in a column of one chunk:
+    'int', 'float', 'bool', 'str' or 'empty' (only missing values, read as float).
+    """
+    if column.dtype == bool:
+        return 'bool'
+    if is_integer_dtype(column.dtype):
+        return 'int'
+    if is_numeric_dtype(column.dtype):
+        return 'empty' if column.isna().all() else 'float'
+    return 'str'
+
+def combineKinds(first, second):
+    """
+    Function that combines the kinds of a column in two chunks into the kind pandas
+    would have given the column if both chunks had been read at once.
+    """
+    if first is None or first == second:
+        return second
+    kinds = {first, second}
+    if kinds <= {'int', 'float', 'empty'}:
+        return 'float'
+    if kinds == {'str', 'empty'}:
+        return 'str'
+    # Booleans with missing values or mixed with other values are read as objects
+    return 'str'
+
+def probeColumnKinds(csvPath, chunkRows):
+    """
+    Function that reads the input once in chunks to find the type every column would have
+    if the whole file was read with pd.read_csv. The chunks of the external sort are read with
+    these types, so values are formatted and sorted exactly like in the in-memory path.
+    (Columns that pandas itself reads with mixed types are read as strings.)
+
+    Parameters
+    ----------
+        - csvPath : str
+            A path to the source csv file
+        - chunkRows : int
+            Rows per chunk
+
+    Returns
+    -------
+        - kinds : dict
+            Kind of every column, see getColumnKind()
+    """
+    kinds = {}
+    for chunk in pd.read_csv(csvPath, chunksize=chunkRows):
+        for name in chunk.columns:
+            kinds[name] = combineKinds(kinds.get(name), getColumnKind(chunk[name]))
+    return kinds
+
+def getSortKeys(column):
+    """
+    Function that returns (missing, value) sort keys of a column, missing values sort last like in sort_values.
+    """
+    missing = column.isna().to_numpy()
+    fill = 0 if is_numeric_dtype(column.dtype) else ''
+    return [(1, fill) if isMissing else (0, value) for isMissing, value in zip(missing, column.tolist())]
+
+def writeSortedRun(chunk, runPath):
+    """
+    Function that sorts a chunk by guid and EPID and pickles it to a run file in batches.
+    Every row is stored with its sort key (guid, EPID, row number) and the guid, EPID and
+    note strings that the engines see. The row number keeps equal keys in input order,
+    like the stable sort_values of the in-memory path.
+
+    Parameters
+    ----------
+        - chunk : pd.dataframe
+            Rows of one chunk, its index holds the row numbers in the input file
+        - runPath : str
+            Path of the run file
+    """
+    chunk = chunk.sort_values(['guid', 'Fitment EPID'], kind='stable')
+    guids, epids, notes = getRowStrings(chunk)
+    rows = list(zip(getSortKeys(chunk['guid']), getSortKeys(chunk['Fitment EPID']), chunk.index.tolist(), guids, epids, notes))
+    with open(runPath, 'wb') as runFile:
+        for start in range(0, len(rows), RUN_BATCH_ROWS):
+            pickle.dump(rows[start:start + RUN_BATCH_ROWS], runFile, protocol=pickle.HIGHEST_PROTOCOL)
+
+def readSortedRun(runPath):
+    """
+    Function that yields the rows of a run file one batch at a time.
+    """
+    with open(runPath, 'rb') as runFile:
+        while True:
+            try:
+                batch = pickle.load(runFile)
+            except EOFError:
+                return
+            for row in batch:
+                yield row
+
+def externalSortCSV(csvPath, chunkRows, VERBOSE=False, progress=None):
+    """
+    Generator version of readAndSortCSV for inputs larger than the memory. The input is read
+    in chunks, every chunk is sorted and spilled to a temporary run file, and the runs are
+    merged with a k-way merge. Only one chunk and one batch per run are held in memory.
+
+    Parameters
+    ----------
+        - csvPath : str
+            A path to the source csv file
+        - chunkRows : int
+            Rows per chunk
+        - VERBOSE : bool
+            Whether to print details or not
+        - progress : ProgressReporter
+            Reporter of the merge, it is told the number of rows once all chunks are sorted
+
+    Yields
+    ------
+        - row : tuple
+            (guid, epid, note) strings in the order of sort_values(['guid', 'Fitment EPID'])
+    """
+    kinds = probeColumnKinds(csvPath, chunkRows)
+    dtypes = {name: KIND_DTYPES[kind] for name, kind in kinds.items()}
+
+    runDirectory = tempfile.mkdtemp(prefix='exportsuredoneepid-sort_')
+    try:
+        runPaths = []
+        numrows = 0
+        for chunk in pd.read_csv(csvPath, chunksize=chunkRows, dtype=dtypes):
+            runPath = path.join(runDirectory, 'run_{}.pkl'.format(len(runPaths)))
+            writeSortedRun(chunk, runPath)
+            runPaths.append(runPath)
+            numrows += chunk.shape[0]
+            if VERBOSE: print ("Sorted chunk {} ({} rows)".format(len(runPaths), chunk.shape[0]))
+        if progress is not None:
+            progress.start(numrows)
+
+        for row in heapq.merge(*[readSortedRun(runPath) for runPath in runPaths]):
+            yield row[3:]
+    finally:
+        shutil.rmtree(runDirectory, ignore_errors=True)
+
+def aggregateSortedRows(rows, maxItersPerGUID):
+    """
+    Generator that combines sorted (guid, epid, note) rows into one ebayepid per GUID,
+    with the same format, max iterations and iteration counts as the engines.
+
+    Parameters
+    ----------
+        - rows : iterable
+            (guid, epid, note) strings sorted by guid
+        - maxItersPerGUID : int
+            Maximum number of iteration allowed per GUID
+
+    Yields
+    ------
+        - guid, ebayepid, iterations : tuple
+            Combined row of a GUID and its number of rows (including the rows over the max iterations)
+    """
+    runningGUID = None
+    tokens = []
+    iterations = 0
+    for guid, epid, note in rows:
+        if guid != runningGUID:
+            if runningGUID is not None:
+                yield runningGUID, '*'.join(tokens), iterations
+            runningGUID = guid
+            tokens = []
+            iterations = 0
+        if iterations < maxItersPerGUID:
+            tokens.append(epid + '::' + note if note not in ('nan', '') else epid)
+        iterations += 1
+    if runningGUID is not None:
+        yield runningGUID, '*'.join(tokens), iterations
+
+class ProgressReporter(object):
+    """
+    Progress line of a long transformation, printed over itself at most every
+    PROGRESS_INTERVAL_MS milliseconds with the rows and GUIDs per second and, if the
+    number of rows is known, the percentage done and the ETA.
+    """
+    def __init__(self, label, total=None, interval=PROGRESS_INTERVAL_MS):
+        """
+        Constructor function.
+
+        Parameters
+        ----------
+            - label : str
+                What is counted, e.g. 'Combined'
+            - total : int
+                Number of rows to process, None if not known yet (see start())
+            - interval : int
+                Least milliseconds between two progress lines
+        """
+        self.label = label
+        self.interval = interval / 1000.0
+        self.start(total)
+
+    def start(self, total=None):
+        """
+        Function that resets the counts and sets the number of rows to process. The clock
+        starts with the first update, after the engines have read and prepared their input.
+        """
+        self.total = total
+        self.rows = 0
+        self.guids = 0
+        self.startTime = None
+        self.width = 0
+
+    def update(self, rows, guids=0):
+        now = time.monotonic()
+        if self.startTime is None:
+            self.startTime = now
+            self.nextReport = now + self.interval
+        self.rows += rows
+        self.guids += guids
+        if now >= self.nextReport:
+            self.nextReport = now + self.interval
+            self.report(now)
+
+    def report(self, now, end='\r'):
+        elapsed = max(now - (self.startTime or now), 1e-9)
+        rowsPerSecond = self.rows / elapsed
+        line = "{}: {:,} rows".format(self.label, self.rows)
+        if self.total:
+            line += " of {:,} ({:.0%})".format(self.total, min(self.rows / self.total, 1))
+        line += ", {:,} GUIDs | {:,.0f} rows/s, {:,.0f} GUIDs/s".format(self.guids, rowsPerSecond, self.guids / elapsed)
+        if end != '\r':
+            line += " | took {}".format(timedelta(seconds=round(elapsed)))
+        elif self.total and rowsPerSecond > 0:
+            line += " | ETA {}".format(timedelta(seconds=round(max(self.total - self.rows, 0) / rowsPerSecond)))
+        # Pad to overwrite the rest of a longer previous line
+        print (line.ljust(self.width), end=end, flush=True)
+        self.width = len(line)
+
+    def finish(self):
+        self.report(time.monotonic(), end='\n')
+
+def getEngineRows(csvfile, maxItersPerGUID, engine, VERBOSE):
+    """
+    Function that returns the rows generator of an engine, see mainLoop() and groupbyLoop().
+    """
+    if engine == 'loop':
+        return mainLoop(csvfile, maxItersPerGUID, VERBOSE)
+    return groupbyLoop(csvfile, maxItersPerGUID, VERBOSE)
+
+def scanOutputFile(outputFilePath):
+    """
+    Function that finds the complete rows of an output file written by an earlier run.
+    The file may end in a partly written row if that run died, the row ends after it are
+    tracked so such a row can be cut off.
+
+    Parameters
+    ----------
+        - outputFilePath : str
+            A path to the output csv file
+
+    Returns
+    -------
+        - size : int
+            Size in bytes of the header and the complete rows, 0 if there is no header
+        - rows : int
+            Number of complete rows after the header
+        - lastGUID : str
+            GUID of the last complete row, None if there is none
+    """
+    ends = [0]
+    def readLines(binaryFile):
+        for line in binaryFile:
+            if not line.endswith(b'\n'):
+                return
+            ends.append(ends[-1] + len(line))
+            yield line.decode('utf-8')
+
+    size = 0
+    rows = -1
+    lastGUID = None
+    with open(outputFilePath, 'rb') as outputFile:
+        reader = csv.reader(readLines(outputFile), strict=True)
+        try:
+            for row in reader:
+                if rows == -1 and row != OUTPUT_COLUMNS:
+                    print ("Error: {} is not an output file of this script, it can not be resumed.".format(outputFilePath))
+                    sys.exit(4)
+                size = ends[-1]
+                rows += 1
+                lastGUID = row[1] if rows > 0 else None
+        except csv.Error:
+            # A quoted value that was cut off
+            pass
+    return size, max(rows, 0), lastGUID
+
+class OutputWriter(object):
+    """
+    Buffered writer of the output CSV, formatted like DataFrame.to_csv(index=False).
+    Rows are written and flushed every OUTPUT_BUFFER_ROWS rows, so the file always holds
+    the GUIDs completed so far. When resuming, the rows already in the file are checked
+    against the first rows passed to writeRow() and skipped.
+    """
+    def __init__(self, outputFilePath, resume=False, bufferRows=OUTPUT_BUFFER_ROWS):
+        """
+        Constructor function.
+
+        Parameters
+        ----------
+            - outputFilePath : str
+                A path to the output csv file
+            - resume : bool
+                Whether to keep the complete rows of an existing output file
+            - bufferRows : int
+                Rows buffered before they are written
+        """
+        self.outputFilePath = outputFilePath
+        self.bufferRows = bufferRows
+        self.buffer = []
+        self.skipRows = 0
+        self.lastGUID = None
+        self.rowsWritten = 0
+
+        size = 0
+        if resume and path.exists(outputFilePath):
+            size, self.skipRows, self.lastGUID = scanOutputFile(outputFilePath)
+        if size > 0:
+            os.truncate(outputFilePath, size)
+            print ("Resuming after {} rows of {}".format(self.skipRows, outputFilePath))
+            self.outputFile = open(outputFilePath, 'a', newline='', encoding='utf-8')
+            self.writer = csv.writer(self.outputFile, lineterminator=os.linesep)
+        else:
+            self.outputFile = open(outputFilePath, 'w', newline='', encoding='utf-8')
+            self.writer = csv.writer(self.outputFile, lineterminator=os.linesep)
+            self.writer.writerow(OUTPUT_COLUMNS)
+
+    def writeRow(self, guid, ebayepid):
+        if self.skipRows > 0:
+            self.skipRows -= 1
+            if self.skipRows == 0 and guid != self.lastGUID:
+                print ("Error: The output file does not match the input, it ends at GUID {} where the input has {}.".format(self.lastGUID, guid))
+                sys.exit(4)
+            return
+        self.buffer.append(('edit', guid, ebayepid))
+        if len(self.buffer) >= self.bufferRows:
+            self.flush()
+
+    def flush(self):
+        self.writer.writerows(self.buffer)
+        self.outputFile.flush()
+        self.rowsWritten += len(self.buffer)
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.outputFile.close()
+        if self.skipRows > 0:
+            print ("Error: The output file has {} more rows than the input has GUIDs.".format(self.skipRows))
+            sys.exit(4)
+
+class PartUploader(object):
+    """
+    Uploader of the output rows as SureDone bulk jobs, while the GUIDs are still being combined.
+    Every PART_ROWS GUIDs the rows collected so far are posted from memory as one bulk job in a
+    thread pool, with the client and upload code of suredone_upload.py. At most max_concurrent
+    jobs are uploaded and one more is waiting, writeRow() blocks until a slot is free, so the
+    memory of the parts stays bounded. Parts that fail are written to files that can be
+    uploaded again with suredone_upload.py -i.
+    """
+    def __init__(self, uploadArgs, partRows=PART_ROWS):
+        """
+        Constructor function.
+
+        Parameters
+        ----------
+            - uploadArgs : argparse.Namespace
+                Options of suredone_upload.py (credentials_file, email, selections, max_concurrent, ...)
+            - partRows : int
+                GUIDs per bulk job
+        """
+        self.args = uploadArgs
+        self.partRows = partRows
+        self.logger = suredone_upload.create_logger(uploadArgs)
+        credentials = suredone_upload.get_credentials(uploadArgs, self.logger)
+        self.client = suredone_upload.create_client(uploadArgs, credentials, self.logger)
+        self.poller = suredone_upload.ResultPoller(uploadArgs, self.client, self.logger) if uploadArgs.fetch_results else None
+
+        concurrent = max(1, uploadArgs.max_concurrent)
+        self.executor = ThreadPoolExecutor(max_workers=concurrent)
+        self.slots = threading.BoundedSemaphore(concurrent + 1)
+        self.futures = []
+        self.bulkPrefix = "exportsuredoneepid-upload_{}".format(getRunSuffix())
+        self.startPart()
+
+    def startPart(self):
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, lineterminator=os.linesep)
+        self.writer.writerow(OUTPUT_COLUMNS)
+        self.rows = 0
+
+    def writeRow(self, guid, ebayepid):
+        self.writer.writerow(('edit', guid, ebayepid))
+        self.rows += 1
+        if self.rows >= self.partRows:
+            self.submitPart()
+
+    def submitPart(self):
+        data = self.buffer.getvalue().encode('utf-8')
+        rows = self.rows
+        bulkName = "{}_part{:03d}".format(self.bulkPrefix, len(self.futures) + 1)
+        self.startPart()
+
+        self.slots.acquire()
+        future = self.executor.submit(self.uploadPart, data, rows, bulkName)
+        future.add_done_callback(lambda done: self.slots.release())
+        self.futures.append(future)
+
+    def uploadPart(self, data, rows, bulkName):
+        """
+        Function that posts one part and returns its result, run in the thread pool.
+        """
+        partLogger = lambda message: self.logger('[{}] {}'.format(bulkName, message))
+        result = {'bulk_name': bulkName, 'rows': rows, 'bytes': len(data)}
+        try:
+            response = suredone_upload.post_bulk_file(self.args, self.client, partLogger, io.BytesIO(data), len(data), bulkName)
+            result['status'] = 'success'
+            result['result_file'] = response.get('result_file')
+            if self.poller is not None:
+                self.poller.track(response)
+        except Exception as e:
+            partLogger('An error occurred during uploading the part: {}'.format(e))
+            result['status'] = 'failed'
+            result['error'] = str(e)
+            result['file'] = bulkName + '.csv'
+            with open(result['file'], 'wb') as partFile:
+                partFile.write(data)
+        return result
+
+    def close(self):
+        if self.rows > 0:
+            self.submitPart()
+
+    def finish(self):
+        """
+        Function that waits for all bulk jobs (and their results with --fetch_results) and prints a summary.
+
+        Returns
+        -------
+            - uploaded : bool
+                Whether every part was uploaded (and none of their rows failed)
+        """
+        self.close()
+        results = [future.result() for future in self.futures]
+        self.executor.shutdown()
+
+        print ("\nUploaded {} of {} bulk jobs:".format(sum(result['status'] == 'success' for result in results), len(results)))
+        for result in results:
+            if result['status'] == 'success':
+                print ("\t{}\t{} GUIDs\tresult file: {}".format(result['bulk_name'], result['rows'], result['result_file']))
+            else:
+                print ("\t{}\t{} GUIDs\tfailed ({}), kept in {}".format(result['bulk_name'], result['rows'], result['error'], result['file']))
+        uploaded = all(result['status'] == 'success' for result in results)
+
+        if self.poller is not None:
+            jobs = self.poller.close_and_wait()
+            failedRows = sum(job.get('failed', 0) for job in jobs)
+            unknownRows = sum(job.get('unknown', 0) for job in jobs)
+            unfinished = sum(1 for job in jobs if job['status'] != 'done')
+            print ("Results of {} bulk jobs: {} rows failed, {} rows without a result, {} jobs without result".format(len(jobs), failedRows, unknownRows, unfinished))
+            uploaded = uploaded and not failedRows and not unknownRows and not unfinished
+        self.client.close()
+
+        if self.args.metrics_file:
+            suredone_upload.METRICS.setGauge('last_run_success', 1 if uploaded else 0)
+            suredone_upload.write_metrics(self.args.metrics_file)
+        return uploaded
+
+def writeOutput(rows, outputFilePath, resume=False, progress=None, uploader=None, liveValues=None, logFile=None):
+    """
+    Function that writes the rows of an engine to the output file, and the GUIDs and
+    iterations to the log file, as they come. Nothing is kept per GUID.
+
+    Parameters
+    ----------
+        - rows : iterable
+            (guid, ebayepid, iterations) of every GUID in the order of the output
+        - outputFilePath : str
+            A path to the output csv file, None to not write one
+        - resume : bool
+            Whether to keep the complete rows of an existing output file
+        - progress : ProgressReporter
+            Reporter of the combined rows and GUIDs, None to not report
+        - uploader : PartUploader
+            Uploader the rows are also sent to, None to not upload
+        - liveValues : dict
+            Live ebayepid of the GUIDs, rows that would not change it are skipped, see readLiveValues()
+        - logFile : LogFileWriter
+            Log file the written GUIDs and their iterations are sent to, None to not log
+
+    Returns
+    -------
+        - finalTime : long
+            Time taken by combining and writing
+    """
+    startTime = current_milli_time()
+    writers = [OutputWriter(outputFilePath, resume)] if outputFilePath else []
+    if uploader is not None:
+        writers.append(uploader)
+    skipped = 0
+    for guid, ebayepid, iterations in rows:
+        if progress is not None:
+            progress.update(iterations, 1)
+        if liveValues is not None and isLiveValue(liveValues, guid, ebayepid):
+            skipped += 1
+            continue
+        for writer in writers:
+            writer.writeRow(guid, ebayepid)
+        if logFile is not None:
+            logFile.writeGUID(guid, iterations)
+    for writer in writers:
+        writer.close()
+    if logFile is not None:
+        logFile.close()
+    if progress is not None:
+        progress.finish()
+    if liveValues is not None:
+        print ("Skipped {} GUIDs whose ebayepid is already live.".format(skipped))
+    return current_milli_time() - startTime
+
+def readLiveValues(exportPath, chunkRows=EXPORT_CHUNK_ROWS):
+    """
+    Function that builds the hash table of the live ebayepid of every guid from an export of
+    suredone_download.py. The export is read chunkRows rows at a time with only its guid and
+    ebayepid columns, and only a hash of each value is kept, so the table stays small however
+    long the values are. The output rows are looked up in it as they are written, see isLiveValue().
+
+    Parameters
+    ----------
+        - exportPath : str
+            A path to the export CSV, its delimiter is taken from its guid index if it has one
+        - chunkRows : int
+            Rows read at a time
+
+    Returns
+    -------
+        - liveValues : dict
+            hash() of the ebayepid of every guid, None for a guid that has different values in the export
+    """
+    liveValues = {}
+    try:
+        delimiter = ','
+        indexPath = suredone_lookup.getIndexPath(exportPath)
+        if path.exists(indexPath):
+            index = suredone_lookup.GuidIndex(indexPath)
+            delimiter = index.delimiter
+            index.close()
+        for chunk in pd.read_csv(exportPath, sep=delimiter, usecols=['guid', 'ebayepid'], dtype=str, keep_default_na=False, chunksize=chunkRows):
+            for guid, ebayepid in zip(chunk['guid'].tolist(), chunk['ebayepid'].tolist()):
+                valueHash = hash(ebayepid)
+                if liveValues.setdefault(guid, valueHash) != valueHash:
+                    liveValues[guid] = None
+    except (OSError, ValueError, pd.errors.ParserError) as e:
+        print ("Error: Could not read the ebayepid values of the export {}: {}".format(exportPath, e))
+        sys.exit(3)
+    return liveValues
+
+def isLiveValue(liveValues, guid, ebayepid):
+    """
+    Function that tells if a combined ebayepid is already the live value of its guid.
+    """
+    valueHash = liveValues.get(guid)
+    return valueHash is not None and valueHash == hash(ebayepid)
+
+def partitionFrame(csvfile, workers):
+    """
+    Function that splits the rows into shards by a hash of their guid, so all rows of a GUID
+    end up in the same shard. The rows of a shard keep their order in the input.
+
+    Parameters
+    ----------
+        - csvfile : pd.dataframe
+            The unsorted dataframe of the input CSV file
+        - workers : int
+            Number of shards
+
+    Returns
+    -------
+        - shards : list
+            One dataframe per shard
+    """
+    shardIds = pd.util.hash_pandas_object(csvfile['guid'], index=False).to_numpy() % workers
+    return [csvfile[shardIds == shard] for shard in range(workers)]
+
+def transformShard(shard, maxItersPerGUID, engine, presorted):
+    """
+    Function that sorts and combines one shard in a worker process. The engine's progress
+    output is dropped, the main process prints its own.
+
+    Returns
+    -------
+        - keys : list
+            Sort key of every GUID of the shard, see getSortKeys()
+        - rows : list
+            (guid, ebayepid, iterations) of every GUID of the shard in sorted order
+    """
+    with redirect_stdout(io.StringIO()):
+        # A shard keeps the input order of its rows, so shards of sorted input are sorted
+        if not presorted:
+            shard = sortRows(shard)
+        rows = list(getEngineRows(shard, maxItersPerGUID, engine, False))
+    keys = getSortKeys(shard['guid'].drop_duplicates())
+    return keys, rows
+
+def parallelLoop(csvfile, maxItersPerGUID, engine, workers, presorted, VERBOSE):
+    """
+    Generator that runs the transformation on hash partitioned shards in a process pool and
+    merges the shard outputs by guid, in the order the single process output has.
+
+    Parameters
+    ----------
+        - csvfile : pd.dataframe
+            The unsorted dataframe of the input CSV file
+        - maxItersPerGUID : int
+            Maximum number of iteration allowed per GUID
+        - engine : str
+            Engine used by the workers, one of ENGINES
+        - workers : int
+            Number of worker processes
+        - presorted : bool
+            Whether the input is known to be sorted
+        - VERBOSE : bool
+            Whether to print details or not
+
+    Yields
+    ------
+        - guid, ebayepid, iterations : tuple
+            Same as mainLoop()
+    """
+    print ("\nStarting main loop ({} workers)...".format(workers))
+
+    shards = partitionFrame(csvfile, workers)
+    progress = ProgressReporter('Sorted and combined in shards', csvfile.shape[0]) if VERBOSE else None
+    if progress is not None:
+        # Shards only report when they are done, so the clock starts with the pool
+        progress.update(0)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(transformShard, shard, maxItersPerGUID, engine, presorted): shard.shape[0] for shard in shards}
+        del shards
+        for future in as_completed(futures):
+            if progress is not None:
+                progress.update(futures[future], len(future.result()[1]))
+        results = [future.result() for future in futures]
+    if progress is not None:
+        progress.finish()
+
+    # Every GUID is in one shard only, so merging by the sort key restores the global order
+    for key, row in heapq.merge(*[zip(keys, rows) for keys, rows in results], key=lambda item: item[0]):
+        yield row
+    print ("Main loop Complete.")
+
+def getFingerprints(csvfile, maxItersPerGUID):
+    """
+    Function that computes a fingerprint of the rows of every GUID without sorting them.
+    The EPID and note of each row are hashed as they were read (a column that is read with
+    another type, e.g. float EPIDs, also changes the output), the hashes of a GUID are added
+    up, so the order of its rows does not matter, and hashed together with the number of
+    rows that are joined, which changes when maxItersPerGUID cuts the GUID differently.
+
+    Parameters
+    ----------
+        - csvfile : pd.dataframe
+            The dataframe of the input CSV file, sorted or not
+        - maxItersPerGUID : int
+            Maximum number of iteration allowed per GUID
+
+    Returns
+    -------
+        - fingerprints : pd.Series
+            uint64 fingerprint of every GUID, indexed by the GUID as it is written to the output
+        - codes : np.ndarray
+            Position of every row's GUID in fingerprints
+    """
+    codes = pd.factorize(csvfile.iloc[:, 0])[0]
+    # Rows without a guid are one GUID too
+    codes = np.where(codes < 0, codes.max(initial=-1) + 1, codes)
+    numGUIDs = codes.max(initial=-1) + 1
+    rowHashes = pd.util.hash_pandas_object(csvfile.iloc[:, 1:3], index=False).to_numpy()
+
+    # Sums wrap around in uint64
+    sums = np.zeros(numGUIDs, dtype=np.uint64)
+    np.add.at(sums, codes, rowHashes)
+    keptSizes = np.minimum(np.bincount(codes, minlength=numGUIDs), maxItersPerGUID)
+    fingerprints = pd.util.hash_pandas_object(pd.DataFrame({'rows': sums, 'kept': keptSizes}), index=False).to_numpy()
+
+    # The first row of every GUID is formatted like the engines format it
+    firstRows = np.unique(codes, return_index=True)[1]
+    guids = getRowStrings(csvfile.iloc[firstRows])[0]
+    return pd.Series(fingerprints, index=pd.Index(guids, name='guid'), name='fingerprint'), codes
+
+def readFingerprints(fingerprintPath):
+    """
+    Function that reads the fingerprints written by the previous run, see writeFingerprints().
+    A missing file is the first run, every GUID is then new.
+
+    Returns
+    -------
+        - fingerprints : pd.Series
+            uint64 fingerprint of every GUID, indexed by the GUID
+    """
+    if not path.exists(fingerprintPath):
+        return pd.Series([], index=pd.Index([], dtype=object, name='guid'), dtype=np.uint64, name='fingerprint')
+    try:
+        fingerprints = pd.read_csv(fingerprintPath, dtype={'guid': str, 'fingerprint': np.uint64}, keep_default_na=False)
+        return fingerprints.set_index('guid')['fingerprint']
+    except (ValueError, KeyError, pd.errors.ParserError) as e:
+        print ("Error: Could not read the fingerprint file {}: {}".format(fingerprintPath, e))
+        sys.exit(3)
+
+def writeFingerprints(fingerprints, fingerprintPath):
+    """
+    Function that replaces the fingerprint file with the fingerprints of this run. The file
+    is written next to it first, so a run that dies keeps the previous fingerprints.
+    """
+    tempPath = fingerprintPath + '.tmp'
+    try:
+        fingerprints.to_csv(tempPath, header=True)
+        os.replace(tempPath, fingerprintPath)
+    except OSError as e:
+        print ("Error: Could not write the fingerprint file {}: {}".format(fingerprintPath, e))
+        sys.exit(4)
+
+def selectChangedRows(csvfile, maxItersPerGUID, fingerprintPath, VERBOSE=False):
+    """
+    Function that keeps only the rows of the GUIDs that are new or whose rows changed since
+    the run that wrote the fingerprint file. The rows keep their order, so sorted rows stay sorted.
+
+    Parameters
+    ----------
+        - csvfile : pd.dataframe
+            The dataframe of the input CSV file
+        - maxItersPerGUID : int
+            Maximum number of iteration allowed per GUID
+        - fingerprintPath : str
+            A path to the fingerprint file of the previous run
+        - VERBOSE : bool
+            Whether to print how many GUIDs changed
+
+    Returns
+    -------
+        - csv : pd.dataframe
+            The rows of the changed GUIDs
+        - fingerprints : pd.Series
+            Fingerprints of all GUIDs of the input, to write once the output is done
+    """
+    fingerprints, codes = getFingerprints(csvfile, maxItersPerGUID)
+    previous = readFingerprints(fingerprintPath)
+
+    positions = previous.index.get_indexer(fingerprints.index)
+    known = positions >= 0
+    unchanged = np.zeros(len(fingerprints), dtype=bool)
+    unchanged[known] = previous.to_numpy()[positions[known]] == fingerprints.to_numpy()[known]
+    changedRows = ~unchanged[codes]
+    print ("{} of {} GUIDs changed since the last run.".format(len(fingerprints) - unchanged.sum(), len(fingerprints)))
+    if VERBOSE: print ("Combining {} of {} rows.".format(changedRows.sum(), csvfile.shape[0]))
+    return csvfile[changedRows], fingerprints
+
+def getRunSuffix():
+    """
+    Function that returns the time suffix of this run's log and report files. The suffix
+    is fixed the first time it is asked for, so every file of the run carries the same one.
+
+    Returns
+    -------
+        - suffix : str
+            Time suffix formatted as yyyy_mm_dd-hh-mm-sec
+    """
+    global RUN_SUFFIX
+    if RUN_SUFFIX is None:
+        tempdate = datetime.now()
+        RUN_SUFFIX = "{}_{}_{}-{}-{}-{}".format(tempdate.year, tempdate.month, tempdate.day, tempdate.hour, tempdate.minute, tempdate.second)
+    return RUN_SUFFIX
+
+def getLogFilePath():
+    """
+    Function that returns the path of the log file of this run in the current directory.
+    """
+    return "exportsuredoneepid-log_{}.csv.log".format(getRunSuffix())
+
+class LogFileWriter(object):
+    """
+    Writer of the log file of GUIDs and their iterations, based on the max iterations
+    allowed and the logLevel defined by user. The GUIDs are written as they come, so the
+    log file does not keep anything in memory; with logLevel 0 no file is created.
+    """
+    def __init__(self, maxIters, logLevel):
+        """
+        Constructor function.
+
+        Parameters
+        ----------
+            - maxIters      : int
+                The max number of iterations that were allowed per GUID
+            - logLevel      : int
+                The level of information that needs to be displayed.
+        """
+        self.maxIters = maxIters
+        self.logLevel = logLevel
+        self.logFile = None
+        if logLevel == 0:
+            return
+
+        self.logFile = open(getLogFilePath(), 'w')
+        self.logFile.write("\tGUIDS\t\t|\tIterations\n")
+        self.logFile.write("========================|========================\n")
+
+    def writeGUID(self, guid, iterations):
+        # Level 1 only logs the GUIDs that reached the max iterations, level 2 logs all of them
+        if self.logFile is not None and (self.logLevel == 2 or iterations >= self.maxIters):
+            self.logFile.write("\t{}\t|\t{}\n".format(guid, iterations))
+
+    def close(self):
+        if self.logFile is not None:
+            self.logFile.close()
+            self.logFile = None
+
+def printMemoryStats(profiler):
+    """
+    Function that appends the memory of every stage of the run and the top MEMSTATS_SITES
+    allocation sites at the end of every stage to the log file, which is created if the
+    log level did not write one.
+
+    Parameters
+    ----------
+        - profiler : Profiler
+            The profiler that traced the stages, started with or without cProfile
+    """
+    with open(getLogFilePath(), 'a') as logFile:
+        logFile.write("\nMemory per stage (Start, End and Peak traced by tracemalloc, RSS of this process)\n")
+        logFile.write("================================================================\n")
+        logFile.write(profiler.formatMemory())
 
 # Running script from command line
 if __name__ == "__main__":
@@ -0,0 +1,466 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Reference Benchmark
+
+@owner: Patrick Mahoney
+@version: 1.0.0
+
+This module generates synthetic inputs for reference.py and times its stages on them,
+to catch performance regressions and to compare the engines.
+
+The generated CSV has the columns of the SQL export (guid, Fitment EPID, note):
+    - guids are SKU00000001, SKU00000002, ... in random row order (or sorted with --sorted)
+    - the rows per guid follow a log-normal distribution (--skew is its sigma, 0 for equal groups)
+    - --big_groups guids get one and a half times --max_iterations rows
+    - --note_density of the rows have a note, the others an empty note
+
+Every benchmark case (input size and engine) runs in a new process and records the wall
+time of the stages of reference.main():
+    - read_sort   : readAndSortCSV()
+    - main_loop   : the engine (mainLoop() or groupbyLoop()) writing the output file and the
+                    log file with log level 2, in one pass like reference.main() does
+The peak RSS of the case is recorded as well, except on Windows where it is not available.
+Unless --skip_memory is given the case is run a second time with tracemalloc to record the peak
+traced memory of every stage (tracing slows the code down, so it is not done in the timed run).
+Before Python 3.9 the peak can't be reset between stages, the main_loop peak then also covers
+read_sort.
+
+The results are written to a JSON baseline. With --baseline the results are compared to an
+earlier baseline and every stage that got slower or bigger than --tolerance is reported, unless
+it changed by less than --min_seconds or --min_mb: timings of a few milliseconds are mostly noise.
+
+Usage:
+    $ python reference_benchmark.py [options]
+    $ python reference_benchmark.py -g [output.csv] [generator options]
+
+Parameters/Options:
+    -h                      : usage help and examples
+    -g  | --generate        : only generate an input file at this path
+    -r  | --rows            : rows of the generated input file (default 1000000)
+    -n  | --sizes           : comma separated input sizes to benchmark (default 100000,1000000,10000000)
+    -e  | --engines         : comma separated engines to benchmark (default groupby,loop)
+          --loop_max_rows   : largest input the slow loop engine is run on (default 1000000)
+    -u  | --guids           : number of guids, default a fifth of the rows
+          --skew            : sigma of the log-normal group sizes (default 1.0)
+          --big_groups      : guids with more rows than --max_iterations (default 10)
+    -i  | --max_iterations  : max iterations per GUID passed to the engines (default 1000)
+          --note_density    : share of the rows with a note (default 0.3)
+          --sorted          : generate the input sorted by guid and EPID
+          --seed            : seed of the random generator (default 0)
+    -d  | --work_dir        : directory of the generated inputs and outputs (default: a temporary directory)
+    -o  | --output          : path of the JSON baseline (default reference_benchmark_<time>.json)
+    -b  | --baseline        : earlier JSON baseline to compare the results to
+    -t  | --tolerance       : allowed slow down or growth before a stage is a regression (default 0.2)
+          --min_seconds     : smallest slow down in seconds that counts as a regression (default 0.05)
+          --min_mb          : smallest growth in MB that counts as a regression (default 1.0)
+          --skip_memory     : don't run the cases a second time with tracemalloc
+
+Example:
+    $ python reference_benchmark.py -g input.csv -r 1000000 --skew 1.5 --note_density 0.5
+
+    $ python reference_benchmark.py -n 100000,1000000 -o baseline.json
+    $ python reference_benchmark.py --sizes 100000,1000000 --baseline baseline.json --tolerance 0.3
+
+Exit Statusses:
+    - 1 -- Regressions against the baseline were found
+    - 2 -- Reading arguments
+    - 5 -- -h argument used
+"""
+
+import sys, getopt
+import os
+import json
+import time
+import shutil
+import hashlib
+import platform
+import tempfile
+import tracemalloc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+import reference
+from suredone_profiler import getPeakRss, resetPeak
+
+# Help message
+HELP_MESSAGE = __doc__[__doc__.index('Usage:'):]
+
+# Stages of a benchmark case in the order they run
+STAGES = ('read_sort', 'main_loop')
+
+# Rows written to the generated CSV at a time
+GENERATE_CHUNK_ROWS = 1000000
+
+# Notes of the generated rows
+NOTES = ('Position: Front', 'Position: Rear', 'Position: Front Left', 'Position: Front Right',
+         'Engine: 2.0L', 'Engine: 3.5L V6', 'Drive Type: AWD', 'Submodel: Base', 'Submodel: Sport')
+
+def main(argv):
+    settings = parseArgs(argv)
+
+    if settings['generate']:
+        generateInput(settings['generate'], settings['rows'], settings)
+        print ("Input written to: {}".format(settings['generate']))
+        return 0
+
+    workDirectory = os.path.abspath(settings['workDir'] or tempfile.mkdtemp(prefix='exportsuredoneepid-benchmark_'))
+    try:
+        results = []
+        for rows in settings['sizes']:
+            inputPath = getInputPath(workDirectory, rows, settings)
+            if not os.path.exists(inputPath):
+                print ("\nGenerating {:,} rows...".format(rows))
+                generateInput(inputPath, rows, settings)
+            for engine in settings['engines']:
+                if engine == 'loop' and rows > settings['loopMaxRows']:
+                    print ("Skipping the loop engine on {:,} rows (--loop_max_rows)".format(rows))
+                    continue
+                print ("\nBenchmarking the {} engine on {:,} rows...".format(engine, rows))
+                result = runCase(inputPath, engine, settings['maxIters'], workDirectory, traceMemory=False)
+                if not settings['skipMemory']:
+                    memory = runCase(inputPath, engine, settings['maxIters'], workDirectory, traceMemory=True)
+                    for stage in STAGES:
+                        result['stages'][stage]['peakTracedMB'] = memory['stages'][stage]['peakTracedMB']
+                result.update({'rows': rows, 'engine': engine})
+                printResult(result)
+                results.append(result)
+    finally:
+        if not settings['workDir']:
+            shutil.rmtree(workDirectory, ignore_errors=True)
+
+    checkOutputs(results)
+    baseline = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'machine': '{} {} ({} CPUs)'.format(platform.system(), platform.machine(), os.cpu_count()),
+        'settings': {key: settings[key] for key in ('guids', 'skew', 'bigGroups', 'maxIters', 'noteDensity', 'sorted', 'seed')},
+        'results': results
+    }
+    with open(settings['output'], 'w') as outputFile:
+        json.dump(baseline, outputFile, indent=2)
+    print ("\nBaseline written to: {}".format(settings['output']))
+
+    if settings['baseline']:
+        with open(settings['baseline']) as baselineFile:
+            regressions = compareResults(json.load(baselineFile), baseline, settings['tolerance'],
+                                         settings['minSeconds'], settings['minMB'])
+        return 1 if regressions else 0
+    return 0
+
+def parseArgs(argv):
+    """
+    Function that parses the arguments sent from the command line.
+
+    Parameters
+    ----------
+        - argv : list
+            Arguments sent through the command line
+
+    Returns
+    -------
+        - settings : dict
+            The generator and benchmark settings, see HELP_MESSAGE
+    """
+    options = "hg:r:n:e:u:i:d:o:b:t:"
+    long_options = ["generate=", "rows=", "sizes=", "engines=", "loop_max_rows=", "guids=", "skew=", "big_groups=",
+                    "max_iterations=", "note_density=", "sorted", "seed=", "work_dir=", "output=", "baseline=",
+                    "tolerance=", "min_seconds=", "min_mb=", "skip_memory"]
+    settings = {
+        'generate': '',
+        'rows': 1000000,
+        'sizes': [100000, 1000000, 10000000],
+        'engines': list(reference.ENGINES),
+        'loopMaxRows': 1000000,
+        'guids': None,
+        'skew': 1.0,
+        'bigGroups': 10,
+        'maxIters': 1000,
+        'noteDensity': 0.3,
+        'sorted': False,
+        'seed': 0,
+        'workDir': '',
+        'output': 'reference_benchmark_{}.json'.format(reference.getRunSuffix()),
+        'baseline': '',
+        'tolerance': 0.2,
+        'minSeconds': 0.05,
+        'minMB': 1.0,
+        'skipMemory': False
+    }
+
+    try:
+        opts, args = getopt.getopt(argv, options, long_options)
+        for option, value in opts:
+            if option == '-h':
+                print (HELP_MESSAGE)
+                sys.exit(5)
+            elif option in ("-g", "--generate"):
+                settings['generate'] = value
+            elif option in ("-r", "--rows"):
+                settings['rows'] = int(value)
+            elif option in ("-n", "--sizes"):
+                settings['sizes'] = [int(size) for size in value.split(',')]
+            elif option in ("-e", "--engines"):
+                settings['engines'] = [engine.strip().lower() for engine in value.split(',')]
+            elif option == "--loop_max_rows":
+                settings['loopMaxRows'] = int(value)
+            elif option in ("-u", "--guids"):
+                settings['guids'] = int(value)
+            elif option == "--skew":
+                settings['skew'] = float(value)
+            elif option == "--big_groups":
+                settings['bigGroups'] = int(value)
+            elif option in ("-i", "--max_iterations"):
+                settings['maxIters'] = int(value)
+            elif option == "--note_density":
+                settings['noteDensity'] = float(value)
+            elif option == "--sorted":
+                settings['sorted'] = True
+            elif option == "--seed":
+                settings['seed'] = int(value)
+            elif option in ("-d", "--work_dir"):
+                settings['workDir'] = value
+            elif option in ("-o", "--output"):
+                settings['output'] = value
+            elif option in ("-b", "--baseline"):
+                settings['baseline'] = value
+            elif option in ("-t", "--tolerance"):
+                settings['tolerance'] = float(value)
+            elif option == "--min_seconds":
+                settings['minSeconds'] = float(value)
+            elif option == "--min_mb":
+                settings['minMB'] = float(value)
+            elif option == "--skip_memory":
+                settings['skipMemory'] = True
+    except (getopt.GetoptError, ValueError) as error:
+        print ("Error in arguments: {}".format(error))
+        print (HELP_MESSAGE)
+        sys.exit(2)
+
+    unknown = [engine for engine in settings['engines'] if engine not in reference.ENGINES]
+    if unknown:
+        print ("Error: Unknown engine '{}'. Available engines are: {}.".format(unknown[0], ', '.join(reference.ENGINES)))
+        sys.exit(2)
+    if settings['maxIters'] < 1 or not 0 <= settings['noteDensity'] <= 1:
+        print ("Error: --max_iterations must be positive and --note_density between 0 and 1.")
+        sys.exit(2)
+    if settings['workDir'] and not os.path.isdir(settings['workDir']):
+        os.makedirs(settings['workDir'])
+    return settings
+
+def getGroupSizes(rows, guids, skew, bigGroups, maxIters, rng):
+    """
+    Function that draws the number of rows of every guid. The big groups get one and a half
+    times maxIters rows, the other guids share the remaining rows with log-normal weights and
+    at least one row each.
+
+    Returns
+    -------
+        - sizes : np.ndarray
+            Rows of every guid, in random guid order
+    """
+    bigSize = maxIters + maxIters // 2
+    bigGroups = min(bigGroups, max(rows - guids, 0) // bigSize, guids - 1)
+    smallGuids = guids - bigGroups
+    spare = rows - bigGroups * bigSize - smallGuids
+    weights = rng.lognormal(0, skew, smallGuids) if skew > 0 else np.ones(smallGuids)
+    sizes = np.concatenate((np.full(bigGroups, bigSize), 1 + rng.multinomial(spare, weights / weights.sum())))
+    rng.shuffle(sizes)
+    return sizes
+
+def generateInput(outputPath, rows, settings):
+    """
+    Function that writes a synthetic input CSV for reference.py.
+
+    Parameters
+    ----------
+        - outputPath : str
+            Path of the CSV file
+        - rows : int
+            Number of rows
+        - settings : dict
+            guids, skew, bigGroups, maxIters, noteDensity, sorted and seed, see parseArgs()
+    """
+    rng = np.random.default_rng(settings['seed'])
+    guids = min(settings['guids'] or max(rows // 5, 1), rows)
+    sizes = getGroupSizes(rows, guids, settings['skew'], settings['bigGroups'], settings['maxIters'], rng)
+
+    guidIds = np.repeat(np.arange(1, guids + 1, dtype=np.int32), sizes)
+    epids = rng.integers(100000000, 400000000, rows)
+    notes = np.where(rng.random(rows) < settings['noteDensity'], rng.integers(0, len(NOTES), rows), -1).astype(np.int8)
+    if settings['sorted']:
+        order = np.lexsort((epids, guidIds))
+    else:
+        order = rng.permutation(rows)
+
+    noteStrings = np.array(('',) + NOTES, dtype=object)
+    with open(outputPath, 'w', newline='') as outputFile:
+        outputFile.write('guid,Fitment EPID,note\n')
+        for start in range(0, rows, GENERATE_CHUNK_ROWS):
+            positions = order[start:start + GENERATE_CHUNK_ROWS]
+            chunk = pd.DataFrame({
+                'guid': np.char.add('SKU', np.char.zfill(guidIds[positions].astype(str), 8)),
+                'Fitment EPID': epids[positions],
+                'note': noteStrings[notes[positions] + 1]
+            })
+            chunk.to_csv(outputFile, header=False, index=False, lineterminator='\n')
+
+def getInputPath(workDirectory, rows, settings):
+    """
+    Function that returns the path of a generated input, its name holds the generator settings
+    so inputs in a --work_dir are reused by later runs with the same settings.
+    """
+    name = 'benchmark_{}_{}_{}_{}_{}_{}_{}{}.csv'.format(rows, settings['guids'] or 'auto', settings['skew'], settings['bigGroups'],
+                                                        settings['maxIters'], settings['noteDensity'], settings['seed'],
+                                                        '_sorted' if settings['sorted'] else '')
+    return os.path.join(workDirectory, name)
+
+def runCase(inputPath, engine, maxIters, workDirectory, traceMemory):
+    """
+    Function that runs one benchmark case in a new process, so every case starts with
+    the same memory and the peak RSS belongs to the case alone.
+    """
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(timeStages, inputPath, engine, maxIters, workDirectory, traceMemory).result()
+
+def timeStages(inputPath, engine, maxIters, workDirectory, traceMemory):
+    """
+    Function that runs the stages of reference.main() on an input and measures them.
+
+    Parameters
+    ----------
+        - inputPath : str
+            Path of the input CSV
+        - engine : str
+            Engine that combines the rows, one of reference.ENGINES
+        - maxIters : int
+            Max iterations per GUID
+        - workDirectory : str
+            Directory of the output and log files
+        - traceMemory : bool
+            Whether to record the peak traced memory of the stages instead of their time
+
+    Returns
+    -------
+        - result : dict
+            'stages' with the seconds (or peakTracedMB) of every stage, 'peakRssMB',
+            'guids' and the 'outputHash' of the output file
+    """
+    os.chdir(workDirectory)
+    outputPath = 'benchmark_output_{}_{}.csv'.format(engine, os.getpid())
+    stages = {}
+    if traceMemory:
+        tracemalloc.start()
+
+    def measure(stage, function, *args, **kwargs):
+        if traceMemory:
+            resetPeak()
+            startMemory = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        value = function(*args, **kwargs)
+        stages[stage] = {'seconds': round(time.perf_counter() - start, 3)}
+        if traceMemory:
+            stages[stage] = {'peakTracedMB': round((tracemalloc.get_traced_memory()[1] - startMemory) / 10**6, 2)}
+        return value
+
+    with open(os.devnull, 'w') as devnull:
+        originalstdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            csvfile = measure('read_sort', reference.readAndSortCSV, inputPath)
+            rows = reference.getEngineRows(csvfile, maxIters, engine, False)
+            measure('main_loop', reference.writeOutput, rows, outputPath, logFile=reference.LogFileWriter(maxIters, 2))
+            del csvfile, rows
+        finally:
+            sys.stdout = originalstdout
+    if traceMemory:
+        tracemalloc.stop()
+
+    outputHash = hashlib.sha1()
+    with open(outputPath, 'rb') as outputFile:
+        for block in iter(lambda: outputFile.read(1 << 20), b''):
+            outputHash.update(block)
+    os.remove(outputPath)
+    # the log file has a line per GUID after its two header lines
+    with open(reference.getLogFilePath()) as logFile:
+        guids = sum(1 for line in logFile) - 2
+    os.remove(reference.getLogFilePath())
+
+    peakRss = getPeakRss()
+    return {'stages': stages, 'peakRssMB': round(peakRss / 10**6, 2) if peakRss is not None else None, 'guids': guids, 'outputHash': outputHash.hexdigest()}
+
+def printResult(result):
+    for stage in STAGES:
+        values = result['stages'][stage]
+        memory = ', peak traced {}MB'.format(values['peakTracedMB']) if 'peakTracedMB' in values else ''
+        print ("    {:<10}: {:>9.3f}s{}".format(stage, values['seconds'], memory))
+    peakRss = '{}MB'.format(result['peakRssMB']) if result['peakRssMB'] is not None else '-'
+    print ("    Peak RSS  : {}, {:,} GUIDs".format(peakRss, result['guids']))
+
+def checkOutputs(results):
+    """
+    Function that warns when the engines wrote different output files for the same input.
+    """
+    hashes = {}
+    for result in results:
+        hashes.setdefault(result['rows'], {})[result['engine']] = result['outputHash']
+    for rows, engineHashes in sorted(hashes.items()):
+        if len(set(engineHashes.values())) > 1:
+            print ("Warning: The engines wrote different outputs for {:,} rows: {}".format(rows, engineHashes))
+
+def compareResults(baseline, current, tolerance, minSeconds=0.05, minMB=1.0):
+    """
+    Function that compares the results of this run to an earlier baseline and prints the changes.
+
+    Parameters
+    ----------
+        - baseline : dict
+            The earlier baseline
+        - current : dict
+            The baseline of this run
+        - tolerance : float
+            Allowed relative growth of a stage's seconds or memory
+        - minSeconds : float
+            Smallest growth in seconds that is a regression, below it the change is noise
+        - minMB : float
+            Smallest growth in MB that is a regression
+
+    Returns
+    -------
+        - regressions : list
+            (rows, engine, stage, metric, old, new) of every value over the tolerance
+    """
+    earlier = {(result['rows'], result['engine']): result for result in baseline['results']}
+    regressions = []
+    print ("\nCompared to the baseline of {} (pandas {}):".format(baseline['created'], baseline['pandas']))
+    for result in current['results']:
+        old = earlier.get((result['rows'], result['engine']))
+        if old is None:
+            continue
+        values = [(stage, metric, old['stages'][stage].get(metric), result['stages'][stage].get(metric))
+                  for stage in STAGES for metric in ('seconds', 'peakTracedMB')]
+        values.append(('case', 'peakRssMB', old['peakRssMB'], result['peakRssMB']))
+        for stage, metric, oldValue, newValue in values:
+            if not oldValue or newValue is None:
+                continue
+            change = newValue / oldValue - 1
+            minDelta = minSeconds if metric == 'seconds' else minMB
+            regression = change > tolerance and newValue - oldValue >= minDelta
+            if regression:
+                regressions.append((result['rows'], result['engine'], stage, metric, oldValue, newValue))
+            print ("    {:>10,} {:<8} {:<10} {:<13}: {:>10} -> {:<10} ({:+.0%}){}".format(result['rows'], result['engine'], stage, metric,
+                                                                                    oldValue, newValue, change, '  REGRESSION' if regression else ''))
+        if old['outputHash'] != result['outputHash']:
+            print ("Warning: The output of the {} engine on {:,} rows changed.".format(result['engine'], result['rows']))
+    print ("{} regression(s) over {:.0%}".format(len(regressions), tolerance))
+    return regressions
+
+# Running script from command line
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
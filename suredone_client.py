@@ -0,0 +1,431 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Suredone Client
+
+@owner: Patrick Mahoney
+@version: 1.0.0
+
+This module holds the SureDone API client shared by suredone_download.py and
+suredone_upload.py, so both scripts talk to the API the same way:
+    - one requests.Session per run with a connection pool sized for its workers
+    - an optional client side rate limit (requests per second) shared by all threads
+    - HTTP 429 responses pause every thread until X-Rate-Limit-Time-Reset-Ms has passed
+    - connect/read timeouts on every request, shortened to a Deadline if one is given
+    - retries of failed calls, counted in the metrics registry of the calling script
+    - log messages go through a hook with the signature of Logger.writeLog(message, lineNumber, severity)
+
+It also reads the credentials file of both scripts (loadConfig).
+
+Usage:
+    user, apiToken = loadConfig('~/suredone.yaml')
+    sureDone = SureDone(user, apiToken, 15, metrics=METRICS, logger=LOGGER.writeLog)
+    response = sureDone.apicall('get', 'bulk/exports', {'type': 'items'})
+"""
+
+import json
+import time
+import inspect
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from suredone_metrics import getEndpointLabel
+
+# yaml is optional, without it the credentials file is read as simple 'key: value' lines
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+API_ENDPOINT = 'https://api.suredone.com/v1/'
+
+# Seconds to wait after a 429 response that doesn't say when the limit resets
+RATE_LIMIT_WAIT = 40
+
+class LoadingError(Exception):
+    pass
+
+class UnauthorizedError(Exception):
+    pass
+
+class DeadlineExceeded(Exception):
+    pass
+
+class ConfigError(Exception):
+    pass
+
+def loadConfig(configPath):
+    """
+    Function that parses the configuration file and reads the user and token variables.
+
+    Parameters
+    ----------
+        - configPath : str
+            Path to the configuration file
+
+    Returns
+    -------
+        - user : str
+            Username from the configuration file
+        - apiToken : str
+            Api authentication token from the configuration file
+    """
+    with open(configPath, 'r') as stream:
+        if yaml is not None:
+            try:
+                config = yaml.safe_load(stream)
+            except yaml.YAMLError as exc:
+                raise ConfigError('Error while loading YAML: {}'.format(exc))
+        else:
+            config = {}
+            for line in stream:
+                if line.startswith('#') or ':' not in line:
+                    continue
+                key, value = line.split(':', 1)
+                config[key.strip()] = value.strip()
+
+    # Both values are read as strings, a numeric user name is still a user name
+    try:
+        return str(config['user']), str(config['token'])
+    except (KeyError, TypeError):
+        raise ConfigError('Not found user or token in config file.')
+
+class Deadline(object):
+    """ A point in time after which a phase (or the whole run) has to give up. """
+    def __init__(self, seconds, name, parent=None):
+        """
+        Constructor function.
+
+        Parameters
+        ----------
+            - seconds : float
+                Seconds from now until the deadline, None or 0 for no limit of its own
+            - name : str
+                Name of the phase, used in error messages
+            - parent : Deadline object
+                Enclosing deadline (e.g. the run deadline) that also bounds this one
+        """
+        self.name = name
+        self.parent = parent
+        self.expiresAt = time.time() + seconds if seconds else None
+
+    def remaining(self):
+        """
+        Function that returns the seconds left until this or any enclosing deadline, None if unlimited.
+        """
+        remaining = self.expiresAt - time.time() if self.expiresAt is not None else None
+        if self.parent is not None:
+            parentRemaining = self.parent.remaining()
+            if parentRemaining is not None and (remaining is None or parentRemaining < remaining):
+                return parentRemaining
+        return remaining
+
+    def check(self):
+        """ Function that raises DeadlineExceeded if the deadline has passed. """
+        remaining = self.remaining()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded("Time budget of '{}' exceeded.".format(self.name))
+
+    def clamp(self, timeout):
+        """
+        Function that shortens a timeout so it doesn't reach past the deadline.
+
+        Parameters
+        ----------
+            - timeout : float
+                Timeout in seconds
+        """
+        self.check()
+        remaining = self.remaining()
+        return timeout if remaining is None else min(timeout, remaining)
+
+    def sleep(self, seconds):
+        """
+        Function that sleeps between retries, failing right away if the deadline would pass while sleeping.
+
+        Parameters
+        ----------
+            - seconds : float
+                Seconds to sleep
+        """
+        remaining = self.remaining()
+        if remaining is not None and remaining < seconds:
+            raise DeadlineExceeded("Time budget of '{}' exceeded, {:.0f} seconds left but a retry needs a {} seconds wait.".format(self.name, max(remaining, 0), seconds))
+        time.sleep(seconds)
+
+class RateLimiter(object):
+    """ Spaces out the requests of all threads and holds them while the API rate limit is exhausted. """
+    def __init__(self, requestsPerSecond=None):
+        """
+        Constructor function.
+
+        Parameters
+        ----------
+            - requestsPerSecond : float
+                Highest request rate, None or 0 for no client side limit
+        """
+        self.interval = 1.0 / requestsPerSecond if requestsPerSecond else 0
+        self.lock = threading.Lock()
+        self.nextSlot = 0
+        self.pausedUntil = 0
+
+    def wait(self, deadline):
+        """
+        Function that blocks until the calling thread may send its next request.
+
+        Parameters
+        ----------
+            - deadline : Deadline object
+                Time limit of the waiting call
+        """
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.nextSlot, self.pausedUntil)
+            self.nextSlot = slot + self.interval
+        if slot > now:
+            deadline.sleep(slot - now)
+
+    def pause(self, seconds):
+        """
+        Function that holds every thread for the given seconds (after a 429 response).
+
+        Parameters
+        ----------
+            - seconds : float
+                Seconds until the rate limit resets
+        """
+        with self.lock:
+            self.pausedUntil = max(self.pausedUntil, time.time() + seconds)
+
+def getRateLimitWait(response):
+    """
+    Function that reads the wait in seconds from the X-Rate-Limit-Time-Reset-Ms header of a 429 response.
+    """
+    try:
+        return max(float(response.headers['X-Rate-Limit-Time-Reset-Ms']) / 1000.0, 1)
+    except (KeyError, ValueError):
+        return RATE_LIMIT_WAIT
+
+class SureDone(object):
+    """ A driver class to manage connection and make requests to the Suredone API """
+    def __init__(self, user, api_token, timeout, integration='partnername', rateLimit=None, poolSize=10, maxErrors=3, metrics=None, logger=None):
+        """
+        Constructor function. Basically creates a header template and a pooled session for api calls.
+
+        Parameters
+        ----------
+            - user : str
+                User name for API
+            - api_token : str
+                Auth token provided by the API
+            - timeout : float
+                Connect and read timeout of the requests in seconds
+            - integration : str
+                Name that identifies the application to the API
+            - rateLimit : float
+                Highest request rate in requests per second, None for no client side limit
+            - poolSize : int
+                Number of connections kept open, at least the number of threads using the client
+            - maxErrors : int
+                Number of errors after which a call gives up
+            - metrics : MetricsRegistry object
+                Registry of the calling script, None to not record metrics
+            - logger : function
+                Called with (message, lineNumber, severity=...) like Logger.writeLog, None to not log
+        """
+        self.timeout = timeout
+        self.api_endpoint = API_ENDPOINT
+        self.maxErrors = maxErrors
+        self.metrics = metrics
+        self.logger = logger
+        self.rateLimiter = RateLimiter(rateLimit)
+
+        self.headers = {}
+        self.headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        self.headers['x-auth-integration'] = integration
+        self.headers['x-auth-user'] = user
+        self.headers['x-auth-token'] = api_token
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, poolSize))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def log(self, message, severity='normal'):
+        if self.logger is not None:
+            self.logger(message, inspect.currentframe().f_back.f_lineno, severity=severity)
+
+    def incCounter(self, name, value=1, labels=None):
+        if self.metrics is not None:
+            self.metrics.incCounter(name, value, labels=labels)
+
+    def observe(self, name, value, labels=None):
+        if self.metrics is not None:
+            self.metrics.observe(name, value, labels=labels)
+
+    def request(self, typ, url, deadline=None, timeout=None, **kwargs):
+        """
+        Function that sends a single request through the pooled session, after the rate limiter
+        let it through, and records its duration and status. Nothing is retried here. The auth
+        headers are only sent to URLs under the API endpoint, never to external hosts.
+
+        Parameters
+        ----------
+            - typ : str
+                HTTP method (get, put, post, delete)
+            - url : str
+                Full URL or endpoint relative to the API root
+            - deadline : Deadline object
+                Time limit of the request, the timeout is shortened to it
+            - timeout : float or tuple
+                Timeout of this request, the client's timeout if None
+            - kwargs
+                Passed on to requests (params, data, headers, stream, ...)
+
+        Returns
+        -------
+            - resp : requests.Response
+                The response, also for error statuses
+        """
+        if not url.startswith('http'):
+            url = self.api_endpoint + url
+        endpointLabel = getEndpointLabel(url[len(self.api_endpoint):] if url.startswith(self.api_endpoint) else 'external')
+        if deadline is None:
+            deadline = Deadline(None, endpointLabel)
+        timeout = self.timeout if timeout is None else timeout
+        if isinstance(timeout, tuple):
+            timeout = tuple(deadline.clamp(value) for value in timeout)
+        else:
+            timeout = deadline.clamp(timeout)
+
+        headers = dict(self.headers) if url.startswith(self.api_endpoint) else {}
+        headers.update(kwargs.pop('headers', None) or {})
+
+        self.rateLimiter.wait(deadline)
+        requestStart = time.time()
+        try:
+            resp = self.session.request(typ.upper(), url, headers=headers, timeout=timeout, **kwargs)
+        except requests.exceptions.RequestException:
+            self.incCounter('api_calls_total', labels={'endpoint': endpointLabel, 'status': 'error'})
+            raise
+        self.observe('api_call_duration_seconds', time.time() - requestStart, labels={'endpoint': endpointLabel})
+        self.incCounter('api_calls_total', labels={'endpoint': endpointLabel, 'status': str(resp.status_code)})
+        if not kwargs.get('stream'):
+            self.incCounter('bytes_downloaded_total', len(resp.content))
+
+        if resp.status_code == 429:
+            wait = getRateLimitWait(resp)
+            self.rateLimiter.pause(wait)
+            self.incCounter('rate_limit_sleep_seconds_total', wait)
+        return resp
+
+    def apicall(self, typ, endpoint, data=None, deadline=None):
+        """
+        Function that will concatenate the intended endpoint with the main URL that
+        goes to the Suredone API and initiate the request with the provided data.
+
+        Parameters
+        ----------
+            - typ : str
+                Defines the type of request. (REST functionality)
+                Available types:
+                    - get
+                    - put
+                    - post
+                    - delete
+            - endpoint : str
+                Specific module of the API that needs to be called.
+            - data : dict
+                The data that is meant to be sent in the API request in key-value dict format.
+            - deadline : Deadline object
+                Time limit of the call including all of its retries. Request timeouts and
+                retry waits are shortened to it and DeadlineExceeded is raised once it passes.
+
+        Returns
+        -------
+            - r : str
+                The JSON formatted response data after the request was made
+        """
+        # Build url string by concatenating the main url with the sub module
+        url = self.api_endpoint + endpoint
+        endpointLabel = getEndpointLabel(endpoint)
+        errorCount = 0
+        attempts = 0
+        if deadline is None:
+            deadline = Deadline(None, endpoint)
+
+        if typ == 'get':
+            kwargs = {'params': data}
+        else:
+            kwargs = {'data': json.dumps(data)}
+
+        # Main loop
+        while True:
+            # 3 or more errors break the loop
+            if errorCount >= self.maxErrors:
+                break
+            if attempts > 0:
+                self.incCounter('api_retries_total', labels={'endpoint': endpointLabel})
+            attempts += 1
+            try:
+                resp = self.request(typ, url, deadline=deadline, **kwargs)
+            except requests.exceptions.RequestException as e:
+                # Error handling. Increment error counter and sleep for
+                # 15 seconds and try again if error was ocurred
+                errorCount += 1
+                self.log('HTTP Error {} {} {} {}.\nAttempt {}'.format(typ, url, data, e, errorCount), severity='error')
+                deadline.sleep(15)
+                continue
+
+            # If the response code is 200 (Which means OK)
+            if resp.status_code == requests.codes.ok:
+                # Try loading the response in json format
+                try:
+                    return json.loads(resp.text)
+                except json.decoder.JSONDecodeError:
+                    # Raise LoadingError if the response was OK but data couldn't be read in JSON
+                    self.log('JSONDecodeError Error {} {} {}\n{}'.format(typ, url, data, resp.text), severity='error')
+                    raise LoadingError
+            elif resp.status_code == 401:  # Unauthorized
+                # Error handling. Handle for unauthorized error, the token is masked in the log.
+                headers = dict(self.headers, **{'x-auth-token': '***'})
+                self.log(json.dumps(headers, indent=4), severity='error')
+                raise UnauthorizedError
+            elif resp.status_code == 403:
+                try:
+                    # Try to load the data in JSON to get more information on error
+                    r = json.loads(resp.text)
+                except json.decoder.JSONDecodeError:
+                    # Error handling. Increment error counter and sleep for 15 seconds
+                    # and try again if the 403 error couldn't also be decoded to JSON either.
+                    self.log('API json.decoder 403 ' + resp.text, severity='error')
+                    errorCount += 1
+                    deadline.sleep(15)
+                    continue
+                if 'message' not in r:
+                    # Error handling. Increment error counter and sleep for 15 seconds
+                    # and try again if r['message'] wasn't present in the response.
+                    self.log('Api not message: 403 {} {}'.format(resp.text, data), severity='error')
+                    errorCount += 1
+                    deadline.sleep(15)
+                    continue
+                # If the message tells us that the account has been expired
+                if r['message'] == 'The requested Account has expired.':
+                    print('The requested Account has expired.')
+                    raise LoadingError
+                self.log('API 403 {}'.format(r['message']), severity='error')
+            elif resp.status_code == 429:  # X-Rate-Limit-Time-Reset-Ms
+                # request() paused the rate limiter until the limit resets, the next attempt waits for it
+                continue
+            else:
+                errorCount += 1
+                self.log('Error {} {} {} {} {}\n{}'.format(errorCount, resp.status_code, typ, url, data, resp.text), severity='error')
+                deadline.sleep(10)
+                continue
+            break
+
+        self.log('Error {} {} {} {}'.format(errorCount, typ, url, data), severity='error')
+        raise LoadingError
+
+    def close(self):
+        self.session.close()
@@ -47,6 +47,7 @@ The CSV currently intended to download has the following columns:
     - ebaybuyitnow
     - ebayupcnot
     - ebayskip
+    - ebayepid
     - amznsku
     - amznasin
     - amznprice
@@ -80,6 +81,44 @@ Parameters/Options:
     -p  | --preserve        : Do not delete older files that start with 'SureDone_' in the download directory
         |                       - This funciton is limited to default download locations only.
         |                       - Defining custom output path will render this feature useless.
+    -s  | --split_channels  : Also write per-channel files (guid, common fields and the channel's own columns)
+        |                       while the export is being downloaded. Comma separated list of channels or 'all'.
+        |                       - Available channels: ebay, amazon, walmart
+        |                       - Rows whose channel skip field (ebayskip, amznskip, walmartskip) is set are left out.
+        |                       - Files are saved next to the output file as <output>_<channel>.csv
+    -m  | --mode            : How the items are acquired: 'bulk', 'paged' or 'auto'
+        |                       - bulk  : Request a bulk/exports file and download it once SureDone has prepared it
+        |                       - paged : Page through the items (or search) endpoint with concurrent page requests
+        |                       - auto  : Paged if the result has at most --paged_limit items or a --query is given,
+        |                                 bulk otherwise
+        |                                 (paged files have the columns of the requested fields, not the export layout)
+        |                       - Default: bulk, paged when a --query is given
+    -q  | --query           : SureDone search query for a targeted pull (paged and auto mode, bulk exports
+        |                       always hold the whole catalog so -m bulk with -q is an error)
+        |                       - Default is empty, i.e. all items
+        | --paged_limit     : Largest number of items auto mode fetches page by page
+        |                       - Default: 5000
+        | --page_workers    : Number of page requests in flight at the same time in paged mode
+        |                       - Default: 4
+        | --metrics_file    : Write run metrics in Prometheus textfile-collector format to this path when the script ends
+        |                       - e.g. /var/lib/node_exporter/textfile/suredone_download.prom
+        | --profile         : Profile the run with cProfile and tracemalloc
+        |                       - Writes <log>.prof, <log>_profile.txt and <log>_memory.txt next to the log file
+        | --deadline        : Total time (in seconds) the whole run may take before it is aborted
+        |                       - Default: 0 (no deadline)
+        | --phase_budget    : Time budget (in seconds) of each phase, enforced across API retries and polling
+        |                       - A single number applies to every phase, or per phase as name=seconds pairs
+        |                       - Phases: export_request, download, paged_download
+        |                       - Default: 0 (no budget)
+        | --stall_floor     : Lowest acceptable download throughput in bytes per second. A download that stays
+        |                       below it for --stall_window seconds is aborted and resumed where it stopped.
+        |                       - Default: 1024 bytes/second, 0 disables the watchdog
+        | --stall_window    : Number of seconds the throughput is measured over
+        |                       - Default: 60 seconds
+        | --no_index        : Do not build the guid index (<output>.idx) of the downloaded file
+        |                       - The index is used by suredone_lookup.py for single guid lookups
+        | --rate_limit      : Highest number of API requests per second, shared by all page workers
+        |                       - Default: 0 (no limit, HTTP 429 responses still pause until the limit resets)
     -v  | --verbose         : Show outputs in terminal as well as log file
     -w  | --wait            : Custom timeout for requests invoked by the script (specified in seconds)
         |                       - Default: 15 seconds
@@ -95,6 +134,19 @@ Example:
 
     $ python3 suredone_download.py -f [config.yaml] -o [output.csv] -v -p
     $ python3 suredone_download.py -file [config.yaml] --output_file [output.csv] --verbose --preserve
+
+    $ python3 suredone_download.py -f [config.yaml] -s ebay,amazon
+    $ python3 suredone_download.py -file [config.yaml] --split_channels all
+
+    $ python3 suredone_download.py -f [config.yaml] -m paged -q "brand:=acme"
+    $ python3 suredone_download.py -file [config.yaml] --mode auto --paged_limit 10000 --page_workers 8
+
+    $ python3 suredone_download.py -f [config.yaml] --metrics_file [suredone_download.prom]
+    $ python3 suredone_download.py -f [config.yaml] --profile
+
+    $ python3 suredone_download.py -f [config.yaml] --deadline 3600 --phase_budget export_request=300,download=1800
+    $ python3 suredone_download.py -f [config.yaml] --stall_floor 4096 --stall_window 30
+    $ python3 suredone_download.py -f [config.yaml] -m paged --page_workers 8 --rate_limit 5
 """
 
 # Help message
@@ -118,6 +170,44 @@ Parameters/Options:
     -p  | --preserve        : Do not delete older files that start with 'SureDone_' in the download directory
         |                       - This funciton is limited to default download locations only.
         |                       - Defining custom output path will render this feature useless.
+    -s  | --split_channels  : Also write per-channel files (guid, common fields and the channel's own columns)
+        |                       while the export is being downloaded. Comma separated list of channels or 'all'.
+        |                       - Available channels: ebay, amazon, walmart
+        |                       - Rows whose channel skip field (ebayskip, amznskip, walmartskip) is set are left out.
+        |                       - Files are saved next to the output file as <output>_<channel>.csv
+    -m  | --mode            : How the items are acquired: 'bulk', 'paged' or 'auto'
+        |                       - bulk  : Request a bulk/exports file and download it once SureDone has prepared it
+        |                       - paged : Page through the items (or search) endpoint with concurrent page requests
+        |                       - auto  : Paged if the result has at most --paged_limit items or a --query is given,
+        |                                 bulk otherwise
+        |                                 (paged files have the columns of the requested fields, not the export layout)
+        |                       - Default: bulk, paged when a --query is given
+    -q  | --query           : SureDone search query for a targeted pull (paged and auto mode, bulk exports
+        |                       always hold the whole catalog so -m bulk with -q is an error)
+        |                       - Default is empty, i.e. all items
+        | --paged_limit     : Largest number of items auto mode fetches page by page
+        |                       - Default: 5000
+        | --page_workers    : Number of page requests in flight at the same time in paged mode
+        |                       - Default: 4
+        | --metrics_file    : Write run metrics in Prometheus textfile-collector format to this path when the script ends
+        |                       - e.g. /var/lib/node_exporter/textfile/suredone_download.prom
+        | --profile         : Profile the run with cProfile and tracemalloc
+        |                       - Writes <log>.prof, <log>_profile.txt and <log>_memory.txt next to the log file
+        | --deadline        : Total time (in seconds) the whole run may take before it is aborted
+        |                       - Default: 0 (no deadline)
+        | --phase_budget    : Time budget (in seconds) of each phase, enforced across API retries and polling
+        |                       - A single number applies to every phase, or per phase as name=seconds pairs
+        |                       - Phases: export_request, download, paged_download
+        |                       - Default: 0 (no budget)
+        | --stall_floor     : Lowest acceptable download throughput in bytes per second. A download that stays
+        |                       below it for --stall_window seconds is aborted and resumed where it stopped.
+        |                       - Default: 1024 bytes/second, 0 disables the watchdog
+        | --stall_window    : Number of seconds the throughput is measured over
+        |                       - Default: 60 seconds
+        | --no_index        : Do not build the guid index (<output>.idx) of the downloaded file
+        |                       - The index is used by suredone_lookup.py for single guid lookups
+        | --rate_limit      : Highest number of API requests per second, shared by all page workers
+        |                       - Default: 0 (no limit, HTTP 429 responses still pause until the limit resets)
     -v  | --verbose         : Show outputs in terminal as well as log file
     -w  | --wait            : Custom timeout for requests invoked by the script (specified in seconds)
         |                       - Default: 15 seconds
@@ -133,6 +223,19 @@ Example:
 
     $ python3 suredone_download.py -f [config.yaml] -o [output.csv] -v -p
     $ python3 suredone_download.py -file [config.yaml] --output_file [output.csv] --verbose --preserve
+
+    $ python3 suredone_download.py -f [config.yaml] -s ebay,amazon
+    $ python3 suredone_download.py -file [config.yaml] --split_channels all
+
+    $ python3 suredone_download.py -f [config.yaml] -m paged -q "brand:=acme"
+    $ python3 suredone_download.py -file [config.yaml] --mode auto --paged_limit 10000 --page_workers 8
+
+    $ python3 suredone_download.py -f [config.yaml] --metrics_file [suredone_download.prom]
+    $ python3 suredone_download.py -f [config.yaml] --profile
+
+    $ python3 suredone_download.py -f [config.yaml] --deadline 3600 --phase_budget export_request=300,download=1800
+    $ python3 suredone_download.py -f [config.yaml] --stall_floor 4096 --stall_window 30
+    $ python3 suredone_download.py -f [config.yaml] -m paged --page_workers 8 --rate_limit 5
 """
 
 # Imports
@@ -141,15 +244,27 @@ import os
 import getopt
 import platform
 import requests
-import yaml
 import json
 import pandas as pd
 import re
+import csv
+import codecs
+import io
+import math
 import time
 import inspect
 import traceback
+import atexit
+import signal
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from os.path import expanduser
 from datetime import datetime
+from suredone_metrics import MetricsRegistry
+from suredone_profiler import Profiler
+from suredone_lookup import GuidIndexBuilder, buildIndexFromFile
+from suredone_client import SureDone, Deadline, DeadlineExceeded, LoadingError, ConfigError, loadConfig as readConfig
 
 currentMilliTime = lambda: int(round(time.time() * 1000))
 
@@ -159,12 +274,48 @@ PYTHON_VERSION = float(sys.version[:sys.version.index(' ')-2])
 RUN_TIME = currentMilliTime()
 START_TIME = datetime.now()
 
+# Channel specific columns of the export are recognized by their prefix.
+# Each channel also has a skip field that excludes the row from that channel.
+CHANNELS = {
+    'ebay': {'prefix': 'ebay', 'skip': 'ebayskip'},
+    'amazon': {'prefix': 'amzn', 'skip': 'amznskip'},
+    'walmart': {'prefix': 'walmart', 'skip': 'walmartskip'}
+}
+
+# Number of items SureDone returns per page of the items and search endpoints
+ITEMS_PER_PAGE = 50
+
+# Phases that can get their own time budget
+PHASES = ('export_request', 'download', 'paged_download')
+
+# How many times a stalled or broken download stream is resumed before giving up
+MAX_DOWNLOAD_RESUMES = 5
+
+# Seconds after the run deadline at which the process is stopped even if it is blocked somewhere
+DEADLINE_GRACE = 60
+
 def main(argv):
     localFrame = inspect.currentframe()
 
     # Parse arguments
     # When verbose argument is added, change the verbose of the logger based on the argument as well
-    waitTime, configPath, delimiter, outputFilePath, preserveOldFiles, verbose = parseArgs(argv)
+    waitTime, configPath, delimiter, outputFilePath, preserveOldFiles, verbose, splitChannels, mode, query, pagedLimit, pageWorkers, metricsFilePath, profile, deadline, phaseBudgets, stallFloor, stallWindow, buildIndex, rateLimit = parseArgs(argv)
+
+    # The run deadline bounds every phase, the alarm is the last resort if the process is blocked
+    runDeadline = Deadline(deadline, 'run')
+    if deadline and hasattr(signal, 'SIGALRM'):
+        signal.signal(signal.SIGALRM, onDeadlineAlarm)
+        signal.alarm(int(math.ceil(deadline)) + DEADLINE_GRACE)
+
+    # Profiling reports are written next to the log file at exit
+    if profile:
+        PROFILER.start()
+        atexit.register(writeProfile)
+
+    # Metrics are written however the script ends, safeExit marks the run as successful
+    if metricsFilePath:
+        METRICS.setGauge('last_run_success', 0)
+        atexit.register(writeMetrics, metricsFilePath)
 
     # Check if python version is 3.5 or higher
     if not PYTHON_VERSION >= 3.5:
@@ -176,6 +327,16 @@ def main(argv):
     LOGGER.writeLog("Configurations path: {}.".format(configPath), localFrame.f_lineno, severity='normal')
     LOGGER.writeLog("Delimiter: {}.".format(delimiter), localFrame.f_lineno, severity='normal')
     LOGGER.writeLog("Preserve old files: {}.".format(preserveOldFiles), localFrame.f_lineno, severity='normal')
+    LOGGER.writeLog("Split channels: {}.".format(', '.join(splitChannels) if splitChannels else 'None'), localFrame.f_lineno, severity='normal')
+    LOGGER.writeLog("Mode: {}.".format(mode), localFrame.f_lineno, severity='normal')
+    LOGGER.writeLog("Query: {}.".format(query if query else 'None'), localFrame.f_lineno, severity='normal')
+    LOGGER.writeLog("Metrics file: {}.".format(metricsFilePath if metricsFilePath else 'None'), localFrame.f_lineno, severity='normal')
+    LOGGER.writeLog("Profile: {}.".format(profile), localFrame.f_lineno, severity='normal')
+    LOGGER.writeLog("Deadline: {}.".format('{} seconds'.format(deadline) if deadline else 'None'), localFrame.f_lineno, severity='normal')
+    LOGGER.writeLog("Phase budgets: {}.".format(', '.join('{}={}'.format(phase, phaseBudgets[phase]) for phase in phaseBudgets) if phaseBudgets else 'None'), localFrame.f_lineno, severity='normal')
+    LOGGER.writeLog("Guid index: {}.".format(buildIndex), localFrame.f_lineno, severity='normal')
+    LOGGER.writeLog("Rate limit: {}.".format('{} requests/second'.format(rateLimit) if rateLimit else 'None'), localFrame.f_lineno, severity='normal')
+    LOGGER.writeLog("Stall watchdog: {}.".format('below {} bytes/second for {} seconds'.format(stallFloor, stallWindow) if stallFloor else 'None'), localFrame.f_lineno, severity='normal')
     LOGGER.writeLog("Verbose: {}.\n".format(verbose), localFrame.f_lineno, severity='normal')
 
     # Parse configuration
@@ -184,13 +345,31 @@ def main(argv):
     LOGGER.writeLog("Configuration read.", localFrame.f_lineno, severity='normal')
     
     # Initialize API handler object
-    sureDone = SureDone(user, apiToken, waitTime)
+    # The session's connection pool serves every page worker, API messages go to the log file
+    sureDone = SureDone(user, apiToken, waitTime, rateLimit=rateLimit, poolSize=pageWorkers + 1, metrics=METRICS, logger=LOGGER.writeLog)
 
     # Get data to send to the bulk/exports sub module
     data = getDataForExports()
 
+    # Small result sets are paged through directly instead of waiting for a bulk export
+    mode, firstPage = chooseAcquisitionMode(sureDone, mode, query, pagedLimit, deadline=runDeadline)
+    if mode == 'paged':
+        sinks = []
+        if splitChannels:
+            sinks.append(ChannelSplitter(outputFilePath, splitChannels, delimiter=delimiter, sourceDelimiter=delimiter))
+        if buildIndex:
+            sinks.append(GuidIndexBuilder(outputFilePath, delimiter=delimiter))
+
+        with runStage('paged_download'):
+            phaseDeadline = Deadline(phaseBudgets.get('paged_download'), 'paged_download', parent=runDeadline)
+            downloadPagedItems(sureDone, query, data['fields'].split(','), firstPage, outputFilePath, delimiter=delimiter, workers=pageWorkers, sinks=sinks, deadline=phaseDeadline)
+        safeExit(outputFilePath, marker='execution-complete')
+        return
+
     # Invoke the GET API call to bulk/exports sub module
-    exportRequestResponse = sureDone.apicall('get', 'bulk/exports', data)
+    with runStage('export_request'):
+        phaseDeadline = Deadline(phaseBudgets.get('export_request'), 'export_request', parent=runDeadline)
+        exportRequestResponse = sureDone.apicall('get', 'bulk/exports', data, deadline=phaseDeadline)
     
     LOGGER.writeLog("API response recieved.", localFrame.f_lineno, severity='normal')
     
@@ -199,8 +378,23 @@ def main(argv):
         # Get the file name of the newly exported file
         fileName = exportRequestResponse['export_file']
 
+        # Consumers that get the downloaded bytes in the same streaming pass
+        sinks = []
+        if splitChannels:
+            sinks.append(ChannelSplitter(outputFilePath, splitChannels, delimiter=delimiter))
+        # The file is rewritten afterwards for other delimiters, so it is indexed after that
+        if buildIndex and delimiter == ',':
+            sinks.append(GuidIndexBuilder(outputFilePath, delimiter=delimiter))
+
         # Download and save the file
-        downloadExportedFile(fileName, outputFilePath, sureDone, delimiter=delimiter)
+        with runStage('download'):
+            phaseDeadline = Deadline(phaseBudgets.get('download'), 'download', parent=runDeadline)
+            downloadExportedFile(fileName, outputFilePath, sureDone, delimiter=delimiter, sinks=sinks, deadline=phaseDeadline, stallFloor=stallFloor, stallWindow=stallWindow)
+
+        if buildIndex and delimiter != ',':
+            with runStage('index'):
+                count = buildIndexFromFile(outputFilePath, delimiter=delimiter)
+            LOGGER.writeLog("Indexed {} rows.".format(count), localFrame.f_lineno, severity='normal')
 
         safeExit(outputFilePath, marker='execution-complete')
 
@@ -231,6 +425,8 @@ def safeExit(downloadPath, marker=''):
 
     # For execution-completed
     if marker == 'execution-complete':
+        METRICS.incCounter('rows_exported_total', numRows)
+        METRICS.setGauge('last_run_success', 1)
         print("=================================================================")
         print("SCRIPT EXECUTED SUCCESSFULLY")
         print("Starting time: {}".format(START_TIME.strftime("%H:%M:%S")))
@@ -239,6 +435,39 @@ def safeExit(downloadPath, marker=''):
         print("Total records in downloaded file: {}".format(numRows))
         print("=================================================================")
 
+@contextmanager
+def runStage(name):
+    """
+    Context manager that measures a named stage of the run for the metrics and the profiler.
+
+    Parameters
+    ----------
+        - name : str
+            Name of the stage
+    """
+    with METRICS.timeStage(name), PROFILER.stage(name):
+        yield
+
+def writeProfile():
+    """ Function registered to run at exit that writes the profiling reports next to the log file. """
+    localFrame = inspect.currentframe()
+    basePath = os.path.splitext(LOGGER.log.name)[0]
+    for path in PROFILER.finish(basePath):
+        LOGGER.writeLog("Profile written to " + path, localFrame.f_lineno, severity='normal')
+
+def writeMetrics(metricsFilePath):
+    """
+    Function registered to run at exit that records the total run time and writes the metrics textfile.
+
+    Parameters
+    ----------
+        - metricsFilePath : str
+            Path of the Prometheus textfile (.prom)
+    """
+    METRICS.observe('stage_duration_seconds', (currentMilliTime() - RUN_TIME) / 1000.0, labels={'stage': 'total'})
+    METRICS.setGauge('last_run_timestamp_seconds', int(time.time()))
+    METRICS.writeTextfile(metricsFilePath)
+
 def loadConfig (configPath):
     """
     Function that parses the configuration file and reads user and apiToken variables
@@ -255,20 +484,13 @@ def loadConfig (configPath):
         - apiToken : str
             Api authentication token from the configuration file
     """
-    # Loading configurations
-    with open(configPath, 'r') as stream:
-        try:
-            config = yaml.safe_load(stream)
-        except yaml.YAMLError as exc:
-            LOGGER.writeLog("Error while loading YAML.", localFrame.f_lineno, severity='code-breaker', data={'code':3, 'error':exc})
-    
-    # Try to read the user and api_token from suredone_api set in the settings
-    # Print error that the settings weren't found and exit
+    localFrame = inspect.currentframe()
+    # The file is read by the client module shared with suredone_upload.py
+    # Print error that the settings couldn't be read and exit
     try:
-        user = config['user']
-        apiToken = config['token']
-    except KeyError as exc:
-        LOGGER.writeLog("Not found user or token in config file.", localFrame.f_lineno, severity='code-breaker', data={'code':3, 'error':exc})
+        user, apiToken = readConfig(configPath)
+    except ConfigError as exc:
+        LOGGER.writeLog(str(exc), localFrame.f_lineno, severity='code-breaker', data={'code':3, 'error':str(exc)})
         exit()
     return user, apiToken
 
@@ -328,7 +550,7 @@ def getDataForExports():
     data['type'] = 'items'
     data['mode'] = 'include'
     # data['fields'] = 'guid,stock,price, msrp,cost,title,condition,brand,media1,weight,fitmentfootnotes, manufacturerpartnumber, otherpartnumber,chaincablepattern, compatibletiresizes,caution, howmanywheelsdoesthisdo,howmanytiresdoesthiscover,ebayid,ebaypaymentprofileid,ebayreturnprofileid,ebayshippingprofileid'
-    data['fields'] ='guid,stock,price,msrp,cost,title,longdescription,condition,brand,upc,media1,weight,datesold,totalsold,manufacturerpartnumber,warranty,mpn,ebayid,ebaysku,ebaycatid,ebaystoreid,ebayprice,ebaytitle,ebaystarttime,ebayendtime,ebaysiteid,ebaysubtitle,ebaypaymentprofileid,ebayreturnprofileid,ebayshippingprofileid,ebaybestofferenabled,ebaybestofferminimumprice,ebaybestofferautoacceptprice,ebaybuyitnow,ebayupcnot,ebayskip,amznsku,amznasin,amznprice,amznskip,walmartskip,walmartprice,walmartcategory,walmartdescription,walmartislisted,walmartinprogress,walmartstatus,walmarturl,total_stock'
+    data['fields'] ='guid,stock,price,msrp,cost,title,longdescription,condition,brand,upc,media1,weight,datesold,totalsold,manufacturerpartnumber,warranty,mpn,ebayid,ebaysku,ebaycatid,ebaystoreid,ebayprice,ebaytitle,ebaystarttime,ebayendtime,ebaysiteid,ebaysubtitle,ebaypaymentprofileid,ebayreturnprofileid,ebayshippingprofileid,ebaybestofferenabled,ebaybestofferminimumprice,ebaybestofferautoacceptprice,ebaybuyitnow,ebayupcnot,ebayskip,ebayepid,amznsku,amznasin,amznprice,amznskip,walmartskip,walmartprice,walmartcategory,walmartdescription,walmartislisted,walmartinprogress,walmartstatus,walmarturl,total_stock'
 
     # Split the data fields based on ',' and they strip each field of any spaces
     t=list(map(lambda x: x.strip(' '),data['fields'].split(',')))
@@ -345,8 +567,153 @@ def getDataForExports():
 
     # Rejoin the fields into a single string, separated by a ','
     data['fields'] = ','.join(field_list)
+    return data
 
-def downloadExportedFile(fileName, downloadFilePath, sureDone, delimiter=','):
+def getItemsEndpoint(query):
+    """
+    Function that returns the paginated endpoint to read items from.
+
+    Parameters
+    ----------
+        - query : str
+            SureDone search query, empty for all items
+    """
+    if query:
+        return 'search/items/' + requests.utils.quote(query, safe='')
+    return 'editor/items'
+
+def chooseAcquisitionMode(sureDone, mode, query, pagedLimit, deadline=None):
+    """
+    Function that decides between the bulk export and the paged item fetch.
+    In auto mode the first page is requested to learn the size of the result,
+    and that page is handed back so it doesn't have to be requested again.
+    A query always pages, the bulk export can't apply it.
+
+    Parameters
+    ----------
+        - sureDone : SureDone object
+            Object of the SureDone API handler class
+        - mode : str
+            'bulk', 'paged' or 'auto'
+        - query : str
+            SureDone search query, empty for all items
+        - pagedLimit : int
+            Largest number of items fetched page by page in auto mode
+        - deadline : Deadline object
+            Time limit of the request
+
+    Returns
+    -------
+        - mode : str
+            'bulk' or 'paged'
+        - firstPage : dict
+            The first page of the paged endpoint, None when bulk mode was chosen without requesting it
+    """
+    localFrame = inspect.currentframe()
+    if mode == 'bulk':
+        return mode, None
+
+    firstPage = sureDone.apicall('get', getItemsEndpoint(query), {'page': 1}, deadline=deadline)
+    total = getItemCount(firstPage)
+    if total is None:
+        # Without the count the pages can't be planned, only the bulk export is complete
+        if mode == 'auto' and not query:
+            LOGGER.writeLog("The first page has no item count, auto mode falls back to bulk acquisition.", localFrame.f_lineno, severity='warning')
+            return 'bulk', None
+        LOGGER.writeLog("The first page has no item count, can not page through the items.", localFrame.f_lineno, severity='code-breaker', data={'code':2, 'response':json.dumps(firstPage)})
+        exit(1)
+    LOGGER.writeLog("Items matching the request: {}.".format(total), localFrame.f_lineno, severity='normal')
+
+    if mode == 'auto':
+        mode = 'paged' if query or total <= pagedLimit else 'bulk'
+        LOGGER.writeLog("Auto mode selected {} acquisition.".format(mode), localFrame.f_lineno, severity='normal')
+    return mode, firstPage
+
+def getItemCount(page):
+    """
+    Function that returns the number of items of a paged result from the "all" key of its
+    first page, None if the key is missing or not a number.
+    """
+    try:
+        return int(page['all'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def getPageItems(page):
+    """
+    Function that extracts the items of a page response in the order SureDone numbered them.
+    Items are stored under the keys "1", "2", ... next to meta keys like "all" and "result".
+
+    Parameters
+    ----------
+        - page : dict
+            JSON response of the items or search endpoint
+    """
+    keys = sorted((key for key in page if key.isdigit()), key=int)
+    return [page[key] for key in keys]
+
+def formatItemValue(value):
+    """ Function that converts an item value from the JSON response to a CSV cell. """
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+def downloadPagedItems(sureDone, query, fields, firstPage, downloadFilePath, delimiter=',', workers=4, sinks=None, deadline=None):
+    """
+    Function that pages through the items (or search) endpoint and streams the items into the output CSV.
+    At most 'workers' page requests are in flight and pages are written in order as soon as they arrive,
+    so memory is bounded by the number of outstanding pages rather than the size of the result.
+
+    Parameters
+    ----------
+        - sureDone : SureDone object
+            Object of the SureDone API handler class
+        - query : str
+            SureDone search query, empty for all items
+        - fields : list
+            Columns of the output CSV
+        - firstPage : dict
+            Already requested first page of the result
+        - downloadFilePath : str
+            Path of the output CSV
+        - delimiter : str
+            Delimiter of the output CSV
+        - workers : int
+            Number of concurrent page requests
+        - sinks : list
+            Objects with feed(chunk) and close() methods that receive every written chunk
+        - deadline : Deadline object
+            Time limit of the paged download, shared by all page requests
+    """
+    localFrame = inspect.currentframe()
+    endpoint = getItemsEndpoint(query)
+    total = getItemCount(firstPage)
+    if total is None:
+        raise LoadingError('The first page has no item count.')
+    numPages = int(math.ceil(total / float(ITEMS_PER_PAGE)))
+    LOGGER.writeLog("Starting paged download of {} items in {} pages.".format(total, numPages), localFrame.f_lineno, severity='normal')
+
+    with open(downloadFilePath, 'wb') as downloadedFile:
+        writer = ExportRowWriter(downloadedFile, delimiter=delimiter, sinks=sinks)
+        writer.writeRow(fields)
+        writer.writeItems(getPageItems(firstPage), fields)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            nextPage = 2
+            while nextPage <= numPages or pending:
+                # Keep the pipeline full, then write the oldest page once it's available
+                while nextPage <= numPages and len(pending) < workers:
+                    pending.append(executor.submit(sureDone.apicall, 'get', endpoint, {'page': nextPage}, deadline=deadline))
+                    nextPage += 1
+                writer.writeItems(getPageItems(pending.popleft().result()), fields)
+        writer.close()
+
+    LOGGER.writeLog("Saved {} items to {}".format(writer.rowCount, downloadFilePath), localFrame.f_lineno, severity='normal')
+
+def downloadExportedFile(fileName, downloadFilePath, sureDone, delimiter=',', sinks=None, deadline=None, stallFloor=0, stallWindow=60):
     """
     Fucntion that is invoked once the file is exported and is ready to download.
     Invokes the download stream, reads it and write to the file in the decided download directory.
@@ -359,25 +726,33 @@ def downloadExportedFile(fileName, downloadFilePath, sureDone, delimiter=','):
             Path to the download directory.
         - sureDone : SureDone object
             Object of the SureDone API handler class
+        - delimiter : str
+            Delimiter of the saved file
+        - sinks : list
+            Objects with feed(chunk) and close() methods that receive every downloaded chunk
+            as it is written to disk, e.g. a ChannelSplitter
+        - deadline : Deadline object
+            Time limit of the polling and the download together
+        - stallFloor : float
+            Lowest acceptable throughput in bytes per second, 0 disables the stall watchdog
+        - stallWindow : float
+            Seconds the throughput is measured over
     """
+    if sinks is None:
+        sinks = []
+    if deadline is None:
+        deadline = Deadline(None, 'download')
     localFrame = inspect.currentframe()
     errorCount=0
     while True:
         # Invoke api call to the same module but with a filename and no data 
-        fileDownloadURLResponse = sureDone.apicall('get', 'bulk/exports/' + fileName, {})
+        fileDownloadURLResponse = sureDone.apicall('get', 'bulk/exports/' + fileName, {}, deadline=deadline)
 
         # If the result was successfull...
         if fileDownloadURLResponse['result'] == 'success':
             # Set the path, get the download URL of the file requested, and start a stream to download it
             LOGGER.writeLog("Starting file download.", localFrame.f_lineno, severity='normal')
-            downloadStream = requests.get(fileDownloadURLResponse['url'], stream=True)
-            
-            # Get all the file bytes in the stream and write to the file
-            index = 0
-            with open(downloadFilePath, 'wb') as downloadedFile:
-                for index, chunk in enumerate(downloadStream.iter_content(chunk_size=1024)):
-                    if chunk:  # filter out keep-alive new chunks
-                        downloadedFile.write(chunk)
+            streamToFile(fileDownloadURLResponse['url'], downloadFilePath, sureDone.timeout, sinks, deadline, stallFloor, stallWindow, session=sureDone.session)
             
             # Re open the saved csv and save it back with the desired delimiter
             # As long as the delimiter desired is not ',' becasue the default way of delimiting the csv is via ','
@@ -398,9 +773,79 @@ def downloadExportedFile(fileName, downloadFilePath, sureDone, delimiter=','):
                 break
             else:
                 LOGGER.writeLog('Attempt ' + str(errorCount) + ' ' + str(fileDownloadURLResponse), localFrame.f_lineno, severity='warning')
-                time.sleep(30)
+                deadline.sleep(30)
                 continue
 
+def streamToFile(url, downloadFilePath, timeout, sinks, deadline, stallFloor=0, stallWindow=60, session=None):
+    """
+    Function that downloads the exported file and feeds every chunk to the sinks.
+    A stream that breaks or stays below the throughput floor is aborted and resumed
+    with a Range request from the last written byte. If the server ignores the range,
+    the bytes that were already written are skipped instead.
+
+    Parameters
+    ----------
+        - url : str
+            Download URL of the exported file
+        - downloadFilePath : str
+            Path of the output file
+        - timeout : float
+            Connect and read timeout of the stream in seconds
+        - sinks : list
+            Objects with feed(chunk) and close() methods
+        - deadline : Deadline object
+            Time limit of the download
+        - stallFloor : float
+            Lowest acceptable throughput in bytes per second, 0 disables the stall watchdog
+        - stallWindow : float
+            Seconds the throughput is measured over
+        - session : requests.Session
+            Session to download with (connection reuse), requests.get is used if None
+    """
+    localFrame = inspect.currentframe()
+    # Without data for a whole stall window the stream is stalled as well
+    readTimeout = min(timeout, stallWindow) if stallFloor else timeout
+    written = 0
+    resumes = 0
+
+    with open(downloadFilePath, 'wb') as downloadedFile:
+        while True:
+            headers = {'Range': 'bytes={}-'.format(written)} if written else {}
+            try:
+                downloadStream = (session or requests).get(url, stream=True, headers=headers, timeout=(deadline.clamp(timeout), deadline.clamp(readTimeout)))
+                downloadStream.raise_for_status()
+                # Bytes to throw away when the server sends the file from the start again
+                skip = written if downloadStream.status_code != 206 else 0
+                watchdog = StallWatchdog(stallFloor, stallWindow)
+                for chunk in downloadStream.iter_content(chunk_size=65536):
+                    deadline.check()
+                    if not chunk:  # filter out keep-alive new chunks
+                        continue
+                    METRICS.incCounter('bytes_downloaded_total', len(chunk))
+                    watchdog.update(len(chunk))
+                    if skip:
+                        if len(chunk) <= skip:
+                            skip -= len(chunk)
+                            continue
+                        chunk = chunk[skip:]
+                        skip = 0
+                    downloadedFile.write(chunk)
+                    written += len(chunk)
+                    for sink in sinks:
+                        sink.feed(chunk)
+                break
+            except (requests.exceptions.RequestException, StalledDownloadError) as e:
+                resumes += 1
+                if resumes > MAX_DOWNLOAD_RESUMES:
+                    LOGGER.writeLog("Download failed after {} resumes: {}".format(MAX_DOWNLOAD_RESUMES, e), localFrame.f_lineno, severity='error')
+                    raise LoadingError
+                LOGGER.writeLog("Download interrupted at {} bytes ({}). Resuming, attempt {}.".format(written, e, resumes), localFrame.f_lineno, severity='warning')
+                METRICS.incCounter('api_retries_total', labels={'endpoint': 'download'})
+                deadline.check()
+
+    for sink in sinks:
+        sink.close()
+
 def parseArgs(argv):
     """
     Function that parses the arguments sent from the command line 
@@ -425,10 +870,36 @@ def parseArgs(argv):
         - verbose : bool
         - preserveOldFiles : bool
             A boolean variable that will tell the script to keep or remove older downloaded files in the download path
+        - splitChannels : list
+            Channels (keys of CHANNELS) that need their own output file. Empty if no split was requested.
+        - mode : str
+            Acquisition mode, 'bulk', 'paged' or 'auto'
+        - query : str
+            SureDone search query for paged mode
+        - pagedLimit : int
+            Largest number of items auto mode fetches page by page
+        - pageWorkers : int
+            Number of concurrent page requests in paged mode
+        - metricsFilePath : str
+            Path of the Prometheus textfile to write at the end, empty if metrics aren't written
+        - profile : bool
+            Whether to profile the run with cProfile and tracemalloc
+        - deadline : float
+            Seconds the whole run may take, 0 for no deadline
+        - phaseBudgets : dict
+            Seconds each phase may take, phases without budget are left out
+        - stallFloor : float
+            Lowest acceptable download throughput in bytes per second, 0 disables the watchdog
+        - stallWindow : float
+            Seconds the download throughput is measured over
+        - buildIndex : bool
+            Whether to build the guid index of the downloaded file
+        - rateLimit : float
+            Highest number of API requests per second, 0 for no limit
     """
     # Defining options in for command line arguments
-    options = "hw:f:d:o:vp"
-    long_options = ["help", "wait=", "file=", 'delimiter=','output=', 'verbose', 'preserve']
+    options = "hw:f:d:o:vps:m:q:"
+    long_options = ["help", "wait=", "file=", 'delimiter=','output=', 'verbose', 'preserve', 'split_channels=', 'mode=', 'query=', 'paged_limit=', 'page_workers=', 'metrics_file=', 'profile', 'deadline=', 'phase_budget=', 'stall_floor=', 'stall_window=', 'no_index', 'rate_limit=']
     
     # Arguments
     waitTime = 15
@@ -439,6 +910,19 @@ def parseArgs(argv):
     customOutputPathFoundAndValidated = False
     verbose = False
     preserveOldFiles = False
+    splitChannels = []
+    mode = ''
+    query = ''
+    pagedLimit = 5000
+    pageWorkers = 4
+    metricsFilePath = ''
+    profile = False
+    deadline = 0
+    phaseBudgets = {}
+    stallFloor = 1024
+    stallWindow = 60
+    buildIndex = True
+    rateLimit = 0
 
     # Extracting arguments
     try:
@@ -468,19 +952,52 @@ def parseArgs(argv):
             customOutputPathFoundAndValidated = validateDownloadPath(outputFilePath)
         elif option in ("-p", "--preserve"):
             preserveOldFiles = True
+        elif option in ("-s", "--split_channels"):
+            splitChannels = validateChannels(value)
+        elif option in ("-m", "--mode"):
+            mode = validateMode(value)
+        elif option in ("-q", "--query"):
+            query = value
+        elif option == "--paged_limit":
+            pagedLimit = int(value)
+        elif option == "--page_workers":
+            pageWorkers = max(1, int(value))
+        elif option == "--metrics_file":
+            metricsFilePath = value
+        elif option == "--profile":
+            profile = True
+        elif option == "--deadline":
+            deadline = max(0, float(value))
+        elif option == "--phase_budget":
+            phaseBudgets = validatePhaseBudgets(value)
+        elif option == "--stall_floor":
+            stallFloor = max(0, float(value))
+        elif option == "--stall_window":
+            stallWindow = max(1, float(value))
+        elif option == "--no_index":
+            buildIndex = False
+        elif option == "--rate_limit":
+            rateLimit = max(0, float(value))
         elif option in ("-v", "--verbose"):
             verbose = True
             # Updating logger's behavior based on verbose
             LOGGER.verbose = verbose
 
 
+    # The bulk export always holds the whole catalog, a query is only applied by paging
+    if not mode:
+        mode = 'paged' if query else 'bulk'
+    elif mode == 'bulk' and query:
+        print ("Error: --query can not be used with bulk mode, use paged or auto mode.")
+        sys.exit(2)
+
     # If custom path to config file wasn't found, search in default locations
     if not customConfigPathFoundAndValidated:
         configPath = getDefaultConfigPath()
     if not customOutputPathFoundAndValidated:
         outputFilePath = getDefaultDownloadPath(preserve=preserveOldFiles)
 
-    return waitTime, configPath, delimiter, outputFilePath, preserveOldFiles, verbose
+    return waitTime, configPath, delimiter, outputFilePath, preserveOldFiles, verbose, splitChannels, mode, query, pagedLimit, pageWorkers, metricsFilePath, profile, deadline, phaseBudgets, stallFloor, stallWindow, buildIndex, rateLimit
 
 def validateDownloadPath(path):
     """
@@ -538,6 +1055,83 @@ def validateDelimiter(delimiter):
     
     return delimiter
 
+def validatePhaseBudgets(budgets):
+    """
+    Function that parses the phase budget option.
+
+    Parameters
+    ----------
+        - budgets : str
+            A number of seconds for every phase, or comma separated name=seconds pairs
+
+    Returns
+    -------
+        - phaseBudgets : dict
+            Seconds per phase name, unknown phases and non-positive budgets are dropped with a warning
+    """
+    localFrame = inspect.currentframe()
+    if '=' not in budgets:
+        seconds = float(budgets)
+        return {phase: seconds for phase in PHASES} if seconds > 0 else {}
+
+    phaseBudgets = {}
+    for pair in budgets.split(','):
+        phase, _, seconds = pair.partition('=')
+        phase = phase.strip()
+        if phase not in PHASES:
+            LOGGER.writeLog("Unknown phase '{}' ignored. Available phases are: {}.".format(phase, ', '.join(PHASES)), localFrame.f_lineno, severity='warning')
+        elif float(seconds) > 0:
+            phaseBudgets[phase] = float(seconds)
+    return phaseBudgets
+
+def validateMode(mode):
+    """
+    Function that validates the acquisition mode option.
+
+    Parameters
+    ----------
+        - mode : str
+            The user-specified mode
+
+    Returns
+    -------
+        - mode : str
+            The same mode if validated and 'bulk' if not validated.
+    """
+    localFrame = inspect.currentframe()
+    mode = mode.strip().lower()
+    if mode not in ('bulk', 'paged', 'auto'):
+        LOGGER.writeLog("Mode must be one of bulk, paged or auto, switching to default 'bulk' mode.", localFrame.f_lineno, severity='warning')
+        mode = 'bulk'
+    return mode
+
+def validateChannels(channels):
+    """
+    Function that validates the list of channels the user wants split files for.
+
+    Parameters
+    ----------
+        - channels : str
+            Comma separated channel names or 'all'
+
+    Returns
+    -------
+        - channels : list
+            Valid channel names in the order given, unknown names are dropped with a warning.
+    """
+    localFrame = inspect.currentframe()
+    if channels.strip().lower() == 'all':
+        return list(CHANNELS.keys())
+
+    validated = []
+    for channel in channels.split(','):
+        channel = channel.strip().lower()
+        if channel not in CHANNELS:
+            LOGGER.writeLog("Unknown channel '{}' ignored. Available channels are: {}.".format(channel, ', '.join(CHANNELS.keys())), localFrame.f_lineno, severity='warning')
+        elif channel not in validated:
+            validated.append(channel)
+    return validated
+
 def validateConfigPath(configPath):
     """
     Function to validate the provided config file path.
@@ -747,152 +1341,256 @@ class Logger(object):
         # You might want to specify some extra behavior here.
         pass
 
-class LoadingError(Exception):
+class StalledDownloadError(Exception):
     pass
 
-class UnauthorizedError(Exception):
-    pass
+class StallWatchdog(object):
+    """ Throughput monitor of a download stream that raises StalledDownloadError below the floor. """
+    def __init__(self, floor, window):
+        """
+        Constructor function.
 
-class SureDone:
-    """ A driver class to manage connection and make requests to the Suredone API """
-    def __init__(self, user, api_token, timeout):
+        Parameters
+        ----------
+            - floor : float
+                Lowest acceptable throughput in bytes per second, 0 disables the watchdog
+            - window : float
+                Seconds the throughput is measured over
         """
-        Constructor function. Basically creates a header template for api calls.
+        self.floor = floor
+        self.window = window
+        self.windowStart = time.time()
+        self.windowBytes = 0
+
+    def update(self, numBytes):
+        """
+        Function that adds received bytes and checks the throughput once a window has passed.
 
         Parameters
         ----------
-            - user : str
-                User name for API
-            - 'api_token' : str
-                Auth token provided by the API
+            - numBytes : int
+                Bytes received since the last update
         """
-        self.timeout = timeout
-        self.api_endpoint = 'https://api.suredone.com/v1/'
-        self.headers = {}
-        self.headers['Content-Type'] = 'application/x-www-form-urlencoded'
-        self.headers['x-auth-integration'] = 'partnername'
-        self.headers['x-auth-user'] = user
-        self.headers['x-auth-token'] = api_token
-    
-    def apicall(self, typ, endpoint, data=None):
+        if not self.floor:
+            return
+        self.windowBytes += numBytes
+        elapsed = time.time() - self.windowStart
+        if elapsed >= self.window:
+            rate = self.windowBytes / elapsed
+            if rate < self.floor:
+                raise StalledDownloadError("{:.0f} bytes/second over the last {:.0f} seconds".format(rate, elapsed))
+            self.windowStart = time.time()
+            self.windowBytes = 0
+
+def onDeadlineAlarm(signum, frame):
+    """ Signal handler that stops a run that is still going well past its deadline. """
+    raise DeadlineExceeded("Run deadline exceeded.")
+
+class CsvStreamParser(object):
+    """ Incremental CSV parser that turns downloaded byte chunks into rows while the download is in progress. """
+    def __init__(self, onRow, delimiter=','):
         """
-        Function that will concatenate the intended endpoint with the main URL that
-        goes to the Suredone API and initiate the request with the provided data.
+        Constructor function.
 
         Parameters
         ----------
-            - typ : str
-                Defines the type of request. (REST functionality)
-                Available types:
-                    - get
-                    - put
-                    - post
-                    - delete
-            - endpoint : str
-                Specific module of the API that needs to be called.
-            - data : dict
-                The data that is meant to be sent in the API request in key-value dict format.
-        
-        Returns
-        -------
-            - r : str
-                The JSON formatted response data after the request was made
+            - onRow : function
+                Called with every complete row (list of str), header row included
+            - delimiter : str
+                Delimiter of the incoming CSV
         """
-        localFrame = inspect.currentframe()
-        # Build url string by concatenating the main url with the sub module
-        url = self.api_endpoint + endpoint
-        errorCount = 0
+        self.onRow = onRow
+        self.delimiter = delimiter
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.pending = ''
+        self.record = []
+        self.quotes = 0
+
+    def feed(self, chunk):
+        """
+        Function that consumes a chunk of bytes and emits every row completed by it.
+        Quoted fields may contain new lines, so a record is only complete once its quotes are balanced.
 
-        # Main loop
-        while True:
-            # 3 or more errors break the loop
-            if errorCount >= 3:
-                break
-            try:
-                # Invoke the corresponding api call based on the type
-                if typ == 'get':
-                    resp = requests.get(url, params=data, headers=self.headers, timeout=self.timeout)
-                elif typ == 'put':
-                    resp = requests.put(url, data=json.dumps(data), headers=self.headers, timeout=self.timeout)
-                elif typ == 'post':
-                    resp = requests.post(url, data=json.dumps(data), headers=self.headers, timeout=self.timeout)
-                elif typ == 'delete':
-                    resp = requests.delete(url, data=json.dumps(data), headers=self.headers, timeout=self.timeout)
-            except requests.exceptions.RequestException as e:
-                # Error handling. Increment error counter and sleep for
-                # 15 seconds and try again if error was ocurred
-                temp = 'HTTP Error {} {} {} {}.'.format(typ, url, data, e) + '\nAttempt ' + str(errorCount)
-                LOGGER.writeLog(temp, localFrame.f_lineno, severity='error')
-                errorCount += 1
-                time.sleep(15)
-                continue
+        Parameters
+        ----------
+            - chunk : bytes
+                Next chunk of the CSV file
+        """
+        lines = (self.pending + self.decoder.decode(chunk)).split('\n')
+        self.pending = lines.pop()
+        for line in lines:
+            self.pushLine(line + '\n')
+
+    def pushLine(self, line):
+        self.record.append(line)
+        self.quotes += line.count('"')
+        if self.quotes % 2 == 0:
+            row = next(csv.reader(self.record, delimiter=self.delimiter), [])
+            self.record = []
+            self.quotes = 0
+            if row:
+                self.onRow(row)
+
+    def close(self):
+        """ Function that flushes the last line if the file didn't end with a new line. """
+        self.pending += self.decoder.decode(b'', final=True)
+        if self.pending:
+            self.pushLine(self.pending)
+            self.pending = ''
+        if self.record:
+            self.quotes = 0
+            self.pushLine('')
+
+class ExportRowWriter(object):
+    """ CSV writer for the paged download that writes encoded rows to the output file and feeds them to the sinks. """
+    def __init__(self, downloadedFile, delimiter=',', sinks=None):
+        """
+        Constructor function.
 
-            # If the response code is 200 (Which means OK)
-            if resp.status_code == requests.codes.ok:
-                # Try loading the response in json format
-                try:
-                    r = json.loads(resp.text)
-                except json.decoder.JSONDecodeError:
-                    # Error handling. Increment error counter and raise LoadingError
-                    # if the response was OK but data couldn't be read in JSON
-                    temp = 'JSONDecodeError Error ' + typ + ' ' + url + ' ' + data + "\n" + resp.text
-                    LOGGER.writeLog(temp, localFrame.f_lineno, severity='error')
-                    errorCount += 1
-                    # TODO: remove custom exceptions probably
-                    raise LoadingError
-                
-                # Return the JSON formatted data
-                return r
-            elif resp.status_code == 401:  # Unauthorized
-                # Error handling. Handle for unauthorized error.
-                LOGGER.writeLog(json.dumps(self.headers, indent=4), localFrame.f_lineno, severity='error')
-                raise UnauthorizedError
-            elif resp.status_code == 403:
-                try:
-                    # Try to load the data in JSON to get more information on error
-                    r = json.loads(resp.text)
-                except json.decoder.JSONDecodeError:
-                    # Error handling. Increment error counter and sleep for 15 seconds 
-                    # and try again if the 403 error couldn't also be decoded to JSON either.
-                    LOGGER.writeLog('API json.decoder 403 ' + resp.text, localFrame.f_lineno, severity='error')
-                    errorCount += 1
-                    time.sleep(15)
-                    continue
-                try:
-                    # If the message tells us that the account has been expired
-                    if r['message'] == 'The requested Account has expired.':
-                        print('The requested Account has expired.')
-                        raise LoadingError
-                except KeyError:
-                    # Error handling. Increment error counter and sleep for 15 seconds
-                    # and try again if r['message'] wasn't present in the response.
-                    LOGGER.writeLog('Api not message: 403 ' + resp.text + ' ' + data, localFrame.f_lineno, severity='error')
-                    errorCount += 1
-                    time.sleep(15)
-                    continue
-            # ?? TODO: Find out more
-            elif resp.status_code == 429:  # X-Rate-Limit-Time-Reset-Ms
-                time.sleep(40)
+        Parameters
+        ----------
+            - downloadedFile : fileIO
+                Output file opened in binary mode
+            - delimiter : str
+                Delimiter of the output CSV
+            - sinks : list
+                Objects with feed(chunk) and close() methods
+        """
+        self.downloadedFile = downloadedFile
+        self.sinks = sinks if sinks else []
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, delimiter=delimiter)
+        self.rowCount = 0
+
+    def writeRow(self, row):
+        self.writer.writerow(row)
+
+    def writeItems(self, items, fields):
+        """
+        Function that writes one row per item with the values of the requested fields.
+
+        Parameters
+        ----------
+            - items : list
+                Item dicts of a page response
+            - fields : list
+                Columns of the output CSV
+        """
+        for item in items:
+            self.writer.writerow([formatItemValue(item.get(field)) for field in fields])
+        self.rowCount += len(items)
+        self.flush()
+
+    def flush(self):
+        chunk = self.buffer.getvalue().encode('utf-8')
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        if chunk:
+            self.downloadedFile.write(chunk)
+            for sink in self.sinks:
+                sink.feed(chunk)
+
+    def close(self):
+        self.flush()
+        for sink in self.sinks:
+            sink.close()
+
+class ChannelSplitter(object):
+    """ Download sink that writes a separate file per sales channel in the same pass as the main download. """
+    def __init__(self, downloadFilePath, channels, delimiter=',', sourceDelimiter=','):
+        """
+        Constructor function.
+
+        Parameters
+        ----------
+            - downloadFilePath : str
+                Path of the main export file, channel files are saved next to it as <name>_<channel>.csv
+            - channels : list
+                Channels (keys of CHANNELS) to write files for
+            - delimiter : str
+                Delimiter of the channel files
+            - sourceDelimiter : str
+                Delimiter of the data fed to the splitter
+        """
+        self.downloadFilePath = downloadFilePath
+        self.channels = channels
+        self.delimiter = delimiter
+        self.parser = CsvStreamParser(self.writeRow, delimiter=sourceDelimiter)
+        self.header = None
+        self.files = {}
+        self.writers = {}
+        self.columns = {}
+        self.skipIndex = {}
+        self.rowCounts = {}
+        self.skipCounts = {}
+
+    def getChannelFilePath(self, channel):
+        root, extension = os.path.splitext(self.downloadFilePath)
+        return root + '_' + channel + extension
+
+    def feed(self, chunk):
+        self.parser.feed(chunk)
+
+    def openChannelFiles(self, header):
+        """
+        Function that decides the columns of every channel file from the export header and opens the files.
+        Channel files get guid, the fields that don't belong to any channel and then the channel's own fields.
+
+        Parameters
+        ----------
+            - header : list
+                Header row of the export
+        """
+        self.header = header
+        prefixes = tuple(CHANNELS[channel]['prefix'] for channel in CHANNELS)
+        common = [i for i, name in enumerate(header) if name != 'guid' and not name.startswith(prefixes)]
+        guid = [header.index('guid')] if 'guid' in header else []
+
+        for channel in self.channels:
+            prefix = CHANNELS[channel]['prefix']
+            own = [i for i, name in enumerate(header) if name.startswith(prefix)]
+            self.columns[channel] = guid + common + own
+            skip = CHANNELS[channel]['skip']
+            self.skipIndex[channel] = header.index(skip) if skip in header else None
+            self.rowCounts[channel] = 0
+            self.skipCounts[channel] = 0
+
+            self.files[channel] = open(self.getChannelFilePath(channel), 'w', newline='', encoding='utf-8')
+            self.writers[channel] = csv.writer(self.files[channel], delimiter=self.delimiter)
+            self.writers[channel].writerow([header[i] for i in self.columns[channel]])
+
+    def writeRow(self, row):
+        if self.header is None:
+            self.openChannelFiles(row)
+            return
+
+        for channel in self.channels:
+            skipIndex = self.skipIndex[channel]
+            if skipIndex is not None and skipIndex < len(row) and isSkipSet(row[skipIndex]):
+                self.skipCounts[channel] += 1
                 continue
-            # elif resp.status_code == 422:
-            #     error_count += 1
-            #     print(' Error 422', error_count,resp.status_code, typ, url, data)
-            #     print(resp.headers)
-            #
-            #     print(resp.text)
-            #     time.sleep(60)
-            #     continue
-            else:
-                errorCount += 1
-                temp = 'Error' + ' ' + errorCount + ' ' + resp.status_code + ' ' + typ + ' ' + url + ' ' + data + '\n' + resp.text
-                LOGGER.writeLog(temp, localFrame.f_lineno, severity='error')
-                time.sleep(10)
+            self.writers[channel].writerow([row[i] if i < len(row) else '' for i in self.columns[channel]])
+            self.rowCounts[channel] += 1
+
+    def close(self):
+        localFrame = inspect.currentframe()
+        self.parser.close()
+        for channel in self.channels:
+            if channel not in self.files:
                 continue
-            break
-        # TODO: logxx
-        temp = 'Error ' + str(errorCount) + ' ' + typ + ' ' + url + ' ' + data
-        LOGGER.writeLog(temp, localFrame.f_lineno, severity='error')
-        raise LoadingError
+            self.files[channel].close()
+            LOGGER.writeLog("Saved {} rows ({} skipped) to {}".format(self.rowCounts[channel], self.skipCounts[channel], self.getChannelFilePath(channel)), localFrame.f_lineno, severity='normal')
+
+def isSkipSet(value):
+    """
+    Function that tells if a channel skip field (ebayskip, amznskip, walmartskip) is set.
+
+    Parameters
+    ----------
+        - value : str
+            Value of the skip field in the export
+    """
+    return value.strip().lower() not in ('', '0', 'false', 'no', 'n')
 
 def purge(dir, pattern, inclusive=True):
     """
@@ -918,7 +1616,7 @@ def purge(dir, pattern, inclusive=True):
         for name in files:
             path = os.path.join(root, name)
             if bool(regexObj.search(path)) == bool(inclusive):
-                if path.endswith('.csv'):
+                if path.endswith(('.csv', '.csv.idx')):
                     os.remove(path)
                     count += 1
     return count
@@ -926,6 +1624,12 @@ def purge(dir, pattern, inclusive=True):
 # Determine log file path
 LOGGER = Logger(verbose=False)
 
+# Run metrics, written to a Prometheus textfile if --metrics_file is given
+METRICS = MetricsRegistry('suredone_download')
+
+# cProfile and tracemalloc, only started with --profile
+PROFILER = Profiler()
+
 if __name__ == "__main__":
     sys.stdout = LOGGER
     sys.excepthook = LOGGER.exceptionLogger
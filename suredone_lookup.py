@@ -0,0 +1,441 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Suredone Lookup
+
+@owner: Patrick Mahoney
+@version: 1.0.0
+
+This module builds and reads a sidecar index for the CSV files saved by
+suredone_download.py. The index maps every guid to the byte offset of its
+row in the export, so a single SKU can be looked up with a binary search
+over the memory mapped index and one seek into the CSV instead of parsing
+the whole file.
+
+The index is saved next to the export as <export>.csv.idx and is laid out as:
+    - header   : magic 'SDGIDX01', number of entries, size of the CSV it was built from, delimiter
+    - entries  : (key offset, key length, row offset) per guid, sorted by guid
+    - keys     : the utf-8 encoded guids the entries point into
+
+suredone_download.py builds the index while the export is being written.
+This module can also build it for an existing export with --build.
+
+Usage:
+    $ python3 suredone_lookup.py [options] <guid> [<guid> ...]
+
+Parameters/Options:
+    -h  | --help            : View usage help and examples
+    -f  | --file            : Path to the export CSV
+        |                       - Default is the newest SureDone_Downloads_*.csv in the default download directory
+    -d  | --delimiter       : Delimiter of the export CSV when building an index
+        |                       - Default is the delimiter stored in the index, ',' when building.
+    -b  | --build           : (Re)build the index of the export before looking up
+
+Example:
+    $ python3 suredone_lookup.py ABC-123
+    $ python3 suredone_lookup.py -f [export.csv] ABC-123 XYZ-9
+    $ python3 suredone_lookup.py --file [export.csv] --build --delimiter "|" ABC-123
+"""
+
+# Help message
+HELP_MESSAGE = """
+Usage:
+    $ python3 suredone_lookup.py [options] <guid> [<guid> ...]
+
+Parameters/Options:
+    -h  | --help            : View usage help and examples
+    -f  | --file            : Path to the export CSV
+        |                       - Default is the newest SureDone_Downloads_*.csv in the default download directory
+    -d  | --delimiter       : Delimiter of the export CSV when building an index
+        |                       - Default is the delimiter stored in the index, ',' when building.
+    -b  | --build           : (Re)build the index of the export before looking up
+
+Example:
+    $ python3 suredone_lookup.py ABC-123
+    $ python3 suredone_lookup.py -f [export.csv] ABC-123 XYZ-9
+    $ python3 suredone_lookup.py --file [export.csv] --build --delimiter "|" ABC-123
+"""
+
+import sys
+import os
+import csv
+import mmap
+import glob
+import getopt
+import struct
+from os.path import expanduser
+
+INDEX_MAGIC = b'SDGIDX01'
+# Magic, number of entries, size of the indexed CSV, delimiter (padded to 8 bytes)
+HEADER_FORMAT = '<8sQQc7x'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+# Key offset in the keys blob, key length, byte offset of the row in the CSV
+ENTRY_FORMAT = '<QIQ'
+ENTRY_SIZE = struct.calcsize(ENTRY_FORMAT)
+
+def main(argv):
+    csvPath, delimiter, build, guids = parseArgs(argv)
+
+    indexPath = getIndexPath(csvPath)
+    if build or not os.path.exists(indexPath):
+        count = buildIndexFromFile(csvPath, delimiter=delimiter if delimiter else ',')
+        print ("Indexed {} rows of {}".format(count, csvPath))
+    if not guids:
+        return 0
+
+    index = GuidIndex(indexPath)
+    if index.csvSize != os.path.getsize(csvPath):
+        print ("Warning: {} changed since it was indexed, rebuild the index with --build.".format(csvPath))
+
+    writer = csv.writer(sys.stdout, delimiter=index.delimiter)
+    writer.writerow(index.readRow(csvPath, 0))
+    missing = 0
+    for guid in guids:
+        offsets = index.lookup(guid)
+        if not offsets:
+            print ("Not found: {}".format(guid), file=sys.stderr)
+            missing += 1
+        for offset in offsets:
+            writer.writerow(index.readRow(csvPath, offset))
+    index.close()
+    return 1 if missing else 0
+
+def getIndexPath(csvPath):
+    """ Function that returns the path of the sidecar index of an export CSV. """
+    return csvPath + '.idx'
+
+class GuidIndexBuilder(object):
+    """ Download sink that records the byte offset of every row and writes the guid index when closed. """
+    def __init__(self, csvPath, delimiter=','):
+        """
+        Constructor function.
+
+        Parameters
+        ----------
+            - csvPath : str
+                Path of the CSV being written, the index is saved as <csvPath>.idx
+            - delimiter : str
+                Delimiter of the CSV
+        """
+        self.csvPath = csvPath
+        self.delimiter = delimiter
+        self.offset = 0
+        self.recordStart = 0
+        self.record = []
+        self.quotes = 0
+        self.guidColumn = None
+        self.entries = []
+        self.count = 0
+
+    def feed(self, chunk):
+        """
+        Function that consumes the next chunk of the CSV exactly as it is written to disk.
+        A record ends at a new line outside of quotes, where the next record's offset starts.
+
+        Parameters
+        ----------
+            - chunk : bytes
+                Next chunk of the CSV file
+        """
+        start = 0
+        while True:
+            end = chunk.find(b'\n', start)
+            if end == -1:
+                if start < len(chunk):
+                    self.record.append(chunk[start:])
+                    self.quotes += chunk.count(b'"', start)
+                break
+            self.record.append(chunk[start:end + 1])
+            self.quotes += chunk.count(b'"', start, end)
+            start = end + 1
+            if self.quotes % 2 == 0:
+                self.endRecord(self.offset + start)
+        self.offset += len(chunk)
+
+    def endRecord(self, nextRecordStart):
+        record = b''.join(self.record)
+        self.record = []
+        self.quotes = 0
+        recordStart = self.recordStart
+        self.recordStart = nextRecordStart
+        if not record.strip():
+            return
+
+        row = next(csv.reader([record.decode('utf-8', errors='replace')], delimiter=self.delimiter), [])
+        if self.guidColumn is None:
+            self.guidColumn = row.index('guid') if 'guid' in row else 0
+            return
+        if self.guidColumn < len(row):
+            self.entries.append((row[self.guidColumn].encode('utf-8'), recordStart))
+
+    def close(self):
+        """
+        Function that indexes the last row (if the file didn't end with a new line) and writes the index.
+
+        Returns
+        -------
+            - count : int
+                Number of indexed rows
+        """
+        if self.record:
+            self.endRecord(self.offset)
+        self.entries.sort()
+        writeIndex(getIndexPath(self.csvPath), self.entries, self.offset, self.delimiter)
+        self.count = len(self.entries)
+        self.entries = []
+        return self.count
+
+def writeIndex(indexPath, entries, csvSize, delimiter):
+    """
+    Function that writes sorted (guid, offset) entries to an index file.
+    The file is written next to the target and renamed, so readers never see a partial index.
+
+    Parameters
+    ----------
+        - indexPath : str
+            Path of the index file
+        - entries : list
+            (utf-8 guid, row offset) tuples sorted by guid
+        - csvSize : int
+            Size in bytes of the indexed CSV
+        - delimiter : str
+            Delimiter of the indexed CSV
+    """
+    temp = indexPath + '.tmp'
+    with open(temp, 'wb') as indexFile:
+        indexFile.write(struct.pack(HEADER_FORMAT, INDEX_MAGIC, len(entries), csvSize, delimiter.encode('utf-8')))
+        keyOffset = 0
+        for key, rowOffset in entries:
+            indexFile.write(struct.pack(ENTRY_FORMAT, keyOffset, len(key), rowOffset))
+            keyOffset += len(key)
+        for key, rowOffset in entries:
+            indexFile.write(key)
+    os.replace(temp, indexPath)
+
+def buildIndexFromFile(csvPath, delimiter=','):
+    """
+    Function that builds the index of an export that is already on disk.
+
+    Parameters
+    ----------
+        - csvPath : str
+            Path of the export CSV
+        - delimiter : str
+            Delimiter of the export CSV
+
+    Returns
+    -------
+        - count : int
+            Number of indexed rows
+    """
+    builder = GuidIndexBuilder(csvPath, delimiter=delimiter)
+    with open(csvPath, 'rb') as csvFile:
+        for chunk in iter(lambda: csvFile.read(1 << 20), b''):
+            builder.feed(chunk)
+    return builder.close()
+
+class GuidIndex(object):
+    """ Read-only guid index, memory mapped so a lookup only touches the pages of its binary search. """
+    def __init__(self, indexPath):
+        """
+        Constructor function.
+
+        Parameters
+        ----------
+            - indexPath : str
+                Path of the index file
+        """
+        self.indexFile = open(indexPath, 'rb')
+        self.map = mmap.mmap(self.indexFile.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, self.csvSize, delimiter = struct.unpack_from(HEADER_FORMAT, self.map, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError('{} is not a guid index.'.format(indexPath))
+        self.delimiter = delimiter.decode('utf-8')
+        self.keysStart = HEADER_SIZE + self.count * ENTRY_SIZE
+
+    def getEntry(self, position):
+        keyOffset, keyLength, rowOffset = struct.unpack_from(ENTRY_FORMAT, self.map, HEADER_SIZE + position * ENTRY_SIZE)
+        start = self.keysStart + keyOffset
+        return self.map[start:start + keyLength], rowOffset
+
+    def lookup(self, guid):
+        """
+        Function that finds the rows of a guid with a binary search over the sorted entries.
+
+        Parameters
+        ----------
+            - guid : str
+                The guid to look up
+
+        Returns
+        -------
+            - offsets : list
+                Byte offsets of the guid's rows in the CSV, empty if the guid isn't in the export
+        """
+        key = guid.encode('utf-8')
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.getEntry(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        offsets = []
+        while low < self.count:
+            entryKey, rowOffset = self.getEntry(low)
+            if entryKey != key:
+                break
+            offsets.append(rowOffset)
+            low += 1
+        return offsets
+
+    def readRow(self, csvPath, offset):
+        """
+        Function that reads the single row starting at a byte offset of the CSV.
+
+        Parameters
+        ----------
+            - csvPath : str
+                Path of the indexed CSV
+            - offset : int
+                Byte offset of the row
+
+        Returns
+        -------
+            - row : list
+                Values of the row
+        """
+        with open(csvPath, 'rb') as csvFile:
+            return self.readRowFrom(csvFile, offset)
+
+    def readRowFrom(self, csvFile, offset):
+        """
+        Function that reads the single row starting at a byte offset from an open CSV file,
+        for callers that look up many rows and keep the file open.
+
+        Parameters
+        ----------
+            - csvFile : file
+                The indexed CSV opened in binary mode
+            - offset : int
+                Byte offset of the row
+
+        Returns
+        -------
+            - row : list
+                Values of the row
+        """
+        csvFile.seek(offset)
+        lines = []
+        quotes = 0
+        while True:
+            line = csvFile.readline()
+            if not line:
+                break
+            lines.append(line)
+            quotes += line.count(b'"')
+            if quotes % 2 == 0:
+                break
+        record = b''.join(lines).decode('utf-8', errors='replace')
+        return next(csv.reader([record], delimiter=self.delimiter), [])
+
+    def close(self):
+        self.map.close()
+        self.indexFile.close()
+
+def getDownloadDirectory():
+    """ Function that returns the default download directory of suredone_download.py. """
+    if sys.platform == 'win32' or sys.platform == 'win64': # Windows
+        return os.path.join(os.path.expandvars(r'%USERPROFILE%'), 'Downloads')
+    return os.path.join(expanduser('~'), 'downloads')
+
+def getLatestExport(directory=None):
+    """
+    Function that returns the newest full export (not a channel file) of suredone_download.py.
+
+    Parameters
+    ----------
+        - directory : str
+            Directory to search, the default download directory if None
+
+    Returns
+    -------
+        - path : str
+            Path of the newest export, None if there is none
+    """
+    directory = directory or getDownloadDirectory()
+    exports = [path for path in glob.glob(os.path.join(directory, 'SureDone_Downloads_*.csv')) if not path.endswith(('_ebay.csv', '_amazon.csv', '_walmart.csv'))]
+    if not exports:
+        return None
+    return max(exports, key=os.path.getmtime)
+
+def getDefaultExportPath():
+    """
+    Function that returns the newest export in the default download directory of suredone_download.py.
+    """
+    path = getLatestExport()
+    if path is None:
+        print ("Error: No SureDone_Downloads_*.csv found in {}. Use -f or --file to define the export path.".format(getDownloadDirectory()))
+        sys.exit(3)
+    return path
+
+def parseArgs(argv):
+    """
+    Function that parses the arguments sent from the command line.
+
+    Parameters
+    ----------
+        - argv : str
+            Arguments sent through the command line
+
+    Returns
+    -------
+        - csvPath : str
+            Path of the export CSV
+        - delimiter : str
+            Delimiter given on the command line, empty if not given
+        - build : bool
+            Whether to (re)build the index first
+        - guids : list
+            The guids to look up
+    """
+    options = "hf:d:b"
+    long_options = ["help", "file=", "delimiter=", "build"]
+
+    csvPath = ''
+    delimiter = ''
+    build = False
+
+    try:
+        opts, args = getopt.getopt(argv, options, long_options)
+    except getopt.GetoptError:
+        print ("Error in arguments!")
+        print (HELP_MESSAGE)
+        sys.exit(2)
+
+    for option, value in opts:
+        if option in ("-h", "--help"):
+            print (HELP_MESSAGE)
+            sys.exit()
+        elif option in ("-f", "--file"):
+            csvPath = value
+        elif option in ("-d", "--delimiter"):
+            delimiter = '\t' if value == '\\t' else value
+        elif option in ("-b", "--build"):
+            build = True
+
+    if not csvPath:
+        csvPath = getDefaultExportPath()
+    elif not os.path.exists(csvPath):
+        print ("Error: The file you specified does not exist. Please recheck the path.")
+        sys.exit(3)
+
+    if not args and not build:
+        print ("Error: At least one guid to look up is necessary.")
+        print (HELP_MESSAGE)
+        sys.exit(2)
+    return csvPath, delimiter, build, args
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Suredone Metrics
+
+@owner: Patrick Mahoney
+@version: 1.0.0
+
+This module collects counters and histograms during a download or upload run
+and writes them in the Prometheus textfile-collector format, so node_exporter
+can scrape them from its textfile directory.
+
+Every metric name is prefixed with the name of the script that collected it:
+    - <prefix>_api_calls_total                  (endpoint, status)
+    - <prefix>_api_retries_total                (endpoint)
+    - <prefix>_api_call_duration_seconds        (endpoint)      histogram
+    - <prefix>_rate_limit_sleep_seconds_total
+    - <prefix>_bytes_downloaded_total
+    - <prefix>_bytes_uploaded_total
+    - <prefix>_rows_exported_total
+    - <prefix>_bulk_processing_seconds                          histogram
+    - <prefix>_bulk_result_rows_total           (result)
+    - <prefix>_stage_duration_seconds           (stage)         histogram
+    - <prefix>_last_run_timestamp_seconds                       gauge
+    - <prefix>_last_run_success                                 gauge
+
+Usage:
+    METRICS = MetricsRegistry('suredone_download')
+    METRICS.incCounter('api_calls_total', labels={'endpoint': 'bulk/exports', 'status': '200'})
+    with METRICS.timeStage('download'):
+        ...
+    METRICS.writeTextfile('/var/lib/node_exporter/textfile/suredone_download.prom')
+"""
+
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+# Help text and type of every known metric (without prefix)
+DESCRIPTIONS = {
+    'api_calls_total': ('counter', 'SureDone API calls by endpoint and HTTP status.'),
+    'api_retries_total': ('counter', 'SureDone API calls that were retried.'),
+    'api_call_duration_seconds': ('histogram', 'Duration of single SureDone API requests.'),
+    'rate_limit_sleep_seconds_total': ('counter', 'Seconds spent sleeping after HTTP 429 responses.'),
+    'bytes_downloaded_total': ('counter', 'Bytes received from SureDone.'),
+    'bytes_uploaded_total': ('counter', 'Bytes sent to SureDone in bulk files.'),
+    'rows_exported_total': ('counter', 'Rows written to the export file.'),
+    'bulk_processing_seconds': ('histogram', 'Time from submitting a bulk file until its result file was available.'),
+    'bulk_result_rows_total': ('counter', 'Rows of the bulk result files by result.'),
+    'stage_duration_seconds': ('histogram', 'Duration of the named stages of the run.'),
+    'last_run_timestamp_seconds': ('gauge', 'Unix time at which the run finished.'),
+    'last_run_success': ('gauge', '1 if the run finished successfully, 0 otherwise.')
+}
+
+# Histogram buckets in seconds, from single requests up to full runs
+DEFAULT_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+class MetricsRegistry(object):
+    """ Thread safe store of the counters, gauges and histograms of one run. """
+    def __init__(self, prefix):
+        """
+        Constructor function.
+
+        Parameters
+        ----------
+            - prefix : str
+                Prefix of every metric name, e.g. 'suredone_download'
+        """
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.values = {}
+        self.histograms = {}
+
+    def getKey(self, name, labels):
+        return (name, tuple(sorted(labels.items())) if labels else ())
+
+    def incCounter(self, name, value=1, labels=None):
+        """
+        Function that increments a counter.
+
+        Parameters
+        ----------
+            - name : str
+                Metric name without prefix
+            - value : float
+                Amount to add
+            - labels : dict
+                Label names and values
+        """
+        key = self.getKey(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def setGauge(self, name, value, labels=None):
+        key = self.getKey(name, labels)
+        with self.lock:
+            self.values[key] = value
+
+    def observe(self, name, value, labels=None, buckets=DEFAULT_BUCKETS):
+        """
+        Function that records one observation in a histogram.
+
+        Parameters
+        ----------
+            - name : str
+                Metric name without prefix
+            - value : float
+                Observed value
+            - labels : dict
+                Label names and values
+            - buckets : tuple
+                Upper bounds of the histogram buckets, used when the series is created
+        """
+        key = self.getKey(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+                self.histograms[key] = histogram
+            for i, bound in enumerate(histogram['buckets']):
+                if value <= bound:
+                    histogram['counts'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextmanager
+    def timeStage(self, stage):
+        """
+        Context manager that records the duration of a named stage in stage_duration_seconds.
+
+        Parameters
+        ----------
+            - stage : str
+                Name of the stage
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe('stage_duration_seconds', time.time() - start, labels={'stage': stage})
+
+    def render(self):
+        """
+        Function that renders all metrics in the Prometheus text exposition format.
+
+        Returns
+        -------
+            - text : str
+                Metrics text, one sample per line
+        """
+        with self.lock:
+            series = {}
+            for (name, labels), value in sorted(self.values.items()):
+                series.setdefault(name, []).append(formatSample(self.prefix + '_' + name, labels, value))
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                fullName = self.prefix + '_' + name
+                lines = series.setdefault(name, [])
+                for bound, count in zip(histogram['buckets'], histogram['counts']):
+                    lines.append(formatSample(fullName + '_bucket', labels + (('le', formatValue(bound)),), count))
+                lines.append(formatSample(fullName + '_bucket', labels + (('le', '+Inf'),), histogram['count']))
+                lines.append(formatSample(fullName + '_sum', labels, histogram['sum']))
+                lines.append(formatSample(fullName + '_count', labels, histogram['count']))
+
+        text = []
+        for name in sorted(series):
+            metricType, description = DESCRIPTIONS.get(name, ('untyped', name))
+            text.append('# HELP {}_{} {}'.format(self.prefix, name, description))
+            text.append('# TYPE {}_{} {}'.format(self.prefix, name, metricType))
+            text.extend(series[name])
+        return '\n'.join(text) + '\n'
+
+    def writeTextfile(self, path):
+        """
+        Function that writes the metrics to a .prom file for the node_exporter textfile collector.
+        The file is written next to the target and renamed, so the collector never reads a partial file.
+
+        Parameters
+        ----------
+            - path : str
+                Path of the .prom file
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp = path + '.' + str(os.getpid()) + '.tmp'
+        with open(temp, 'w') as textfile:
+            textfile.write(self.render())
+        os.replace(temp, path)
+
+def getEndpointLabel(endpoint):
+    """
+    Function that reduces an API endpoint to a label with bounded cardinality.
+    File names and search queries are cut off, e.g. 'bulk/exports/<file>' becomes 'bulk/exports'.
+
+    Parameters
+    ----------
+        - endpoint : str
+            Endpoint relative to the API root
+    """
+    return '/'.join(endpoint.strip('/').split('/')[:2])
+
+def formatValue(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return str(value)
+
+def formatSample(name, labels, value):
+    if labels:
+        pairs = ','.join('{}="{}"'.format(key, escapeLabel(val)) for key, val in labels)
+        return '{}{{{}}} {}'.format(name, pairs, formatValue(value))
+    return '{} {}'.format(name, formatValue(value))
+
+def escapeLabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,242 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+Suredone Profiler
+
+@owner: Patrick Mahoney
+@version: 1.0.0
+
+This module implements the --profile option shared by suredone_download.py,
+suredone_upload.py and reference.py. When enabled it runs cProfile and
+tracemalloc for the whole script and records time, current and peak Python
+memory and the resident memory (RSS) of the process at the end of every named
+stage. At the end it writes, next to the script's log:
+    - <base>.prof            : cProfile stats dump (open with pstats or snakeviz)
+    - <base>_profile.txt     : the most expensive functions by cumulative time
+    - <base>_memory.txt      : per-stage time and memory plus the top allocation sites
+
+Started with cpu=False it only traces memory (reference.py --memstats), the
+memory report is then taken with formatMemory() and finish() writes no files.
+
+cProfile only sees the thread that started it, work done in thread pools shows
+up as time spent waiting on their futures. tracemalloc has a single peak for
+the whole process, so only stages entered from the main thread measure memory;
+stages entered from worker threads (e.g. concurrent uploads) only record their
+duration and are listed with a [thread] suffix.
+
+tracemalloc.reset_peak() is new in Python 3.9. On older versions the peak can't
+be reset between stages, so the peak of a stage is the peak since tracing
+started and may come from an earlier stage; the memory report says so.
+
+Usage:
+    PROFILER = Profiler()
+    PROFILER.start()
+    with PROFILER.stage('download'):
+        ...
+    PROFILER.finish('/home/user/log/suredone_download_2020_01_01-00-00-00')
+"""
+
+import io
+import os
+import sys
+import time
+import threading
+import cProfile
+import pstats
+import tracemalloc
+from contextlib import contextmanager
+
+# resource is not available on Windows, the peak RSS is then not reported
+try:
+    import resource
+except ImportError:
+    resource = None
+
+class Profiler(object):
+    """ cProfile and tracemalloc wrapper that does nothing until it is started. """
+    def __init__(self, topN=25):
+        """
+        Constructor function.
+
+        Parameters
+        ----------
+            - topN : int
+                Number of functions and allocation sites listed in the reports
+        """
+        self.topN = topN
+        self.enabled = False
+        self.profile = None
+        self.stages = []
+        self.openStages = []
+        self.stageSites = 0
+        self.sites = []
+        self.lock = threading.Lock()
+
+    def start(self, cpu=True, stageSites=0):
+        """
+        Function that starts profiling and memory tracing.
+
+        Parameters
+        ----------
+            - cpu : bool
+                Whether to run cProfile too, or only trace memory
+            - stageSites : int
+                Number of allocation sites still allocated at the end of every stage that are
+                listed in the memory report, 0 to only list them at the end
+        """
+        self.enabled = True
+        self.stageSites = stageSites
+        tracemalloc.start()
+        if cpu:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager that records the duration, the traced memory at its start and end, the
+        peak traced memory and the current and peak RSS at the end of a named stage.
+        Stages may be nested, the peak of an inner stage also counts for the outer ones.
+        Stages entered from other threads than the main thread only record their duration,
+        they must not reset the process wide peak of the main thread's stages.
+
+        Parameters
+        ----------
+            - name : str
+                Name of the stage
+        """
+        if not self.enabled:
+            yield
+            return
+
+        if threading.current_thread() is not threading.main_thread():
+            start = time.time()
+            try:
+                yield
+            finally:
+                with self.lock:
+                    self.stages.append((name + ' [thread]', time.time() - start, None, None, None, None, None))
+            return
+
+        with self.lock:
+            # Carry the peak seen so far over to the open stages before resetting it
+            current, peak = tracemalloc.get_traced_memory()
+            for entry in self.openStages:
+                entry['peak'] = max(entry['peak'], peak)
+            resetPeak()
+
+            entry = {'name': name, 'start': time.time(), 'startMemory': current, 'peak': current}
+            self.openStages.append(entry)
+        try:
+            yield
+        finally:
+            with self.lock:
+                current, peak = tracemalloc.get_traced_memory()
+                entry['peak'] = max(entry['peak'], peak)
+                self.openStages.remove(entry)
+                for outer in self.openStages:
+                    outer['peak'] = max(outer['peak'], entry['peak'])
+                self.stages.append((name, time.time() - entry['start'], entry['startMemory'], current, entry['peak'], getRss(), getPeakRss()))
+                if self.stageSites:
+                    self.sites.append((name, tracemalloc.take_snapshot().statistics('lineno')[:self.stageSites]))
+
+    def finish(self, basePath):
+        """
+        Function that stops profiling and writes the reports. Without cProfile (see start())
+        it only stops tracing memory.
+
+        Parameters
+        ----------
+            - basePath : str
+                Path prefix of the report files, usually the log file path without extension
+
+        Returns
+        -------
+            - paths : list
+                Paths of the written files, empty if the profiler wasn't started
+        """
+        if not self.enabled:
+            return []
+        self.enabled = False
+        if self.profile is None:
+            tracemalloc.stop()
+            return []
+        self.profile.disable()
+
+        statsPath = basePath + '.prof'
+        self.profile.dump_stats(statsPath)
+
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=stream)
+        stats.sort_stats('cumulative').print_stats(self.topN)
+        profilePath = basePath + '_profile.txt'
+        with open(profilePath, 'w') as profileFile:
+            profileFile.write(stream.getvalue())
+
+        memoryPath = basePath + '_memory.txt'
+        memoryReport = self.formatMemory()
+        tracemalloc.stop()
+        with open(memoryPath, 'w') as memoryFile:
+            memoryFile.write(memoryReport)
+        return [statsPath, profilePath, memoryPath]
+
+    def formatMemory(self):
+        """
+        Function that returns the memory report: the stages, the memory now and the top
+        allocation sites of the memory that is still allocated.
+        """
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [self.formatStages()]
+        if not hasattr(tracemalloc, 'reset_peak'):
+            lines.append('Peaks are the peaks since tracing started, Python before 3.9 can not reset them between stages.\n')
+        lines.append('Current memory at exit: {}; Peak of the last stage onwards: {}; RSS: {}; Peak RSS: {}\n'.format(
+            formatBytes(current), formatBytes(peak), formatBytes(getRss()), formatBytes(getPeakRss())))
+        for name, statistics in self.sites:
+            lines.append('Top {} allocation sites at the end of {}'.format(self.stageSites, name))
+            lines.append('=' * 60)
+            lines.extend('{}'.format(statistic) for statistic in statistics)
+            lines.append('')
+        lines.append('Top {} allocation sites at exit'.format(self.topN))
+        lines.append('=' * 60)
+        for statistic in snapshot.statistics('lineno')[:self.topN]:
+            lines.append('{}'.format(statistic))
+        return '\n'.join(lines) + '\n'
+
+    def formatStages(self):
+        lines = ['{:<24}|{:>12} |{:>12} |{:>12} |{:>12} |{:>12} |{:>12}'.format('Stage', 'Seconds', 'Start', 'End', 'Peak', 'RSS', 'Peak RSS')]
+        lines.append('=' * len(lines[0]))
+        for name, elapsed, startMemory, endMemory, peak, rss, peakRss in self.stages:
+            lines.append('{:<24}|{:>12.3f} |{:>12} |{:>12} |{:>12} |{:>12} |{:>12}'.format(name, elapsed, formatBytes(startMemory), formatBytes(endMemory), formatBytes(peak),
+                                                                                          formatBytes(rss), formatBytes(peakRss)))
+        return '\n'.join(lines) + '\n'
+
+def resetPeak():
+    """
+    Function that resets the peak traced memory to the current memory. Python before 3.9 has no
+    tracemalloc.reset_peak(), the peak then stays the peak since tracing started.
+    """
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+
+def getRss():
+    """ Function that returns the resident memory of this process in bytes, None where /proc is not available. """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+def getPeakRss():
+    """ Function that returns the peak resident memory of this process in bytes, None without the resource module. """
+    if resource is None:
+        return None
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere, and counts a little less than /proc
+    peakRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return max(peakRss, getRss() or 0)
+
+def formatBytes(size):
+    """ Function that formats a byte count in MB with two decimals, '-' if it is not known. """
+    if size is None:
+        return '-'
+    return '{:.2f}MB'.format(size / 10**6)
@@ -9,12 +9,47 @@ Last update: 2019.05.03
 import argparse
 import os
 import sys
+import csv
+import re
+import json
+import shutil
 import logging
 import datetime
+import time
+import uuid
+import zlib
+import glob
+import heapq
+import hashlib
+import codecs
+import threading
+import atexit
+from array import array
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 # requests module
 import requests
 
+# numpy module
+import numpy as np
+
+# run metrics (Prometheus textfile format)
+from suredone_metrics import MetricsRegistry, getEndpointLabel
+from suredone_profiler import Profiler
+from suredone_lookup import GuidIndex, getIndexPath, getLatestExport
+
+# SureDone API client and credentials file reader shared with suredone_download.py
+from suredone_client import SureDone, loadConfig
+
+METRICS = MetricsRegistry('suredone_upload')
+PROFILER = Profiler()
+RUN_START = time.time()
+
+# Columns of the export that hold numbers, their values are compared by value when diffing
+NUMERIC_COLUMNS = ('price', 'stock', 'cost', 'msrp', 'weight')
+# A number written the plain way, without leading zeros (a value like 012345 is an id, not a number)
+PLAIN_DECIMAL = re.compile(r'-?(0|[1-9][0-9]*)(\.[0-9]+)?$')
 
 
 def get_default_paths():
@@ -47,9 +82,12 @@ def get_default_paths():
 
 
 
-def get_args():
+def get_args(argv=None):
     """Parses the arguments and values from the script user.
 
+    Parameters:
+        argv: Arguments to parse instead of the command line (used by reference.py --upload)
+
     Returns:
         Object with arguments (input file, credentials file, log directory, verbose logging, email, selections)
     """
@@ -94,6 +132,116 @@ def get_args():
         default='mikesautoparts',
         help='name used from SureDone to identify your application to the API for logging (default=mikesautoparts)'
     )
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=600,
+        help='connect and read timeout of the API requests in seconds (default=600)'
+    )
+    parser.add_argument(
+        '--retries',
+        type=int,
+        default=3,
+        help='number of times an upload is retried when it could not have been submitted: a failed connection, HTTP 429 '\
+             'or HTTP 503 with a Retry-After header (default=3)'
+    )
+    parser.add_argument(
+        '--rate_limit',
+        type=float,
+        default=0,
+        help='highest number of API requests per second, shared by all workers (default=0, no limit; '\
+             'HTTP 429 responses still pause all requests until the limit resets)'
+    )
+    parser.add_argument(
+        '--input_glob',
+        type=str,
+        default=None,
+        help='batch mode: upload every file matching this glob pattern, or every .csv file if a directory is given, '\
+             'instead of a single --input_file'
+    )
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='with --input_glob, keep polling for new or changed files and upload them until interrupted (Ctrl+C)'
+    )
+    parser.add_argument(
+        '--poll_interval',
+        type=float,
+        default=30,
+        help='seconds between two polls of --input_glob in watch mode (default=30). '\
+             'A file is uploaded once its size and modification time are the same in two polls.'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=4,
+        help='number of files uploaded at the same time in batch mode (default=4)'
+    )
+    parser.add_argument(
+        '--split_parts',
+        type=int,
+        default=1,
+        help='split the input file into this many parts and upload them as separate bulk jobs (default=1, no split). '\
+             'The header is repeated in every part and all rows of a guid stay in the same part.'
+    )
+    parser.add_argument(
+        '--max_concurrent',
+        type=int,
+        default=4,
+        help='number of parts uploaded at the same time when the input file is split (default=4)'
+    )
+    parser.add_argument(
+        '--skip_validation',
+        action='store_true',
+        help='upload without checking the input file first. By default the file is checked in one streaming pass '\
+             '(action and guid headers, column count, UTF-8 encoding) and not uploaded if it has errors. Duplicate guids '\
+             'are only reported, since several rows of a guid are legitimate'
+    )
+    parser.add_argument(
+        '--reject_duplicates',
+        action='store_true',
+        help='treat duplicate guids found by the validation as an error and do not upload the file'
+    )
+    parser.add_argument(
+        '--validation_report',
+        type=str,
+        default=None,
+        help='write the validation report to this path (default: <input file name>_validation.txt in the log directory, '\
+             'only written when the file has errors or duplicate guids)'
+    )
+    parser.add_argument(
+        '--diff_against',
+        type=str,
+        default=None,
+        help='compare the edit rows with an export of suredone_download.py (path, or "latest" for the newest export in the '\
+             'download directory) and upload only the rows and columns that differ from it. Rows with other actions and '\
+             'guids that are not in the export are uploaded as they are. The guid index (.idx) of the export is used if it exists'
+    )
+    parser.add_argument(
+        '--diff_delimiter',
+        type=str,
+        default=',',
+        help='delimiter of the export used by --diff_against when it has no guid index (default=,)'
+    )
+    parser.add_argument(
+        '--fetch_results',
+        action='store_true',
+        help='after uploading, poll SureDone for the result file of every bulk job, download it to the log directory '\
+             'and count the rows that succeeded and failed. The script exits with status 1 if any row failed or a result '\
+             'file has no result/status column to tell.'
+    )
+    parser.add_argument(
+        '--result_timeout',
+        type=float,
+        default=3600,
+        help='seconds to wait for the result files before giving up (default=3600)'
+    )
+    parser.add_argument(
+        '--metrics_file',
+        type=str,
+        default=None,
+        help='write run metrics in Prometheus textfile-collector format to this path when the script ends (e.g. /var/lib/node_exporter/textfile/suredone_upload.prom)'
+    )
 
     # add list type argument
     parser.add_argument(
@@ -119,8 +267,12 @@ def get_args():
         '--preserve',
         action='store_true',
         help='preserve the input file after successfully uploading (without this arg the input file is removed after successfully uploading)')
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='profile the run with cProfile and tracemalloc, the reports (.prof, _profile.txt, _memory.txt) are written to the log directory')
     
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 
 
@@ -177,7 +329,7 @@ def create_logger(args):
 
 
 def get_credentials(args, logger):
-    """Parses the credentials yaml file and gets user and token (simple yaml parser, key-value parser).
+    """Parses the credentials yaml file and gets user and token (with the reader shared with suredone_download.py).
 
     Parameters:
         args: Object with command line arguments (credentials file)
@@ -187,33 +339,35 @@ def get_credentials(args, logger):
         Credentials, user and token.
     """
 
-    data = {}
+    logger('Reading the credentials file')
+    user, token = loadConfig(args.credentials_file)
+    logger('The credentials are read successfully')
+        
+    return {'user': user, 'token': token}
 
-    with open(args.credentials_file, 'r') as credentials_file:
-        logger('Reading the credentials file')
 
-        # parse line by line
-        for line in credentials_file.readlines():
 
-            # ignore comments
-            if line.startswith('#'):
-                continue
+def create_client(args, credentials, logger):
+    """Creates the SureDone API client of the run.
 
-            # split the line and take the key and value
-            values = line.split(':')
-            key = values[0].strip()
-            value = values[1].strip()
-            data[key] = value
-    
-    if not 'user' in data:
-        raise Exception('There is no user found in the credentials file')
+    The client's session keeps enough connections open for all upload workers and the result poller.
 
-    if not 'token' in data:
-        raise Exception('There is no token found in the credentials file')
-        
-    logger('The credentials are read successfully')
-        
-    return data
+    Parameters:
+        args: Object with command line arguments (name_integration, timeout, rate_limit, workers, max_concurrent)
+        credentials: Credentials for the API (user and token)
+        logger: Function used for logging
+    """
+
+    return SureDone(
+        credentials['user'],
+        credentials['token'],
+        args.timeout,
+        integration=args.name_integration,
+        rateLimit=args.rate_limit,
+        poolSize=max(args.workers, 1) * max(args.max_concurrent, 1) + ResultPoller.workers,
+        metrics=METRICS,
+        logger=lambda message, line_number, severity='normal': logger(message)
+    )
 
 
 
@@ -249,24 +403,148 @@ def construct_input_file_path(args, logger):
     
 
 
-def suredone_upload(args, credentials, logger, input_file_path):
+class MultipartFileStream(object):
+    """File-like multipart/form-data body with a single file field that is read from disk while it is sent.
+
+    requests streams file-like bodies in small blocks, so the memory used by an upload
+    doesn't depend on the size of the file. The total length is known up front, so the
+    request is sent with a Content-Length header like a regular form post.
+    """
+
+    def __init__(self, field_name, file_name, input_file, file_size, logger, report_every=10):
+        """
+        Parameters:
+            field_name: Name of the form field
+            file_name: File name sent in the Content-Disposition header
+            input_file: File object opened in binary mode, positioned at the start of the data
+            file_size: Number of bytes of the file to send
+            logger: Function used for logging the progress
+            report_every: Progress is logged every this many percent
+        """
+
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary={0}'.format(self.boundary)
+        self.preamble = (
+            '--{0}\r\n'
+            'Content-Disposition: form-data; name="{1}"; filename="{2}"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n'
+        ).format(self.boundary, field_name, file_name).encode('utf-8')
+        self.epilogue = '\r\n--{0}--\r\n'.format(self.boundary).encode('utf-8')
+
+        self.input_file = input_file
+        self.file_size = file_size
+        self.file_remaining = file_size
+        self.len = len(self.preamble) + file_size + len(self.epilogue)
+
+        self.logger = logger
+        self.report_every = report_every
+        self.next_report = report_every
+        self.bytes_sent = 0
+        self.start_time = None
+
+    def __len__(self):
+        return self.len
+
+    def read(self, size=-1):
+        """Returns the next part of the body (preamble, file data, epilogue) of at most size bytes."""
+
+        if self.start_time is None:
+            self.start_time = time.time()
+        if size is None or size < 0:
+            size = self.len
+
+        data = b''
+        if self.preamble:
+            data, self.preamble = self.preamble[:size], self.preamble[size:]
+        if len(data) < size and self.file_remaining > 0:
+            chunk = self.input_file.read(min(size - len(data), self.file_remaining))
+            self.file_remaining -= len(chunk)
+            if not chunk and self.file_remaining > 0:
+                raise IOError('The input file ended {0} bytes early'.format(self.file_remaining))
+            data += chunk
+        if len(data) < size and self.file_remaining == 0 and self.epilogue:
+            tail, self.epilogue = self.epilogue[:size - len(data)], self.epilogue[size - len(data):]
+            data += tail
+
+        self.bytes_sent += len(data)
+        self.report_progress()
+        return data
+
+    def report_progress(self):
+        """Logs the progress and throughput each time another report_every percent has been sent."""
+
+        percent = 100 if self.len == 0 else self.bytes_sent * 100 // self.len
+        if percent < self.next_report:
+            return
+        self.next_report = (percent // self.report_every + 1) * self.report_every
+
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        self.logger('Uploaded {0}% ({1:.2f} of {2:.2f} MB, {3:.2f} MB/s)'.format(
+            percent,
+            self.bytes_sent / 10**6,
+            self.len / 10**6,
+            self.bytes_sent / 10**6 / elapsed)
+        )
+
+    def get_throughput(self):
+        """Returns the average upload throughput in bytes per second."""
+
+        if self.start_time is None:
+            return 0
+        return self.bytes_sent / max(time.time() - self.start_time, 1e-6)
+
+
+
+def suredone_upload(args, client, logger, input_file_path):
     """The function with the main logic for this script.
 
     Parameters:
         args: Object with command line arguments 
-        credentials: Credentials for the API (user and token)
+        client: SureDone API client
         logger: Function used for logging
         input_file_path: Input file path
+
+    Returns:
+        The JSON response of a successful upload (request_file, result_file, ...) with the bulk_name that was sent.
     """
 
-    url = 'https://api.suredone.com/v1/bulk'
-    
-    headers = {
-        # no need from Content-Type: multipart/form-data, the post method is adding that
-        'X-Auth-Integration': args.name_integration,
-        'X-Auth-User': credentials['user'],
-        'X-Auth-Token': credentials['token']
-    }
+    input_file_basename = os.path.basename(input_file_path)
+    bulk_name = os.path.splitext(input_file_basename)[0]
+
+    with open(input_file_path, 'rb') as input_file: # the file is streamed from disk while uploading
+        return post_bulk_file(args, client, logger, input_file, os.path.getsize(input_file_path), bulk_name)
+
+
+
+def get_retry_after(response):
+    """Returns the seconds of the Retry-After header of a response, None if it has none."""
+
+    try:
+        return max(float(response.headers['Retry-After']), 0)
+    except (KeyError, ValueError):
+        return None
+
+
+
+def post_bulk_file(args, client, logger, input_file, input_file_size, bulk_name):
+    """Posts a bulk file to SureDone from a binary file object, a file on disk or an in-memory io.BytesIO.
+
+    Only failures after which SureDone can't have started the job are retried, up to --retries times:
+    a connection that failed before any byte was sent, HTTP 429 (the client waits until the rate
+    limit resets) and HTTP 503 with a Retry-After header. Read timeouts and other server errors are
+    not retried, the job may have been submitted. The file is sent again from the start.
+
+    Parameters:
+        args: Object with command line arguments (email, selections, retries)
+        client: SureDone API client
+        logger: Function used for logging
+        input_file: File object opened in binary mode, positioned at the start of the data
+        input_file_size: Number of bytes to send
+        bulk_name: Name of the bulk job
+
+    Returns:
+        The JSON response of a successful upload (request_file, result_file, ...) with the bulk_name that was sent.
+    """
 
     params = {
         'sd_bulk_email': args.email
@@ -276,26 +554,58 @@ def suredone_upload(args, credentials, logger, input_file_path):
     for param in args.selections:
         params[param] = 'on' # 'on' is a default value when submitting a form
 
-    files = {}
-
-    with open(input_file_path, 'rb') as input_file: # works with r and rb
-        logger('Reading the input file')
-
-        input_file_data = input_file.read()
-        input_file_basename = os.path.basename(input_file.name)
-        input_file_name = os.path.splitext(input_file_basename)[0]
-
-        files['bulk_file'] = input_file_data
-        params['bulk_name'] = input_file_name
-
-    logger('Uploading the input file')
-
-    response = requests.post(
-        url, 
-        files=files, 
-        headers=headers, 
-        params=params
-    )
+    params['bulk_name'] = bulk_name
+    start = input_file.tell()
+
+    attempt = 0
+    while True:
+        attempt += 1
+        with run_stage('upload'):
+            input_file.seek(start)
+            logger('Uploading the input file ({0:.2f} MB)'.format(input_file_size / 10**6))
+
+            # the field name was used as the file name when the file was posted as bytes, keep sending it that way
+            body = MultipartFileStream('bulk_file', 'bulk_file', input_file, input_file_size, logger)
+            request_start = time.time()
+
+            try:
+                # Content-Type: multipart/form-data with the boundary of the body
+                response = client.request(
+                    'post',
+                    'bulk',
+                    data=body,
+                    headers={'Content-Type': body.content_type},
+                    params=params
+                )
+                error = None
+            except requests.exceptions.RequestException as e:
+                response = None
+                error = e
+            METRICS.incCounter('bytes_uploaded_total', body.bytes_sent)
+
+        elapsed = time.time() - request_start
+        logger('Sent {0:.2f} MB in {1:.2f} seconds ({2:.2f} MB/s)'.format(body.bytes_sent / 10**6, elapsed, body.get_throughput() / 10**6))
+
+        retry_after = get_retry_after(response) if response is not None and response.status_code == 503 else None
+        if error is not None:
+            retry = isinstance(error, requests.exceptions.ConnectionError) and body.bytes_sent == 0
+        else:
+            retry = response.status_code == 429 or retry_after is not None
+        if not retry:
+            if error is not None:
+                raise error
+            break
+        if attempt > args.retries:
+            if error is not None:
+                raise error
+            break
+
+        METRICS.incCounter('api_retries_total', labels={'endpoint': getEndpointLabel('bulk')})
+        logger('Upload attempt {0} failed ({1}), retrying'.format(attempt, error if error is not None else 'status code {0}'.format(response.status_code)))
+        if retry_after is not None:
+            time.sleep(retry_after)
+        elif response is None:
+            time.sleep(15)
 
     response_json = response.json()
 
@@ -303,6 +613,10 @@ def suredone_upload(args, credentials, logger, input_file_path):
         logger('The input file is uploaded successfully')
         logger('Request file: {0}'.format(response_json['request_file']))
         logger('Result file: {0}'.format(response_json['result_file']))
+        response_json['bulk_name'] = params['bulk_name']
+        response_json['submitted_at'] = request_start
+        response_json['bytes'] = input_file_size
+        return response_json
     else:
         if ('result' in response_json) and ('message' in response_json):
             raise Exception('Status code: {0}; Result: {1}; Message: {2}'.format(
@@ -318,6 +632,963 @@ def suredone_upload(args, credentials, logger, input_file_path):
 
 
 
+def iter_csv_records(input_file):
+    """Yields the raw records of a CSV file opened in binary mode.
+
+    A record ends at a new line outside of quotes, so quoted values with new lines stay in their record
+    and the records can be copied to another file byte for byte.
+
+    Parameters:
+        input_file: File object opened in binary mode
+    """
+
+    record = []
+    quotes = 0
+    for line in input_file:
+        record.append(line)
+        quotes += line.count(b'"')
+        if quotes % 2 == 0:
+            yield b''.join(record)
+            record = []
+            quotes = 0
+    if record:
+        yield b''.join(record)
+
+
+
+def parse_csv_record(record):
+    """Parses one raw CSV record into its values."""
+
+    return next(csv.reader([record.decode('utf-8', errors='replace')]), [])
+
+
+
+def get_guid_hash(guid):
+    """Returns a 64-bit hash of a guid, used to find duplicates without keeping the guids in memory."""
+
+    return int.from_bytes(hashlib.blake2b(guid.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+
+def validate_input_file(input_file_path, logger, max_samples=20):
+    """Checks the input file in a streaming pass before it is uploaded.
+
+    The checks are: the action and guid (or sku) headers exist, every row has as many values as the
+    header, every row is valid UTF-8, and no guid appears in more than one row. The guids are kept as
+    64-bit hashes in an array (8 bytes per row) and sorted, the duplicates are counted from adjacent
+    equal hashes. Only the guids of up to max_samples repeated hashes are looked up in a second pass,
+    which stops once max_samples examples are found, so memory doesn't grow with the duplicates.
+
+    Parameters:
+        input_file_path: Input file path
+        logger: Function used for logging
+        max_samples: Number of example rows kept for every kind of error
+
+    Returns:
+        Dictionary with the number of rows and the errors found (each a count and example rows).
+    """
+
+    report = {
+        'rows': 0,
+        'missing_headers': [],
+        'column_count': {'count': 0, 'samples': []},
+        'encoding': {'count': 0, 'samples': []},
+        'empty_guid': {'count': 0, 'samples': []},
+        'duplicate_guid': {'count': 0, 'samples': []}
+    }
+
+    def add_error(kind, sample):
+        report[kind]['count'] += 1
+        if len(report[kind]['samples']) < max_samples:
+            report[kind]['samples'].append(sample)
+
+    hashes = bytearray()
+    with open(input_file_path, 'rb') as input_file:
+        records = iter_csv_records(input_file)
+        header = next(records, b'')
+        columns = [column.strip().lower() for column in parse_csv_record(header.lstrip(codecs.BOM_UTF8))]
+        for required in ('action', 'guid'):
+            if required not in columns and not (required == 'guid' and 'sku' in columns):
+                report['missing_headers'].append(required)
+        key_column = columns.index('guid') if 'guid' in columns else (columns.index('sku') if 'sku' in columns else None)
+
+        # line numbers are counted in physical lines, so they match what an editor shows
+        line_number = header.count(b'\n') + 1
+        for record in records:
+            record_line = line_number
+            line_number += record.count(b'\n')
+            if not record.strip():
+                continue
+            report['rows'] += 1
+
+            try:
+                text = record.decode('utf-8')
+            except UnicodeDecodeError as e:
+                add_error('encoding', 'line {0}: {1}'.format(record_line, str(e)))
+                text = record.decode('utf-8', errors='replace')
+
+            values = next(csv.reader([text]), [])
+            if len(values) != len(columns):
+                add_error('column_count', 'line {0}: {1} values, the header has {2}'.format(record_line, len(values), len(columns)))
+
+            if key_column is not None:
+                key = values[key_column].strip() if key_column < len(values) else ''
+                if key:
+                    hashes += get_guid_hash(key).to_bytes(8, 'little')
+                else:
+                    add_error('empty_guid', 'line {0}'.format(record_line))
+
+    # count the repeats from the sorted hashes, the guids of a few of them are looked up in a second pass
+    if len(hashes) > 8:
+        hashes = np.frombuffer(hashes, dtype='<u8').copy()
+        hashes.sort()
+        repeated = hashes[1:] == hashes[:-1]
+        report['duplicate_guid']['count'] = int(np.count_nonzero(repeated))
+        # the first repeat of every hash, so the samples show different guids
+        first_repeats = repeated.copy()
+        first_repeats[1:] &= ~repeated[:-1]
+        sampled = set(hashes[1:][first_repeats][:max_samples].tolist())
+        del hashes, repeated, first_repeats
+        samples = report['duplicate_guid']['samples']
+        if sampled:
+            first_lines = {}
+            with open(input_file_path, 'rb') as input_file:
+                records = iter_csv_records(input_file)
+                next(records, b'')
+                line_number = header.count(b'\n') + 1
+                for record in records:
+                    if len(samples) >= max_samples:
+                        break
+                    record_line = line_number
+                    line_number += record.count(b'\n')
+                    if not record.strip():
+                        continue
+                    values = parse_csv_record(record)
+                    key = values[key_column].strip() if key_column < len(values) else ''
+                    if key and get_guid_hash(key) in sampled:
+                        if key in first_lines:
+                            samples.append('{0} (lines {1} and {2})'.format(key, first_lines[key], record_line))
+                        else:
+                            first_lines[key] = record_line
+
+    logger('Validated {0} rows: {1} with a wrong column count, {2} with encoding errors, {3} without guid, {4} duplicate guids{5}'.format(
+        report['rows'],
+        report['column_count']['count'],
+        report['encoding']['count'],
+        report['empty_guid']['count'],
+        report['duplicate_guid']['count'],
+        ', missing headers: ' + ', '.join(report['missing_headers']) if report['missing_headers'] else '')
+    )
+    return report
+
+
+
+def has_validation_errors(report, reject_duplicates=False):
+    """Returns True if the validation report has any error. Duplicate guids only count with reject_duplicates."""
+
+    kinds = ('column_count', 'encoding', 'empty_guid') + (('duplicate_guid',) if reject_duplicates else ())
+    return bool(report['missing_headers']) or any(report[kind]['count'] for kind in kinds)
+
+
+
+def write_validation_report(report, report_path, input_file_path):
+    """Writes the validation report as text, one section per kind of error with its example rows."""
+
+    titles = {
+        'column_count': 'Rows with a wrong column count',
+        'encoding': 'Rows that are not valid UTF-8',
+        'empty_guid': 'Rows without guid',
+        'duplicate_guid': 'Duplicate guids'
+    }
+
+    report_directory = os.path.dirname(os.path.abspath(report_path))
+    if not os.path.isdir(report_directory):
+        os.makedirs(report_directory)
+    with open(report_path, 'w') as report_file:
+        report_file.write('Validation of {0}\n'.format(input_file_path))
+        report_file.write('Rows: {0}\n'.format(report['rows']))
+        if report['missing_headers']:
+            report_file.write('Missing headers: {0}\n'.format(', '.join(report['missing_headers'])))
+        for kind, title in titles.items():
+            if not report[kind]['count']:
+                continue
+            report_file.write('\n{0}: {1}\n'.format(title, report[kind]['count']))
+            for sample in report[kind]['samples']:
+                report_file.write('    {0}\n'.format(sample))
+            if report[kind]['count'] > len(report[kind]['samples']):
+                report_file.write('    ...\n')
+
+
+
+def check_input_file(args, logger, input_file_path):
+    """Validates the input file (unless skipped) and raises an exception if it has errors.
+
+    Parameters:
+        args: Object with command line arguments (skip_validation, reject_duplicates, validation_report, log)
+        logger: Function used for logging
+        input_file_path: Input file path
+    """
+
+    if args.skip_validation:
+        return
+
+    with run_stage('validate'):
+        report = validate_input_file(input_file_path, logger)
+
+    reject_duplicates = args.reject_duplicates
+    if report['duplicate_guid']['count'] and not reject_duplicates:
+        logger('Warning: {0} guids appear in more than one row, uploaded as they are'.format(report['duplicate_guid']['count']))
+
+    report_path = args.validation_report
+    if has_validation_errors(report, reject_duplicates=True) or report_path:
+        if not report_path:
+            input_file_name = os.path.splitext(os.path.basename(input_file_path))[0]
+            report_path = os.path.join(args.log, '{0}_validation.txt'.format(input_file_name))
+        write_validation_report(report, report_path, input_file_path)
+        logger('Validation report saved to {0}'.format(report_path))
+
+    if has_validation_errors(report, reject_duplicates=reject_duplicates):
+        raise Exception('The input file failed validation and is not uploaded (see {0})'.format(report_path))
+
+
+
+class SnapshotRows(object):
+    """Reads the rows of an exported snapshot by guid, restricted to the columns of the edit file.
+
+    With the guid index of the export every row is read from its byte offset when it is needed.
+    Without it the export is streamed once and only the rows of the given guids are kept.
+    """
+
+    def __init__(self, snapshot_path, columns, guids, delimiter, logger):
+        """
+        Parameters:
+            snapshot_path: Path of the export CSV
+            columns: Lowercase column names of the edit file
+            guids: Function returning the guids of the edit file, only called when there is no index
+            delimiter: Delimiter of the export if it has no index
+            logger: Function used for logging
+        """
+
+        self.snapshot_path = snapshot_path
+        self.columns = columns
+        self.index = None
+        self.rows = None
+
+        index_path = getIndexPath(snapshot_path)
+        if os.path.isfile(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(snapshot_path):
+            self.index = GuidIndex(index_path)
+            self.snapshot_file = open(snapshot_path, 'rb')
+            self.header = self.read_header(self.index.readRowFrom(self.snapshot_file, 0))
+            logger('Comparing with {0} using its guid index'.format(snapshot_path))
+        else:
+            logger('Comparing with {0} (no guid index, reading the export)'.format(snapshot_path))
+            self.load_rows(set(guids()), delimiter)
+
+    def read_header(self, header):
+        """Maps the edit file columns to their position in the export."""
+
+        header = [column.strip().lower() for column in header]
+        if header:
+            header[0] = header[0].lstrip('\ufeff')
+        return {column: header.index(column) for column in self.columns if column in header}
+
+    def load_rows(self, guids, delimiter):
+        self.rows = {}
+        with open(self.snapshot_path, 'r', newline='', encoding='utf-8', errors='replace') as snapshot_file:
+            reader = csv.reader(snapshot_file, delimiter=delimiter)
+            self.header = self.read_header(next(reader, []))
+            guid_column = self.header.get('guid')
+            if guid_column is None:
+                raise Exception('The export {0} has no guid column'.format(self.snapshot_path))
+            for row in reader:
+                if guid_column < len(row) and row[guid_column] in guids and row[guid_column] not in self.rows:
+                    self.rows[row[guid_column]] = self.select(row)
+
+    def select(self, row):
+        return {column: row[position] if position < len(row) else '' for column, position in self.header.items()}
+
+    def get(self, guid):
+        """Returns the export values of a guid by edit file column, None if the guid isn't in the export."""
+
+        if self.rows is not None:
+            return self.rows.get(guid)
+        offsets = self.index.lookup(guid)
+        if not offsets:
+            return None
+        return self.select(self.index.readRowFrom(self.snapshot_file, offsets[0]))
+
+    def close(self):
+        if self.index is not None:
+            self.index.close()
+            self.snapshot_file.close()
+
+
+
+def values_match(new_value, old_value, column=''):
+    """Compares an edit value with the exported one.
+
+    Values of the NUMERIC_COLUMNS, and values that are both plain decimals, are compared by value
+    (5 equals 5.00). Anything else must match exactly, so 012345 differs from 12345 and 1e3 from 1000.
+    """
+
+    new_value = new_value.strip()
+    old_value = old_value.strip()
+    if new_value == old_value:
+        return True
+    if column in NUMERIC_COLUMNS or (PLAIN_DECIMAL.match(new_value) and PLAIN_DECIMAL.match(old_value)):
+        try:
+            return float(new_value) == float(old_value)
+        except ValueError:
+            return False
+    return False
+
+
+
+def diff_input_file(args, logger, input_file_path):
+    """Writes the rows and columns of the input file that differ from the last downloaded export.
+
+    Only edit rows are compared. A row is dropped when all of its values match the export, a column
+    is dropped when it matches in every kept row. The action and guid columns are always kept, and
+    the kept rows keep their unchanged values of the kept columns (they equal the export anyway).
+
+    Parameters:
+        args: Object with command line arguments (diff_against, diff_delimiter)
+        logger: Function used for logging
+        input_file_path: Input file path
+
+    Returns:
+        Path of the diff file (<input file name>_diff.csv next to the input file), or None if nothing changed.
+    """
+
+    snapshot_path = args.diff_against
+    if snapshot_path == 'latest':
+        snapshot_path = getLatestExport()
+        if snapshot_path is None:
+            raise Exception('No export of suredone_download.py found to compare with')
+    if not os.path.isfile(snapshot_path):
+        raise Exception('The export to compare with does not exist: {0}'.format(snapshot_path))
+
+    def read_input():
+        input_file = open(input_file_path, 'r', newline='', encoding='utf-8-sig', errors='replace')
+        return input_file, csv.reader(input_file)
+
+    input_file, reader = read_input()
+    with input_file:
+        header = next(reader, [])
+    columns = [column.strip().lower() for column in header]
+    if 'guid' not in columns:
+        raise Exception('--diff_against needs a guid column in the input file')
+    guid_column = columns.index('guid')
+    action_column = columns.index('action') if 'action' in columns else None
+
+    def is_edit(row):
+        return action_column is None or (action_column < len(row) and row[action_column].strip().lower() == 'edit')
+
+    def edit_guids():
+        input_file, reader = read_input()
+        with input_file:
+            next(reader, None)
+            for row in reader:
+                if row and is_edit(row) and guid_column < len(row):
+                    yield row[guid_column]
+
+    # first pass: find the rows to keep and the columns that changed in them
+    kept_rows = array('L')
+    changed_columns = set()
+    unchanged_rows = 0
+    snapshot = SnapshotRows(snapshot_path, columns, edit_guids, args.diff_delimiter, logger)
+    try:
+        input_file, reader = read_input()
+        with input_file:
+            next(reader, None)
+            for row_number, row in enumerate(reader):
+                if not row:
+                    continue
+                old_values = snapshot.get(row[guid_column]) if is_edit(row) and guid_column < len(row) else None
+                if old_values is None:
+                    # not an edit or a new guid, uploaded as it is (with all of its columns, empty values included)
+                    kept_rows.append(row_number)
+                    changed_columns.update(range(len(columns)))
+                    continue
+
+                changed = [
+                    i for i, column in enumerate(columns)
+                    if i not in (guid_column, action_column) and i < len(row)
+                    and (column not in old_values or not values_match(row[i], old_values[column], column))
+                ]
+                if changed:
+                    kept_rows.append(row_number)
+                    changed_columns.update(changed)
+                else:
+                    unchanged_rows += 1
+    finally:
+        snapshot.close()
+
+    logger('{0} rows match the export, {1} rows are uploaded'.format(unchanged_rows, len(kept_rows)))
+    if not kept_rows:
+        return None
+
+    # second pass: write the kept rows with the changed columns
+    selected = [i for i in range(len(columns)) if i in changed_columns or i in (guid_column, action_column)]
+    logger('{0} of {1} columns are uploaded: {2}'.format(len(selected), len(columns), ', '.join(header[i] for i in selected)))
+
+    input_file_name = os.path.splitext(os.path.basename(input_file_path))[0]
+    diff_file_path = os.path.join(os.path.dirname(input_file_path), '{0}_diff.csv'.format(input_file_name))
+    kept = iter(kept_rows)
+    next_row = next(kept, None)
+    input_file, reader = read_input()
+    with input_file, open(diff_file_path, 'w', newline='', encoding='utf-8') as diff_file:
+        writer = csv.writer(diff_file, lineterminator='\n')
+        writer.writerow([header[i] for i in selected])
+        next(reader, None)
+        for row_number, row in enumerate(reader):
+            if row_number != next_row:
+                continue
+            writer.writerow([row[i] if i < len(row) else '' for i in selected])
+            next_row = next(kept, None)
+            if next_row is None:
+                break
+
+    logger('Diff file saved to {0} ({1:.2f} MB instead of {2:.2f} MB)'.format(
+        diff_file_path, os.path.getsize(diff_file_path) / 10**6, os.path.getsize(input_file_path) / 10**6))
+    return diff_file_path
+
+
+
+def split_input_file(input_file_path, parts, logger):
+    """Splits the input file on row boundaries into parts that can be uploaded as separate bulk jobs.
+
+    Rows are assigned to a part by a hash of their guid (or sku), so all rows of a guid end up in the
+    same part, and every part starts with the header of the input file. Without a guid or sku column
+    the rows are dealt out in turn.
+
+    Parameters:
+        input_file_path: Input file path
+        parts: Number of parts
+        logger: Function used for logging
+
+    Returns:
+        List of (part file path, number of rows) for the parts that got at least one row.
+    """
+
+    input_file_basename = os.path.basename(input_file_path)
+    input_file_name = os.path.splitext(input_file_basename)[0]
+    parts_directory = os.path.join(os.path.dirname(input_file_path), '{0}_parts'.format(input_file_name))
+    if not os.path.isdir(parts_directory):
+        os.makedirs(parts_directory)
+
+    part_paths = [
+        os.path.join(parts_directory, '{0}_part{1:02d}.csv'.format(input_file_name, i + 1))
+        for i in range(parts)
+    ]
+    row_counts = [0] * parts
+
+    with open(input_file_path, 'rb') as input_file:
+        records = iter_csv_records(input_file)
+        header = next(records, b'')
+        if not header.endswith(b'\n'):
+            header += b'\n'
+
+        columns = [column.strip().lower() for column in parse_csv_record(header.lstrip(codecs.BOM_UTF8))]
+        key_column = columns.index('guid') if 'guid' in columns else (columns.index('sku') if 'sku' in columns else None)
+        if key_column is None:
+            logger('No guid or sku column found, rows are split in turn')
+
+        part_files = [open(path, 'wb') for path in part_paths]
+        try:
+            for part_file in part_files:
+                part_file.write(header)
+
+            for row_number, record in enumerate(records):
+                if not record.strip():
+                    continue
+                if key_column is None:
+                    part = row_number % parts
+                else:
+                    values = parse_csv_record(record)
+                    key = values[key_column] if key_column < len(values) else ''
+                    part = zlib.crc32(key.encode('utf-8')) % parts
+                if not record.endswith(b'\n'):
+                    record += b'\n'
+                part_files[part].write(record)
+                row_counts[part] += 1
+        finally:
+            for part_file in part_files:
+                part_file.close()
+
+    split = []
+    for path, row_count in zip(part_paths, row_counts):
+        if row_count:
+            split.append((path, row_count))
+        else:
+            os.remove(path)
+
+    logger('The input file is split into {0} parts in {1}'.format(len(split), parts_directory))
+    return split
+
+
+
+def upload_in_parts(args, client, logger, input_file_path, poller=None):
+    """Splits the input file and uploads the parts as separate bulk jobs with bounded concurrency.
+
+    The bulk name, request file and result file of every part are written to manifest.json in the
+    parts directory. When all parts succeed the part files are removed and the manifest is moved to
+    the log directory as <input>_manifest_<time>.json, otherwise the failed parts are kept next to
+    the manifest so they can be uploaded again one by one with -i.
+
+    Parameters:
+        args: Object with command line arguments (split_parts, max_concurrent, log)
+        client: SureDone API client shared by the part uploads
+        logger: Function used for logging
+        input_file_path: Input file path
+        poller: ResultPoller that the uploaded parts are handed to, None if results aren't fetched
+
+    Returns:
+        List with the upload result of every part.
+    """
+
+    with run_stage('split'):
+        parts = split_input_file(input_file_path, args.split_parts, logger)
+    if not parts:
+        raise Exception('The input file has no rows to upload')
+
+    def upload_part(part):
+        part_path, row_count = part
+        part_name = os.path.basename(part_path)
+        part_logger = lambda message: logger('[{0}] {1}'.format(part_name, message))
+
+        result = {'file': part_path, 'rows': row_count, 'bytes': os.path.getsize(part_path)}
+        try:
+            response_json = suredone_upload(args, client, part_logger, part_path)
+            result['status'] = 'success'
+            for key in ('bulk_name', 'request_file', 'result_file'):
+                result[key] = response_json.get(key)
+            if poller is not None:
+                poller.track(response_json)
+        except Exception as e:
+            part_logger('An error occurred during uploading the part: {0}'.format(str(e)))
+            result['status'] = 'failed'
+            result['error'] = str(e)
+        return result
+
+    logger('Uploading {0} parts, at most {1} at a time'.format(len(parts), args.max_concurrent))
+    with ThreadPoolExecutor(max_workers=max(1, args.max_concurrent)) as executor:
+        results = list(executor.map(upload_part, parts))
+
+    parts_directory = os.path.dirname(parts[0][0])
+    manifest_path = os.path.join(parts_directory, 'manifest.json')
+    with open(manifest_path, 'w') as manifest:
+        json.dump(results, manifest, indent=4)
+
+    failed = [result for result in results if result['status'] != 'success']
+    for result in results:
+        logger('{0}: {1} ({2} rows, bulk name: {3}, result file: {4})'.format(
+            os.path.basename(result['file']),
+            result['status'],
+            result['rows'],
+            result.get('bulk_name'),
+            result.get('result_file'))
+        )
+
+    # uploaded parts are not needed anymore, failed parts stay next to the manifest
+    for result in results:
+        if result['status'] == 'success':
+            os.remove(result['file'])
+
+    if failed:
+        raise Exception('{0} of {1} parts failed, they are kept in {2} and can be uploaded again with -i'.format(
+            len(failed), len(results), parts_directory)
+        )
+
+    # the manifest keeps the bulk names and result files of the parts after the parts are gone
+    if not os.path.isdir(args.log):
+        os.makedirs(args.log)
+    input_file_name = os.path.splitext(os.path.basename(input_file_path))[0]
+    datetime_now = datetime.datetime.now().strftime('%Y_%m_%d-%H-%M-%S')
+    kept_manifest_path = os.path.join(args.log, '{0}_manifest_{1}.json'.format(input_file_name, datetime_now))
+    shutil.move(manifest_path, kept_manifest_path)
+    logger('Manifest of the parts saved to {0}'.format(kept_manifest_path))
+    if not os.listdir(parts_directory):
+        os.rmdir(parts_directory)
+    return results
+
+
+
+def upload_file(args, client, logger, input_file_path, poller=None):
+    """Validates and uploads one input file (reduced to its changes and split into parts if requested)
+    and removes it afterwards (unless preserved).
+
+    Parameters:
+        args: Object with command line arguments
+        client: SureDone API client
+        logger: Function used for logging
+        input_file_path: Input file path
+        poller: ResultPoller that the bulk jobs are handed to, None if results aren't fetched
+
+    Returns:
+        The upload result of the file, the list of results of its parts, or None if nothing changed.
+    """
+
+    # check the file before anything is sent
+    check_input_file(args, logger, input_file_path)
+
+    # upload only what differs from the last download
+    upload_file_path = input_file_path
+    if args.diff_against:
+        with run_stage('diff'):
+            upload_file_path = diff_input_file(args, logger, input_file_path)
+        if upload_file_path is None:
+            logger('Nothing changed since the export, the input file is not uploaded')
+            remove_input_file(args, logger, input_file_path)
+            return None
+
+    try:
+        if args.split_parts > 1:
+            result = upload_in_parts(args, client, logger, upload_file_path, poller=poller)
+        else:
+            result = suredone_upload(args, client, logger, upload_file_path)
+            if poller is not None:
+                poller.track(result)
+    finally:
+        if upload_file_path != input_file_path:
+            os.remove(upload_file_path)
+
+    # remove the input file after successfully uploading
+    remove_input_file(args, logger, input_file_path)
+    return result
+
+
+
+def find_input_files(pattern):
+    """Returns the files matching the batch pattern (a glob pattern, or a directory for all its .csv files).
+
+    Parameters:
+        pattern: Glob pattern or directory
+    """
+
+    pattern = os.path.expanduser(pattern)
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.csv')
+    return sorted(path for path in glob.glob(pattern) if os.path.isfile(path))
+
+
+
+def upload_batch(args, client, logger, poller=None):
+    """Uploads every file matching --input_glob through a bounded pool of workers sharing one client.
+
+    In watch mode the pattern is polled every --poll_interval seconds. A file is uploaded once its
+    size and modification time didn't change between two polls (so files that are still being
+    written are left alone), and again only if it changes after it was uploaded. A file whose
+    upload failed is tried again only once it changes too (e.g. it was fixed or written again), so
+    a file that is rejected isn't uploaded on every poll.
+
+    Parameters:
+        args: Object with command line arguments (input_glob, watch, poll_interval, workers)
+        client: SureDone API client
+        logger: Function used for logging
+        poller: ResultPoller that the bulk jobs are handed to, None if results aren't fetched
+
+    Returns:
+        List of per-file results (file, status, seconds, error).
+    """
+
+    results = []
+    uploaded = {}
+    failed = {}
+    last_seen = {}
+
+    def upload_one(ready_file):
+        input_file_path, signature = ready_file
+        file_name = os.path.basename(input_file_path)
+        file_logger = lambda message: logger('[{0}] {1}'.format(file_name, message))
+        result = {'file': input_file_path, 'bytes': os.path.getsize(input_file_path)}
+        start = time.time()
+        try:
+            upload_file(args, client, file_logger, input_file_path, poller=poller)
+            result['status'] = 'success'
+            uploaded[input_file_path] = signature
+            failed.pop(input_file_path, None)
+        except Exception as e:
+            file_logger('An error occurred during uploading the file: {0}'.format(str(e)))
+            # the same file would most likely fail again, it is retried once it changes
+            failed[input_file_path] = signature
+            if args.watch:
+                file_logger('The file is uploaded again once it changes')
+            result['status'] = 'failed'
+            result['error'] = str(e)
+        result['seconds'] = time.time() - start
+        return result
+
+    def collect_ready_files():
+        ready = []
+        current = {}
+        for path in find_input_files(args.input_glob):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            signature = (stat.st_size, stat.st_mtime)
+            current[path] = signature
+            # outside of watch mode the files are taken as they are
+            stable = (not args.watch) or last_seen.get(path) == signature
+            if stable and signature not in (uploaded.get(path), failed.get(path)):
+                ready.append((path, signature))
+        last_seen.clear()
+        last_seen.update(current)
+        return ready
+
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        try:
+            while True:
+                ready = collect_ready_files()
+                if ready:
+                    logger('Uploading {0} files, at most {1} at a time'.format(len(ready), args.workers))
+                    cycle_results = list(executor.map(upload_one, ready))
+                    log_batch_summary(cycle_results, logger)
+                    results.extend(cycle_results)
+                if not args.watch:
+                    break
+                time.sleep(args.poll_interval)
+        except KeyboardInterrupt:
+            logger('Watching is stopped')
+
+    if args.watch and results:
+        logger('Summary of the whole watch run:')
+        log_batch_summary(results, logger)
+    return results
+
+
+
+def log_batch_summary(results, logger):
+    """Logs one line per uploaded file and the totals of a batch.
+
+    Parameters:
+        results: List of per-file results
+        logger: Function used for logging
+    """
+
+    for result in results:
+        logger('{0}: {1} ({2:.2f} MB in {3:.1f} seconds){4}'.format(
+            os.path.basename(result['file']),
+            result['status'],
+            result['bytes'] / 10**6,
+            result['seconds'],
+            '; {0}'.format(result['error']) if 'error' in result else '')
+        )
+    failed = sum(1 for result in results if result['status'] != 'success')
+    logger('{0} files uploaded, {1} failed'.format(len(results) - failed, failed))
+
+
+
+class ResultPoller(object):
+    """Tracks the submitted bulk jobs and fetches their result files in the background.
+
+    Every job is polled with a growing delay. Once some jobs are done, the observed processing
+    rate (bytes per second) is used to schedule the first poll of a job close to the time it is
+    expected to finish, so big files aren't polled needlessly often. The result files are
+    downloaded to the log directory and the rows are counted by their result/status column.
+    """
+
+    # results endpoint of the bulk jobs, the result_file name of the upload response is appended
+    results_endpoint = 'bulk/results/'
+    initial_delay = 10
+    max_delay = 300
+    backoff = 1.5
+    # number of result files fetched at the same time
+    workers = 4
+
+    def __init__(self, args, client, logger):
+        """
+        Parameters:
+            args: Object with command line arguments (log directory, result_timeout)
+            client: SureDone API client to poll with
+            logger: Function used for logging
+        """
+
+        self.args = args
+        self.logger = logger
+        self.client = client
+
+        self.condition = threading.Condition()
+        self.queue = []  # heap of (next poll time, sequence, job)
+        self.sequence = 0
+        self.active = 0
+        self.closed = False
+        self.results = []
+        self.processed_bytes = 0
+        self.processed_seconds = 0.0
+
+        self.thread = threading.Thread(target=self.run, name='result-poller')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def track(self, response_json):
+        """Adds a submitted bulk job (upload response with bulk_name, result_file, submitted_at, bytes)."""
+
+        job = {
+            'bulk_name': response_json.get('bulk_name'),
+            'result_file': response_json['result_file'],
+            'submitted_at': response_json.get('submitted_at', time.time()),
+            'bytes': response_json.get('bytes', 0),
+            'delay': self.initial_delay
+        }
+        with self.condition:
+            self.schedule(job, self.get_first_poll_time(job))
+
+    def get_first_poll_time(self, job):
+        """Returns when a new job is first polled, at the expected completion time once a rate is known."""
+
+        first_poll = job['submitted_at'] + self.initial_delay
+        if self.processed_seconds > 0 and self.processed_bytes > 0:
+            expected = job['bytes'] * self.processed_seconds / self.processed_bytes
+            first_poll = max(first_poll, job['submitted_at'] + expected)
+        return first_poll
+
+    def schedule(self, job, poll_time):
+        heapq.heappush(self.queue, (poll_time, self.sequence, job))
+        self.sequence += 1
+        self.condition.notify_all()
+
+    def run(self):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                with self.condition:
+                    while True:
+                        if self.closed and not self.queue and self.active == 0:
+                            return
+                        if self.queue and self.queue[0][0] <= time.time():
+                            break
+                        timeout = self.queue[0][0] - time.time() if self.queue else None
+                        self.condition.wait(timeout)
+                    poll_time, sequence, job = heapq.heappop(self.queue)
+                    self.active += 1
+                executor.submit(self.poll, job)
+
+    def poll(self, job):
+        try:
+            done = self.fetch_result(job)
+        except Exception as e:
+            self.logger('[{0}] Polling the result failed: {1}'.format(job['bulk_name'], str(e)))
+            done = False
+
+        with self.condition:
+            self.active -= 1
+            if not done:
+                if time.time() - job['submitted_at'] > self.args.result_timeout:
+                    self.finish(job, {'status': 'timeout'})
+                else:
+                    job['delay'] = min(job['delay'] * self.backoff, self.max_delay)
+                    self.schedule(job, time.time() + job['delay'])
+            self.condition.notify_all()
+
+    def fetch_result(self, job):
+        """Downloads and counts the result file of a job. Returns False if the result isn't ready yet."""
+
+        result_file = job['result_file']
+        if result_file.startswith('http') and not result_file.startswith(self.client.api_endpoint):
+            # a signed storage url, fetched without the API credentials like the export download
+            response = self.client.session.get(result_file, timeout=60, stream=True)
+        else:
+            url = result_file if result_file.startswith('http') else self.results_endpoint + result_file
+            response = self.client.request('get', url, timeout=60, stream=True)
+        if response.status_code != 200:
+            response.close()
+            return False
+
+        # the endpoint may answer with a download url like bulk/exports does
+        if 'json' in response.headers.get('Content-Type', ''):
+            response_json = response.json()
+            if response_json.get('result') != 'success' or not response_json.get('url'):
+                return False
+            response = self.client.session.get(response_json['url'], timeout=60, stream=True)
+            if response.status_code != 200:
+                response.close()
+                return False
+
+        if not os.path.isdir(self.args.log):
+            os.makedirs(self.args.log)
+        result_path = os.path.join(self.args.log, '{0}_result.csv'.format(job['bulk_name']))
+        with open(result_path, 'wb') as result_file_out:
+            for chunk in response.iter_content(chunk_size=65536):
+                result_file_out.write(chunk)
+                METRICS.incCounter('bytes_downloaded_total', len(chunk))
+
+        counts = count_result_rows(result_path)
+        counts['status'] = 'done'
+        counts['result_path'] = result_path
+        with self.condition:
+            self.finish(job, counts)
+        return True
+
+    def finish(self, job, counts):
+        """Records a finished job (called with the condition held)."""
+
+        seconds = time.time() - job['submitted_at']
+        job.update(counts)
+        job['seconds'] = seconds
+        self.results.append(job)
+
+        if counts['status'] == 'done':
+            self.processed_bytes += job['bytes']
+            self.processed_seconds += seconds
+            METRICS.observe('bulk_processing_seconds', seconds)
+            METRICS.incCounter('bulk_result_rows_total', counts['succeeded'], labels={'result': 'success'})
+            METRICS.incCounter('bulk_result_rows_total', counts['failed'], labels={'result': 'failure'})
+            METRICS.incCounter('bulk_result_rows_total', counts['unknown'], labels={'result': 'unknown'})
+            self.logger('[{0}] Processed by SureDone in {1:.0f} seconds ({2:.2f} MB): {3} rows succeeded, {4} failed, {5} without a result, result saved to {6}'.format(
+                job['bulk_name'], seconds, job['bytes'] / 10**6, counts['succeeded'], counts['failed'], counts['unknown'], counts['result_path']))
+        else:
+            self.logger('[{0}] No result after {1:.0f} seconds, giving up'.format(job['bulk_name'], seconds))
+
+    def close_and_wait(self):
+        """Waits until every tracked job is finished or timed out and returns their results."""
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        return self.results
+
+
+
+def count_result_rows(result_path):
+    """Counts the succeeded and failed rows of a bulk result file.
+
+    The row result is read from a 'result' or 'status' column; 'success'/'ok' count as succeeded,
+    any other value as failed. Rows without a value in that column, or every row of a file without
+    such a column, are counted as unknown: the file could not be interpreted.
+
+    Parameters:
+        result_path: Path of the downloaded result CSV
+
+    Returns:
+        Dictionary with the number of rows, succeeded, failed and unknown rows.
+    """
+
+    counts = {'rows': 0, 'succeeded': 0, 'failed': 0, 'unknown': 0}
+    with open(result_path, 'r', newline='', encoding='utf-8', errors='replace') as result_file:
+        reader = csv.reader(result_file)
+        columns = [column.strip().lower() for column in next(reader, [])]
+        result_column = None
+        for name in ('result', 'status'):
+            if name in columns:
+                result_column = columns.index(name)
+                break
+
+        for row in reader:
+            if not row:
+                continue
+            counts['rows'] += 1
+            if result_column is None or result_column >= len(row) or not row[result_column].strip():
+                counts['unknown'] += 1
+            elif row[result_column].strip().lower() in ('success', 'ok'):
+                counts['succeeded'] += 1
+            else:
+                counts['failed'] += 1
+    return counts
+
+
+
 def remove_input_file(args, logger, input_file_path):
     """Removes the input file (if args.preserve is False).
 
@@ -335,14 +1606,63 @@ def remove_input_file(args, logger, input_file_path):
 
 
 
+@contextmanager
+def run_stage(name):
+    """Measures a named stage of the run for the metrics and the profiler.
+
+    Parameters:
+        name: Name of the stage
+    """
+
+    with METRICS.timeStage(name), PROFILER.stage(name):
+        yield
+
+
+
+def write_profile(args, logger):
+    """Writes the profiling reports to the log directory (registered to run at exit).
+
+    Parameters:
+        args: Object with arguments (log directory)
+        logger: Function used for logging
+    """
+
+    if not os.path.isdir(args.log):
+        os.makedirs(args.log)
+
+    datetime_now = datetime.datetime.now().strftime('%Y_%m_%d-%H-%M-%S')
+    base_path = os.path.join(args.log, 'suredone_upload-profile_{0}'.format(datetime_now))
+
+    for path in PROFILER.finish(base_path):
+        logger('Profile written to {0}'.format(path))
+
+
+
+def write_metrics(metrics_file):
+    """Records the total run time and writes the metrics textfile (registered to run at exit).
+
+    Parameters:
+        metrics_file: Path of the Prometheus textfile (.prom)
+    """
+
+    METRICS.observe('stage_duration_seconds', time.time() - RUN_START, labels={'stage': 'total'})
+    METRICS.setGauge('last_run_timestamp_seconds', int(time.time()))
+    METRICS.writeTextfile(metrics_file)
+
+
+
 def main():
     """Workflow:
         1. Gets and parses the arguments from the command-line execution.
         2. Creates a logger, logs in 2 places: log file and console.
         3. Reads the credentials from the yaml file.
-        4. Constructs the input file path. 
-        5. Uploads a file to SureDone using the SureDone API.
+        4. Constructs the input file path (or finds the input files in batch mode).
+        5. Validates the input file and uploads it to SureDone using the SureDone API.
         6. Removes the input file after successfully uploading.
+        7. Waits for the result files of the bulk jobs (if requested).
+
+    Returns:
+        Exit status, 0 on success and 1 if an upload or (with --fetch_results) a row failed.
     """
 
     # get and parse the arguments
@@ -351,32 +1671,70 @@ def main():
     # create a logger
     logger = create_logger(args)
 
+    # write the metrics however the run ends, a successful upload sets last_run_success to 1
+    if args.metrics_file:
+        METRICS.setGauge('last_run_success', 0)
+        atexit.register(write_metrics, args.metrics_file)
+
+    # profiling reports are written next to the log files at exit
+    if args.profile:
+        PROFILER.start()
+        atexit.register(write_profile, args, logger)
+
     try:
         # get credentials
         credentials = get_credentials(args, logger)
     except Exception as e:
         logger('An error occurred during reading the credentials: {0}'.format(str(e)))
-        return
+        return 1
 
-    try:
-        # construct input file path
-        input_file_path = construct_input_file_path(args, logger)
-    except Exception as e:
-        logger('An error occurred: Input file path argument is required (-i --input_file)')
-        return
-        
-    try:
-        # call the suredone upload method
-        suredone_upload(args, credentials, logger, input_file_path)
-    except Exception as e:
-        logger('An error occurred during uploading the file: {0}'.format(str(e)))
-        return
+    # one client (and connection pool) for all uploads and result polls
+    client = create_client(args, credentials, logger)
 
-    # remove the input file after successfully uploading
-    remove_input_file(args, logger, input_file_path)
+    # fetch the result files of the bulk jobs in the background while uploading
+    poller = ResultPoller(args, client, logger) if args.fetch_results else None
+
+    # batch mode: upload all files matching the pattern (and keep watching it if requested)
+    if args.input_glob:
+        results = upload_batch(args, client, logger, poller=poller)
+        uploaded = all(result['status'] == 'success' for result in results)
+    else:
+        try:
+            # construct input file path
+            input_file_path = construct_input_file_path(args, logger)
+        except Exception as e:
+            logger('An error occurred: Input file path argument is required (-i --input_file)')
+            return 1
+
+        try:
+            # call the suredone upload method, split into concurrent bulk jobs if requested,
+            # and remove the input file after successfully uploading
+            upload_file(args, client, logger, input_file_path, poller=poller)
+            uploaded = True
+        except Exception as e:
+            logger('An error occurred during uploading the file: {0}'.format(str(e)))
+            uploaded = False
+
+    if poller is not None:
+        logger('Waiting for the result files')
+        with run_stage('results'):
+            jobs = poller.close_and_wait()
+        failed_rows = sum(job.get('failed', 0) for job in jobs)
+        unknown_rows = sum(job.get('unknown', 0) for job in jobs)
+        unfinished = sum(1 for job in jobs if job['status'] != 'done')
+        logger('Results of {0} bulk jobs: {1} rows failed, {2} rows without a result, {3} jobs without result'.format(
+            len(jobs), failed_rows, unknown_rows, unfinished))
+        if failed_rows or unknown_rows or unfinished:
+            return 1
+
+    if not uploaded:
+        return 1
+
+    METRICS.setGauge('last_run_success', 1)
+    return 0
 
 
 
 if __name__ == "__main__":
     """The script starts here."""
-    main()
+    sys.exit(main())
@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+# The scripts are modules at the root of the repository
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# suredone_download.py opens its log file in ~/log when it is imported, keep it out of the real home
+os.environ['HOME'] = tempfile.mkdtemp(prefix='exportsuredoneepid-tests_')
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
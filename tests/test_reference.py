@@ -0,0 +1,288 @@
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import threading
+
+import pandas as pd
+import pytest
+
+import reference
+from suredone_lookup import buildIndexFromFile
+from conftest import FIXTURES, ROOT
+
+MODES = [[], ['-e', 'loop'], ['-s', '-c', '3'], ['-w', '2']]
+
+
+def run_reference(cwd, *args):
+    result = subprocess.run([sys.executable, os.path.join(ROOT, 'reference.py')] + list(args), cwd=str(cwd),
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    assert result.returncode == 0, result.stdout
+    return result
+
+
+def read_bytes(path):
+    with open(str(path), 'rb') as f:
+        return f.read()
+
+
+def transform(tmp_path, input_name, *args):
+    output_path = tmp_path / 'output.csv'
+    run_reference(tmp_path, '-f', os.path.join(FIXTURES, input_name), '-o', str(output_path), '-i', '2', *args)
+    return read_bytes(output_path)
+
+
+@pytest.mark.parametrize('input_name', ['mixed.csv', 'numeric.csv', 'nan.csv', 'sorted.csv'])
+@pytest.mark.parametrize('mode', MODES[1:], ids=lambda mode: ' '.join(mode))
+def test_engines_write_identical_output(tmp_path, input_name, mode):
+    assert transform(tmp_path, input_name, *mode) == transform(tmp_path, input_name)
+
+
+@pytest.mark.parametrize('input_name', ['mixed.csv', 'numeric.csv', 'nan.csv'])
+def test_compact_types_write_the_output_of_the_pandas_types(tmp_path, input_name):
+    assert transform(tmp_path, input_name, '-d') == transform(tmp_path, input_name)
+
+
+def test_groupby_output_matches_expected(tmp_path):
+    assert transform(tmp_path, 'mixed.csv') == read_bytes(os.path.join(FIXTURES, 'mixed_expected.csv'))
+
+
+def test_presorted_input_skips_the_sort(tmp_path):
+    assert transform(tmp_path, 'sorted.csv', '-P') == transform(tmp_path, 'sorted.csv')
+
+
+@pytest.mark.parametrize('guids, epids', [
+    (['a', 'a', 'b', 'c'], [1, 2, 3, 4]),
+    (['a', 'a', 'b', 'c', 'c'], [2, 1, 3, 5, 4]),
+    (['b', 'a', 'c', 'a'], [1, 2, None, 1]),
+], ids=['sorted', 'epids out of order', 'guids out of order'])
+def test_sort_rows_matches_sort_values(guids, epids):
+    frame = pd.DataFrame({'guid': guids, 'Fitment EPID': epids, 'note': range(len(guids))})
+    expected = frame.sort_values(['guid', 'Fitment EPID'])
+
+    assert reference.sortRows(frame).index.tolist() == expected.index.tolist()
+
+
+def test_scan_output_file_cuts_a_partial_row(tmp_path):
+    complete = 'action,guid,ebayepid\nedit,a,1.0\nedit,b,"2.0::x, y"\n'
+    output_path = tmp_path / 'output.csv'
+    output_path.write_bytes((complete + 'edit,c,"3.0::cut of').encode('utf-8'))
+
+    assert reference.scanOutputFile(str(output_path)) == (len(complete), 2, 'b')
+
+
+def test_scan_output_file_rejects_other_files(tmp_path):
+    output_path = tmp_path / 'other.csv'
+    output_path.write_text('guid,Fitment EPID,note\na,1,\n')
+
+    with pytest.raises(SystemExit) as exit_info:
+        reference.scanOutputFile(str(output_path))
+    assert exit_info.value.code == 4
+
+
+@pytest.mark.parametrize('mode', [[], ['-s', '-c', '3']], ids=['in memory', 'external sort'])
+def test_resume_completes_a_truncated_output(tmp_path, mode):
+    full = transform(tmp_path, 'mixed.csv', *mode)
+    # cut the output inside the quoted multi line value of the third GUID
+    output_path = tmp_path / 'output.csv'
+    output_path.write_bytes(full[:full.index(b'lines')])
+
+    result = run_reference(tmp_path, '-f', os.path.join(FIXTURES, 'mixed.csv'), '-o', str(output_path), '-i', '2', '-r', *mode)
+    assert 'Resuming after 2 rows' in result.stdout
+    assert read_bytes(output_path) == full
+
+
+@pytest.mark.parametrize('log_level, logged', [('1', [('10', '3')]), ('2', [('10', '3'), ('2', '2'), ('A-7', '2'), ('B1', '2')])])
+@pytest.mark.parametrize('mode', MODES, ids=lambda mode: ' '.join(mode) or 'groupby')
+def test_log_file_lists_the_guids_of_the_log_level(tmp_path, log_level, logged, mode):
+    run_reference(tmp_path, '-f', os.path.join(FIXTURES, 'mixed.csv'), '-o', str(tmp_path / 'output.csv'), '-i', '3', '-l', log_level, *mode)
+
+    log_paths = list(tmp_path.glob('exportsuredoneepid-log_*.csv.log'))
+    assert len(log_paths) == 1
+    lines = log_paths[0].read_text().splitlines()
+    assert [tuple(value.strip() for value in line.split('|')) for line in lines[2:]] == logged
+
+
+def test_live_values_of_the_export(tmp_path):
+    export_path = tmp_path / 'export.csv'
+    export_path.write_text('guid|title|ebayepid\nA|x|1.0::a\nB|y|2.0\nC|z|3.0\nB|y|2.5\nD|w|\n')
+    buildIndexFromFile(str(export_path), delimiter='|')
+    liveValues = reference.readLiveValues(str(export_path), chunkRows=2)
+
+    assert sorted(liveValues) == ['A', 'B', 'C', 'D']
+    assert reference.isLiveValue(liveValues, 'A', '1.0::a')
+    assert not reference.isLiveValue(liveValues, 'A', '1.0')
+    # a guid with different values in the export is always written
+    assert not reference.isLiveValue(liveValues, 'B', '2.0')
+    assert reference.isLiveValue(liveValues, 'D', '')
+    assert not reference.isLiveValue(liveValues, 'E', '')
+
+
+def test_export_without_ebayepid_is_an_input_error(tmp_path):
+    export_path = tmp_path / 'export.csv'
+    export_path.write_text('guid,title\nA,x\n')
+
+    with pytest.raises(SystemExit) as exit_info:
+        reference.readLiveValues(str(export_path))
+    assert exit_info.value.code == 3
+
+
+def test_guids_that_are_already_live_are_skipped(tmp_path):
+    export_path = tmp_path / 'export.csv'
+    export_path.write_text('guid,ebayepid\n10,3.0*3.0::z\n2,old\nB1,"1.0::q, uoted*9.0"\n')
+    output_path = tmp_path / 'output.csv'
+
+    result = run_reference(tmp_path, '-f', os.path.join(FIXTURES, 'mixed.csv'), '-o', str(output_path), '-i', '2', '-E', str(export_path))
+
+    assert 'Skipped 2 GUIDs whose ebayepid is already live.' in result.stdout
+    assert read_bytes(output_path).splitlines() == [b'action,guid,ebayepid', b'edit,2,7.0::a*nan::b', b'edit,A-7,"4.0::two', b'lines*12.0"']
+
+
+def test_memstats_are_appended_to_the_log_file(tmp_path):
+    run_reference(tmp_path, '-f', os.path.join(FIXTURES, 'mixed.csv'), '-o', str(tmp_path / 'output.csv'), '-l', '0', '-m')
+
+    (log_path,) = tmp_path.glob('exportsuredoneepid-log_*.csv.log')
+    log = log_path.read_text()
+    assert log.startswith('\nMemory per stage')
+    assert all('\n{} '.format(stage) in log for stage in ('read', 'sort', 'main_loop'))
+    assert 'allocation sites at the end of main_loop' in log
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(reference, 'time', clock)
+    return clock
+
+
+def test_progress_is_printed_at_most_every_interval(clock, capsys):
+    progress = reference.ProgressReporter('Combined', 100, interval=500)
+    for rows, now in [(10, 100.0), (10, 100.2), (10, 101.0), (10, 101.3)]:
+        clock.now = now
+        progress.update(rows, 1)
+
+    assert capsys.readouterr().out == 'Combined: 30 rows of 100 (30%), 3 GUIDs | 30 rows/s, 3 GUIDs/s | ETA 0:00:02\r'
+
+
+def test_progress_without_total_has_no_eta(clock, capsys):
+    progress = reference.ProgressReporter('Combined', interval=1000)
+    clock.now = 100.0
+    progress.update(5)
+    clock.now = 102.0
+    progress.update(1995, 10)
+    progress.finish()
+
+    assert capsys.readouterr().out.split('\r') == [
+        'Combined: 2,000 rows, 10 GUIDs | 1,000 rows/s, 5 GUIDs/s',
+        'Combined: 2,000 rows, 10 GUIDs | 1,000 rows/s, 5 GUIDs/s | took 0:00:02\n',
+    ]
+
+
+def test_shorter_progress_lines_overwrite_the_longer_ones(clock, capsys):
+    progress = reference.ProgressReporter('Combined', interval=1000)
+    clock.now = 100.0
+    progress.update(0)
+    clock.now = 101.0
+    progress.update(10**6, 1000)
+    clock.now = 1100.0
+    progress.update(0)
+
+    first, second = capsys.readouterr().out.split('\r')[:2]
+    assert first == 'Combined: 1,000,000 rows, 1,000 GUIDs | 1,000,000 rows/s, 1,000 GUIDs/s'
+    assert second == 'Combined: 1,000,000 rows, 1,000 GUIDs | 1,000 rows/s, 1 GUIDs/s'.ljust(len(first))
+
+
+class FakeClient(object):
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def uploads(monkeypatch, tmp_path):
+    """Bulk files posted by PartUploader, posting waits until uploads['release'] is set."""
+    uploads = {'posted': [], 'release': threading.Event(), 'failing': set()}
+    def post_bulk_file(args, client, logger, input_file, input_file_size, bulk_name):
+        uploads['release'].wait(10)
+        data = input_file.read()
+        assert len(data) == input_file_size
+        uploads['posted'].append((bulk_name, data))
+        if bulk_name.endswith(tuple(uploads['failing'])):
+            raise Exception('status code 500')
+        return {'bulk_name': bulk_name, 'result_file': bulk_name + '_result.csv'}
+    monkeypatch.setattr(reference.suredone_upload, 'create_logger', lambda args: lambda message: None)
+    monkeypatch.setattr(reference.suredone_upload, 'get_credentials', lambda args, logger: {'user': 'user', 'token': 'token'})
+    monkeypatch.setattr(reference.suredone_upload, 'create_client', lambda args, credentials, logger: FakeClient())
+    monkeypatch.setattr(reference.suredone_upload, 'post_bulk_file', post_bulk_file)
+    monkeypatch.chdir(tmp_path)
+    return uploads
+
+
+def create_uploader(partRows):
+    return reference.PartUploader(argparse.Namespace(fetch_results=False, max_concurrent=1, metrics_file=None), partRows)
+
+
+def test_uploader_blocks_while_a_part_is_uploaded_and_one_is_waiting(uploads):
+    uploader = create_uploader(1)
+    writer = threading.Thread(target=lambda: [uploader.writeRow('G{}'.format(number), str(number)) for number in range(3)])
+    writer.start()
+    writer.join(0.2)
+
+    # the first part is being posted and the second waits, the third part can't be submitted yet
+    assert writer.is_alive() and len(uploader.futures) == 2
+    uploads['release'].set()
+    writer.join(10)
+    assert uploader.finish()
+    assert [data.splitlines()[1] for _, data in sorted(uploads['posted'])] == [b'edit,G0,0', b'edit,G1,1', b'edit,G2,2']
+
+
+def test_failed_parts_are_saved_for_a_later_upload(uploads, tmp_path):
+    uploads['release'].set()
+    uploads['failing'].add('_part002')
+    uploader = create_uploader(2)
+    for number in range(5):
+        uploader.writeRow('G{}'.format(number), str(number))
+
+    assert not uploader.finish()
+    assert [bulk_name[-7:] for bulk_name, _ in sorted(uploads['posted'])] == ['part001', 'part002', 'part003']
+    (failed_path,) = tmp_path.glob('exportsuredoneepid-upload_*_part002.csv')
+    assert failed_path.read_bytes() == dict(uploads['posted'])[failed_path.stem]
+    assert failed_path.read_bytes().decode('utf-8').splitlines() == ['action,guid,ebayepid', 'edit,G2,2', 'edit,G3,3']
+
+
+def test_resume_can_not_be_combined_with_upload(tmp_path):
+    with pytest.raises(SystemExit) as exit_info:
+        reference.parseArgs(['-f', os.path.join(FIXTURES, 'mixed.csv'), '-o', str(tmp_path / 'output.csv'), '-r', '-u'])
+    assert exit_info.value.code == 2
+
+
+def test_fingerprints_only_write_the_guids_changed_since_the_last_upload(tmp_path, uploads):
+    uploads['release'].set()
+    input_path = tmp_path / 'input.csv'
+    shutil.copy(os.path.join(FIXTURES, 'mixed.csv'), str(input_path))
+    output_path = tmp_path / 'output.csv'
+    fingerprint_path = tmp_path / 'fingerprints.csv'
+
+    def run(*args):
+        reference.main(['-f', str(input_path), '-o', str(output_path), '-i', '2', '-F', str(fingerprint_path)] + list(args))
+        return read_bytes(output_path)
+
+    expected = read_bytes(os.path.join(FIXTURES, 'mixed_expected.csv'))
+    # without --upload the fingerprints stay as they are
+    assert run() == expected
+    assert run() == expected
+    assert not fingerprint_path.exists()
+
+    assert run('-u') == expected
+    assert run('-u').splitlines() == [b'action,guid,ebayepid']
+    input_path.write_text(input_path.read_text().replace('B1,9,', 'B1,8,'))
+    assert run().splitlines() == [b'action,guid,ebayepid', b'edit,B1,"1.0::q, uoted*8.0"']
+    assert run('-u').splitlines() == [b'action,guid,ebayepid', b'edit,B1,"1.0::q, uoted*8.0"']
+    assert run('-u').splitlines() == [b'action,guid,ebayepid']
@@ -0,0 +1,59 @@
+import hashlib
+
+import pandas as pd
+import pytest
+
+import reference
+import reference_benchmark
+
+SETTINGS = {'guids': 50, 'skew': 1.0, 'bigGroups': 2, 'maxIters': 4, 'noteDensity': 0.2, 'sorted': False, 'seed': 7}
+
+
+@pytest.fixture
+def input_path(tmp_path):
+    input_path = str(tmp_path / 'input.csv')
+    reference_benchmark.generateInput(input_path, 400, SETTINGS)
+    return input_path
+
+
+def test_generated_input_has_the_requested_guids(input_path):
+    frame = pd.read_csv(input_path, dtype=str, keep_default_na=False)
+    sizes = frame['guid'].value_counts()
+
+    assert list(frame.columns) == ['guid', 'Fitment EPID', 'note']
+    assert len(frame) == 400 and len(sizes) == 50
+    assert (sizes == 6).sum() >= 2
+
+
+@pytest.mark.parametrize('engine', reference.ENGINES)
+def test_stages_write_the_output_of_reference(tmp_path, monkeypatch, input_path, engine):
+    monkeypatch.chdir(tmp_path)
+    result = reference_benchmark.timeStages(input_path, engine, 4, str(tmp_path), False)
+
+    output_path = str(tmp_path / 'expected.csv')
+    reference.writeOutput(reference.getEngineRows(reference.readAndSortCSV(input_path), 4, engine, False), output_path)
+    with open(output_path, 'rb') as output_file:
+        assert result['outputHash'] == hashlib.sha1(output_file.read()).hexdigest()
+    assert sorted(result['stages']) == sorted(reference_benchmark.STAGES)
+    assert result['guids'] == 50
+
+
+def baseline(seconds, peakRssMB=100.0):
+    stages = {stage: {'seconds': seconds} for stage in reference_benchmark.STAGES}
+    return {'created': 'earlier', 'pandas': pd.__version__, 'results': [
+        {'rows': 400, 'engine': 'groupby', 'stages': stages, 'peakRssMB': peakRssMB, 'outputHash': 'x'}
+    ]}
+
+
+def test_compare_reports_stages_over_the_tolerance():
+    regressions = reference_benchmark.compareResults(baseline(1.0), baseline(1.5, 105.0), 0.2)
+
+    assert [(stage, metric) for _, _, stage, metric, _, _ in regressions] == [(stage, 'seconds') for stage in reference_benchmark.STAGES]
+    assert reference_benchmark.compareResults(baseline(1.0), baseline(1.1), 0.2) == []
+
+
+def test_compare_ignores_tiny_changes_and_a_missing_peak_rss():
+    assert reference_benchmark.compareResults(baseline(0.01), baseline(0.03, 100.5), 0.2) == []
+    assert reference_benchmark.compareResults(baseline(0.01), baseline(0.03), 0.2, minSeconds=0.01) != []
+    assert reference_benchmark.compareResults(baseline(1.0, 100.0), baseline(1.0, None), 0.2) == []
+    assert reference_benchmark.compareResults(baseline(1.0, None), baseline(1.0, 200.0), 0.2) == []
@@ -0,0 +1,120 @@
+import time
+
+import pytest
+
+from suredone_client import API_ENDPOINT, RATE_LIMIT_WAIT, Deadline, DeadlineExceeded, RateLimiter, SureDone, getRateLimitWait
+
+
+def test_deadline_without_limit_never_expires():
+    deadline = Deadline(None, 'run')
+
+    assert deadline.remaining() is None
+    assert deadline.clamp(30) == 30
+    deadline.check()
+
+
+def test_phase_deadline_is_bounded_by_the_run_deadline():
+    run = Deadline(1, 'run')
+    phase = Deadline(100, 'download', parent=run)
+
+    assert 0 < phase.remaining() <= 1
+    assert phase.clamp(30) <= 1
+    assert phase.clamp(0.5) == 0.5
+
+
+def test_expired_deadline_fails_checks_and_timeouts():
+    deadline = Deadline(0.01, 'export_request')
+    time.sleep(0.02)
+
+    with pytest.raises(DeadlineExceeded, match='export_request'):
+        deadline.check()
+    with pytest.raises(DeadlineExceeded):
+        deadline.clamp(30)
+
+
+def test_deadline_does_not_sleep_past_itself():
+    deadline = Deadline(10, 'download')
+    start = time.time()
+
+    with pytest.raises(DeadlineExceeded, match='needs a 60 seconds wait'):
+        deadline.sleep(60)
+    assert time.time() - start < 1
+
+
+def test_rate_limiter_spaces_out_the_requests():
+    limiter = RateLimiter(20)
+    deadline = Deadline(None, 'run')
+    start = time.time()
+    for _ in range(5):
+        limiter.wait(deadline)
+
+    assert time.time() - start >= 0.19
+
+
+def test_rate_limiter_holds_every_request_while_paused():
+    limiter = RateLimiter()
+    deadline = Deadline(None, 'run')
+    start = time.time()
+    limiter.wait(deadline)
+    assert time.time() - start < 0.05
+
+    limiter.pause(0.1)
+    limiter.wait(deadline)
+    assert time.time() - start >= 0.09
+
+
+def test_paused_rate_limiter_fails_a_call_that_would_pass_its_deadline():
+    limiter = RateLimiter()
+    limiter.pause(60)
+
+    with pytest.raises(DeadlineExceeded):
+        limiter.wait(Deadline(1, 'export_request'))
+
+
+class HeaderResponse(object):
+    def __init__(self, headers):
+        self.headers = headers
+
+
+@pytest.mark.parametrize('headers, wait', [
+    ({'X-Rate-Limit-Time-Reset-Ms': '2500'}, 2.5),
+    ({'X-Rate-Limit-Time-Reset-Ms': '10'}, 1),
+    ({'X-Rate-Limit-Time-Reset-Ms': 'soon'}, RATE_LIMIT_WAIT),
+    ({}, RATE_LIMIT_WAIT),
+])
+def test_rate_limit_wait_is_read_from_the_reset_header(headers, wait):
+    assert getRateLimitWait(HeaderResponse(headers)) == wait
+
+
+class RecordingSession(object):
+    def __init__(self, status_code=200):
+        self.status_code = status_code
+        self.requests = []
+
+    def request(self, method, url, headers=None, timeout=None, **kwargs):
+        self.requests.append((method, url, headers))
+        response = HeaderResponse({'X-Rate-Limit-Time-Reset-Ms': '5000'})
+        response.status_code = self.status_code
+        response.content = b'{}'
+        return response
+
+
+def test_auth_headers_are_only_sent_to_the_api():
+    client = SureDone('user', 'token', 30)
+    client.session = RecordingSession()
+    client.request('get', 'editor/items', params={'page': 1})
+    client.request('get', 'https://downloads.example.com/export.csv', headers={'Range': 'bytes=0-'})
+
+    (method, url, api_headers), (_, external_url, external_headers) = client.session.requests
+    assert (method, url) == ('GET', API_ENDPOINT + 'editor/items')
+    assert (api_headers['x-auth-user'], api_headers['x-auth-token']) == ('user', 'token')
+    assert external_url == 'https://downloads.example.com/export.csv'
+    assert external_headers == {'Range': 'bytes=0-'}
+
+
+def test_rate_limited_response_pauses_the_client():
+    client = SureDone('user', 'token', 30)
+    client.session = RecordingSession(429)
+    client.request('get', 'editor/items')
+
+    assert 4 < client.rateLimiter.pausedUntil - time.time() <= 5
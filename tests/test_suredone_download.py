@@ -0,0 +1,188 @@
+import csv
+import io
+import time
+
+import pytest
+
+import suredone_download
+from suredone_download import ChannelSplitter, CsvStreamParser, StallWatchdog, StalledDownloadError
+
+CONTENT = 'guid,title,note\r\nA,"multi\nline ""quoted""",x\nB,Äpfel,"a,b"\n"C\n\n",,"""\n'
+
+
+def parse(data, chunk_size, delimiter=','):
+    rows = []
+    parser = CsvStreamParser(rows.append, delimiter=delimiter)
+    for start in range(0, len(data), chunk_size):
+        parser.feed(data[start:start + chunk_size])
+    parser.close()
+    return rows
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 1 << 20])
+def test_rows_match_csv_reader_in_any_chunking(chunk_size):
+    expected = list(csv.reader(io.StringIO(CONTENT, newline='')))
+
+    assert parse(CONTENT.encode('utf-8'), chunk_size) == expected
+
+
+def test_last_row_without_new_line():
+    assert parse(b'guid;note\nA;"x\ny"', 4, delimiter=';') == [['guid', 'note'], ['A', 'x\ny']]
+
+
+def test_unbalanced_quote_is_flushed_on_close():
+    assert parse(b'guid,note\nA,"open\n', 5) == [['guid', 'note'], ['A', 'open\n']]
+
+
+def test_channel_files_keep_common_and_own_columns(tmp_path):
+    download_path = str(tmp_path / 'export.csv')
+    splitter = ChannelSplitter(download_path, ['ebay', 'amazon'], delimiter='|')
+    splitter.feed(b'title,guid,ebayprice,amznprice,ebayskip\nx,A,1,2,0\ny,B,3,4,yes\n')
+    splitter.close()
+
+    with open(splitter.getChannelFilePath('ebay')) as ebay_file:
+        assert ebay_file.read() == 'guid|title|ebayprice|ebayskip\nA|x|1|0\n'
+    with open(splitter.getChannelFilePath('amazon')) as amazon_file:
+        assert amazon_file.read() == 'guid|title|amznprice\nA|x|2\nB|y|4\n'
+    assert splitter.skipCounts == {'ebay': 1, 'amazon': 0}
+
+
+class FakeSureDone(object):
+    """ Items endpoint with 'total' items, page 2 answers last so the pages arrive out of order. """
+    def __init__(self, total):
+        self.total = total
+        self.calls = []
+        self.count = str(total)
+
+    def apicall(self, typ, endpoint, data=None, deadline=None):
+        self.calls.append((endpoint, data['page']))
+        if data['page'] == 2:
+            time.sleep(0.05)
+        first = (data['page'] - 1) * suredone_download.ITEMS_PER_PAGE
+        count = max(0, min(suredone_download.ITEMS_PER_PAGE, self.total - first))
+        page = {'result': 'success', 'all': self.count}
+        for number in range(1, count + 1):
+            page[str(number)] = {'guid': 'G{}'.format(first + number), 'stock': first + number, 'meta': {'a': 1}}
+        return page
+
+
+class CollectingSink(object):
+    def __init__(self):
+        self.chunks = []
+
+    def feed(self, chunk):
+        self.chunks.append(chunk)
+
+    def close(self):
+        pass
+
+
+@pytest.mark.parametrize('total, expected', [(120, 'paged'), (121, 'bulk')])
+def test_auto_mode_pages_results_up_to_the_limit(total, expected):
+    sureDone = FakeSureDone(total)
+    mode, firstPage = suredone_download.chooseAcquisitionMode(sureDone, 'auto', '', 120)
+
+    assert mode == expected
+    assert firstPage['1']['guid'] == 'G1'
+    assert sureDone.calls == [('editor/items', 1)]
+
+
+def test_bulk_mode_does_not_request_a_page():
+    sureDone = FakeSureDone(10)
+
+    assert suredone_download.chooseAcquisitionMode(sureDone, 'bulk', '', 120) == ('bulk', None)
+    assert sureDone.calls == []
+
+
+def test_paged_mode_requests_the_search_endpoint():
+    sureDone = FakeSureDone(10)
+    mode, firstPage = suredone_download.chooseAcquisitionMode(sureDone, 'paged', 'brand:=acme tires', 0)
+
+    assert mode == 'paged'
+    assert sureDone.calls == [('search/items/brand%3A%3Dacme%20tires', 1)]
+
+
+@pytest.mark.parametrize('count', [None, 'many'])
+def test_auto_mode_falls_back_to_bulk_without_an_item_count(count):
+    sureDone = FakeSureDone(10)
+    sureDone.count = count
+
+    assert suredone_download.chooseAcquisitionMode(sureDone, 'auto', '', 120) == ('bulk', None)
+
+
+def test_auto_mode_always_pages_a_query():
+    sureDone = FakeSureDone(500)
+
+    assert suredone_download.chooseAcquisitionMode(sureDone, 'auto', 'brand:=acme', 120)[0] == 'paged'
+
+
+@pytest.mark.parametrize('mode, query', [('paged', ''), ('auto', 'brand:=acme')])
+def test_paging_stops_without_an_item_count(mode, query):
+    sureDone = FakeSureDone(10)
+    sureDone.count = None
+
+    with pytest.raises(SystemExit):
+        suredone_download.chooseAcquisitionMode(sureDone, mode, query, 120)
+
+
+def parse_settings(tmp_path, *argv):
+    config_path = tmp_path / 'config.yaml'
+    config_path.write_text('user: user\ntoken: token\n')
+    settings = suredone_download.parseArgs(['-f', str(config_path), '-o', str(tmp_path / 'export.csv')] + list(argv))
+    return dict(zip(('mode', 'query'), settings[7:9]))
+
+
+def test_bulk_is_the_default_mode(tmp_path):
+    assert parse_settings(tmp_path) == {'mode': 'bulk', 'query': ''}
+    assert parse_settings(tmp_path, '-m', 'Auto', '-q', 'brand:=acme') == {'mode': 'auto', 'query': 'brand:=acme'}
+    assert parse_settings(tmp_path, '-m', 'everything') == {'mode': 'bulk', 'query': ''}
+    assert parse_settings(tmp_path, '-q', 'brand:=acme') == {'mode': 'paged', 'query': 'brand:=acme'}
+
+
+def test_bulk_mode_rejects_a_query(tmp_path):
+    with pytest.raises(SystemExit) as exit_info:
+        parse_settings(tmp_path, '-m', 'bulk', '-q', 'brand:=acme')
+    assert exit_info.value.code == 2
+
+
+def test_paged_download_writes_the_pages_in_order(tmp_path):
+    sureDone = FakeSureDone(120)
+    download_path = str(tmp_path / 'paged.csv')
+    sink = CollectingSink()
+    _, firstPage = suredone_download.chooseAcquisitionMode(sureDone, 'paged', '', 0)
+
+    suredone_download.downloadPagedItems(sureDone, '', ['guid', 'stock', 'meta'], firstPage, download_path, delimiter=';', workers=2, sinks=[sink])
+
+    with open(download_path, 'rb') as download_file:
+        content = download_file.read()
+    rows = list(csv.reader(io.StringIO(content.decode('utf-8'), newline=''), delimiter=';'))
+    assert rows[0] == ['guid', 'stock', 'meta']
+    assert rows[1] == ['G1', '1', '{"a": 1}']
+    assert [row[0] for row in rows[1:]] == ['G{}'.format(number) for number in range(1, 121)]
+    assert sorted(page for _, page in sureDone.calls) == [1, 2, 3]
+    assert b''.join(sink.chunks) == content
+
+
+def test_watchdog_raises_below_the_throughput_floor():
+    watchdog = StallWatchdog(1000, 0.05)
+    watchdog.update(10)
+    time.sleep(0.06)
+
+    with pytest.raises(StalledDownloadError):
+        watchdog.update(10)
+
+
+def test_watchdog_starts_a_new_window_after_enough_throughput():
+    watchdog = StallWatchdog(1000, 0.05)
+    time.sleep(0.06)
+    watchdog.update(10**6)
+
+    assert watchdog.windowBytes == 0
+    watchdog.update(10)
+    assert watchdog.windowBytes == 10
+
+
+def test_disabled_watchdog_never_raises():
+    watchdog = StallWatchdog(0, 0)
+    time.sleep(0.01)
+    watchdog.update(0)
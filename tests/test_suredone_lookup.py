@@ -0,0 +1,51 @@
+from suredone_lookup import GuidIndex, GuidIndexBuilder, buildIndexFromFile, getIndexPath
+
+
+def build(tmp_path, content, delimiter=','):
+    csv_path = tmp_path / 'export.csv'
+    csv_path.write_bytes(content.encode('utf-8'))
+    count = buildIndexFromFile(str(csv_path), delimiter=delimiter)
+    return str(csv_path), count
+
+
+def test_lookup_finds_every_row_of_a_guid(tmp_path):
+    csv_path, count = build(tmp_path, 'title,guid\nfirst,B\n"two\nlines",A\nthird,C\nfourth,A\n')
+    index = GuidIndex(getIndexPath(csv_path))
+    try:
+        assert count == 4
+        assert [index.readRow(csv_path, offset) for offset in index.lookup('A')] == [['two\nlines', 'A'], ['fourth', 'A']]
+        assert index.readRow(csv_path, index.lookup('C')[0]) == ['third', 'C']
+        assert index.lookup('D') == []
+        assert index.lookup('') == []
+    finally:
+        index.close()
+
+
+def test_lookup_with_delimiter_and_non_ascii_guids(tmp_path):
+    csv_path, count = build(tmp_path, 'guid|title\nÄ-1|x\nZ|"a|b"\nA-1|y', delimiter='|')
+    index = GuidIndex(getIndexPath(csv_path))
+    try:
+        assert index.delimiter == '|'
+        assert index.readRow(csv_path, index.lookup('Ä-1')[0]) == ['Ä-1', 'x']
+        assert index.readRow(csv_path, index.lookup('Z')[0]) == ['Z', 'a|b']
+        assert index.readRow(csv_path, index.lookup('A-1')[0]) == ['A-1', 'y']
+    finally:
+        index.close()
+
+
+def test_builder_indexes_rows_split_across_download_chunks(tmp_path):
+    content = 'guid,note\r\nB,"x\r\ny"\r\nA,z'.encode('utf-8')
+    csv_path = str(tmp_path / 'export.csv')
+    with open(csv_path, 'wb') as csv_file:
+        csv_file.write(content)
+    builder = GuidIndexBuilder(csv_path)
+    for start in range(0, len(content), 3):
+        builder.feed(content[start:start + 3])
+
+    assert builder.close() == 2
+    index = GuidIndex(getIndexPath(csv_path))
+    try:
+        assert index.readRow(csv_path, index.lookup('B')[0]) == ['B', 'x\r\ny']
+        assert index.readRow(csv_path, index.lookup('A')[0]) == ['A', 'z']
+    finally:
+        index.close()
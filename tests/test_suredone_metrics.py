@@ -0,0 +1,42 @@
+from suredone_metrics import MetricsRegistry, getEndpointLabel
+
+
+def test_render_counters_gauges_and_histograms():
+    metrics = MetricsRegistry('suredone_test')
+    metrics.incCounter('api_calls_total', labels={'endpoint': 'bulk/exports', 'status': '200'})
+    metrics.incCounter('api_calls_total', 2, labels={'status': '200', 'endpoint': 'bulk/exports'})
+    metrics.setGauge('last_run_success', 1)
+    metrics.observe('stage_duration_seconds', 0.3, labels={'stage': 'download'}, buckets=(0.1, 1))
+
+    assert metrics.render().splitlines() == [
+        '# HELP suredone_test_api_calls_total SureDone API calls by endpoint and HTTP status.',
+        '# TYPE suredone_test_api_calls_total counter',
+        'suredone_test_api_calls_total{endpoint="bulk/exports",status="200"} 3',
+        '# HELP suredone_test_last_run_success 1 if the run finished successfully, 0 otherwise.',
+        '# TYPE suredone_test_last_run_success gauge',
+        'suredone_test_last_run_success 1',
+        '# HELP suredone_test_stage_duration_seconds Duration of the named stages of the run.',
+        '# TYPE suredone_test_stage_duration_seconds histogram',
+        'suredone_test_stage_duration_seconds_bucket{stage="download",le="0.1"} 0',
+        'suredone_test_stage_duration_seconds_bucket{stage="download",le="1"} 1',
+        'suredone_test_stage_duration_seconds_bucket{stage="download",le="+Inf"} 1',
+        'suredone_test_stage_duration_seconds_sum{stage="download"} 0.3',
+        'suredone_test_stage_duration_seconds_count{stage="download"} 1',
+    ]
+
+
+def test_write_textfile_replaces_the_file(tmp_path):
+    path = str(tmp_path / 'textfile' / 'suredone_test.prom')
+    metrics = MetricsRegistry('suredone_test')
+    metrics.incCounter('rows_exported_total', 5)
+    metrics.writeTextfile(path)
+
+    with open(path) as textfile:
+        assert textfile.read().endswith('suredone_test_rows_exported_total 5\n')
+    assert list((tmp_path / 'textfile').iterdir()) == [tmp_path / 'textfile' / 'suredone_test.prom']
+
+
+def test_endpoint_labels_drop_file_names_and_queries():
+    assert getEndpointLabel('bulk/exports/export-1.csv') == 'bulk/exports'
+    assert getEndpointLabel('/search/items/brand%3Aacme') == 'search/items'
+    assert getEndpointLabel('editor/items') == 'editor/items'
@@ -0,0 +1,86 @@
+import os
+import threading
+import tracemalloc
+
+from suredone_profiler import Profiler
+
+
+def test_stages_are_not_recorded_until_started(tmp_path):
+    profiler = Profiler()
+    with profiler.stage('read'):
+        pass
+
+    assert profiler.stages == []
+    assert profiler.finish(str(tmp_path / 'run')) == []
+
+
+def test_peak_of_an_inner_stage_counts_for_the_outer_stage(tmp_path):
+    profiler = Profiler()
+    profiler.start()
+    with profiler.stage('outer'):
+        with profiler.stage('inner'):
+            data = bytearray(10**7)
+            del data
+    paths = profiler.finish(str(tmp_path / 'run'))
+
+    (innerName, _, innerStart, _, innerPeak), (outerName, _, _, _, outerPeak) = [stage[:5] for stage in profiler.stages]
+    assert (innerName, outerName) == ('inner', 'outer')
+    assert innerPeak - innerStart >= 10**7
+    assert outerPeak >= innerPeak
+    assert paths == [str(tmp_path / name) for name in ('run.prof', 'run_profile.txt', 'run_memory.txt')]
+    assert all(os.path.getsize(path) > 0 for path in paths)
+    with open(paths[2]) as memoryFile:
+        report = memoryFile.read()
+    assert 'inner' in report and 'outer' in report
+
+
+def test_memory_only_profiler_lists_the_sites_of_every_stage(tmp_path):
+    profiler = Profiler()
+    profiler.start(cpu=False, stageSites=3)
+    with profiler.stage('read'):
+        data = [bytes(1000) for _ in range(100)]
+    report = profiler.formatMemory()
+
+    assert profiler.finish(str(tmp_path / 'run')) == []
+    assert list(tmp_path.iterdir()) == []
+    (name, _, startMemory, endMemory, _, rss, peakRss), = profiler.stages
+    assert name == 'read' and endMemory - startMemory >= 10**5
+    assert 0 < rss <= peakRss
+    assert 'Top 3 allocation sites at the end of read' in report
+    del data
+
+
+def test_stages_of_worker_threads_only_record_their_duration(tmp_path):
+    profiler = Profiler()
+    profiler.start(cpu=False)
+
+    def upload():
+        with profiler.stage('upload'):
+            pass
+
+    with profiler.stage('main_loop'):
+        worker = threading.Thread(target=upload)
+        worker.start()
+        worker.join()
+    profiler.finish(str(tmp_path / 'run'))
+
+    assert profiler.stages[0][0] == 'upload [thread]'
+    assert profiler.stages[0][2:] == (None,) * 5
+    assert profiler.stages[1][0] == 'main_loop' and profiler.stages[1][2] is not None
+
+
+def test_peaks_are_kept_since_the_start_without_reset_peak(tmp_path, monkeypatch):
+    monkeypatch.delattr(tracemalloc, 'reset_peak', raising=False)
+    profiler = Profiler()
+    profiler.start(cpu=False)
+    with profiler.stage('big'):
+        data = bytearray(10**7)
+        del data
+    with profiler.stage('small'):
+        pass
+    report = profiler.formatMemory()
+    profiler.finish(str(tmp_path / 'run'))
+
+    (_, _, _, _, bigPeak), (_, _, smallStart, _, smallPeak) = [stage[:5] for stage in profiler.stages]
+    assert bigPeak >= 10**7 and smallPeak >= bigPeak > smallStart + 10**6
+    assert 'Peaks are the peaks since tracing started' in report
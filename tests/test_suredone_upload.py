@@ -0,0 +1,434 @@
+import argparse
+import io
+import json
+import os
+import shutil
+import time
+
+import pytest
+
+import suredone_upload
+from suredone_client import API_ENDPOINT, SureDone
+from suredone_lookup import buildIndexFromFile
+from conftest import FIXTURES
+
+
+def no_log(message):
+    pass
+
+
+def read_body(stream, size):
+    body = b''
+    while True:
+        data = stream.read(size)
+        if not data:
+            return body
+        body += data
+
+
+@pytest.mark.parametrize('block_size', [1, 5, 64, 8192])
+def test_multipart_body_wraps_the_file(block_size):
+    data = b'action,guid\nedit,A\n'
+    stream = suredone_upload.MultipartFileStream('bulk_file', 'bulk_file', io.BytesIO(data), len(data), no_log)
+    body = read_body(stream, block_size)
+
+    boundary = stream.content_type.split('boundary=')[1]
+    assert body == (
+        '--{0}\r\nContent-Disposition: form-data; name="bulk_file"; filename="bulk_file"\r\n'
+        'Content-Type: application/octet-stream\r\n\r\n'.format(boundary).encode('utf-8')
+        + data + '\r\n--{0}--\r\n'.format(boundary).encode('utf-8')
+    )
+    assert len(stream) == len(body) == stream.bytes_sent
+
+
+def test_multipart_body_sends_only_the_given_bytes():
+    data = b'action,guid\nedit,A\n'
+    input_file = io.BytesIO(b'skipped|' + data + b'|trailing')
+    input_file.seek(8)
+    stream = suredone_upload.MultipartFileStream('bulk_file', 'part.csv', input_file, len(data), no_log)
+    body = read_body(stream, 7)
+
+    assert b'\r\n\r\n' + data + b'\r\n--' in body
+    assert b'skipped' not in body and b'trailing' not in body
+
+
+def test_multipart_body_fails_on_a_short_file():
+    stream = suredone_upload.MultipartFileStream('bulk_file', 'bulk_file', io.BytesIO(b'abc'), 10, no_log)
+    with pytest.raises(IOError):
+        read_body(stream, 4)
+
+
+
+def write_input(tmp_path, content):
+    input_path = tmp_path / 'input.csv'
+    input_path.write_bytes(content)
+    return str(input_path)
+
+
+SPLIT_ROWS = [b'edit,A,x\n', b'edit,B,"two\nlines"\n', b'edit,C,y\n', b'edit,A,z\n', b'edit,D,w\n', b'edit,B,v']
+
+
+def read_parts(parts):
+    contents = []
+    for part_path, row_count in parts:
+        with open(part_path, 'rb') as part_file:
+            records = list(suredone_upload.iter_csv_records(part_file))
+        assert len(records) == row_count + 1
+        contents.append(records)
+    return contents
+
+
+def test_split_keeps_the_rows_of_a_guid_in_one_part(tmp_path):
+    input_path = write_input(tmp_path, b'action,guid,title\n' + b''.join(SPLIT_ROWS))
+    parts = suredone_upload.split_input_file(input_path, 3, no_log)
+    contents = read_parts(parts)
+
+    assert all(os.path.dirname(part_path) == str(tmp_path / 'input_parts') for part_path, _ in parts)
+    assert all(records[0] == b'action,guid,title\n' for records in contents)
+    # the last row gets the new line it was missing
+    assert sorted(record for records in contents for record in records[1:]) == sorted(SPLIT_ROWS[:-1] + [b'edit,B,v\n'])
+    part_guids = [set(suredone_upload.parse_csv_record(record)[1] for record in records[1:]) for records in contents]
+    assert sum(len(guids) for guids in part_guids) == 4
+
+
+def test_split_finds_a_leading_guid_column_after_a_bom(tmp_path):
+    input_path = write_input(tmp_path, b'\xef\xbb\xbfguid,action\nA,edit\nB,edit\nA,edit\n')
+    contents = read_parts(suredone_upload.split_input_file(input_path, 8, no_log))
+
+    part_guids = [sorted(suredone_upload.parse_csv_record(record)[0] for record in records[1:]) for records in contents]
+    assert sorted(part_guids) == [['A', 'A'], ['B']]
+
+
+def test_split_without_guid_deals_the_rows_in_turn(tmp_path):
+    input_path = write_input(tmp_path, b'action,title\nedit,a\nedit,b\nedit,c\n')
+    contents = read_parts(suredone_upload.split_input_file(input_path, 2, no_log))
+
+    assert contents == [[b'action,title\n', b'edit,a\n', b'edit,c\n'], [b'action,title\n', b'edit,b\n']]
+
+
+def fake_upload(failing):
+    def upload(args, client, logger, input_file_path):
+        if os.path.basename(input_file_path) in failing:
+            raise Exception('status code 500')
+        name = os.path.splitext(os.path.basename(input_file_path))[0]
+        return {'bulk_name': name, 'request_file': name + '_request.csv', 'result_file': name + '_result.csv'}
+    return upload
+
+
+def upload_parts(tmp_path, monkeypatch, failing):
+    monkeypatch.setattr(suredone_upload, 'suredone_upload', fake_upload(failing))
+    input_path = write_input(tmp_path, b'action,guid\n' + b''.join(b'edit,G%d\n' % number for number in range(20)))
+    args = argparse.Namespace(split_parts=4, max_concurrent=2, log=str(tmp_path / 'log'))
+    return suredone_upload.upload_in_parts(args, None, no_log, input_path)
+
+
+def test_failed_parts_are_kept_next_to_the_manifest(tmp_path, monkeypatch):
+    with pytest.raises(Exception, match='1 of 4 parts failed'):
+        upload_parts(tmp_path, monkeypatch, {'input_part02.csv'})
+
+    parts_directory = tmp_path / 'input_parts'
+    assert sorted(os.listdir(str(parts_directory))) == ['input_part02.csv', 'manifest.json']
+    with open(str(parts_directory / 'manifest.json')) as manifest:
+        results = json.load(manifest)
+    assert [result['status'] for result in results] == ['success', 'failed', 'success', 'success']
+    assert results[0]['result_file'] == 'input_part01_result.csv'
+    assert results[1]['error'] == 'status code 500'
+    assert sum(result['rows'] for result in results) == 20
+
+
+def test_parts_are_removed_and_the_manifest_kept_after_a_successful_upload(tmp_path, monkeypatch):
+    results = upload_parts(tmp_path, monkeypatch, set())
+
+    assert [result['status'] for result in results] == ['success'] * 4
+    assert not os.path.exists(str(tmp_path / 'input_parts'))
+    manifest_name, = os.listdir(str(tmp_path / 'log'))
+    assert manifest_name.startswith('input_manifest_') and manifest_name.endswith('.json')
+    with open(str(tmp_path / 'log' / manifest_name)) as manifest:
+        assert json.load(manifest) == results
+
+
+def run_batch(tmp_path, monkeypatch, changes, failing=(), watch=True):
+    """Runs upload_batch over the .csv files of tmp_path, changes[i]() is called after poll i + 1.
+
+    Returns the results and the (poll, file name) of every upload.
+    """
+    polls = [1]
+    uploads = []
+    def upload_file(args, client, logger, input_file_path, poller=None):
+        uploads.append((polls[-1], os.path.basename(input_file_path)))
+        if os.path.basename(input_file_path) in failing:
+            raise Exception('status code 500')
+    def sleep(seconds):
+        if polls[-1] > len(changes):
+            raise KeyboardInterrupt
+        changes[polls[-1] - 1]()
+        polls.append(polls[-1] + 1)
+    monkeypatch.setattr(suredone_upload, 'upload_file', upload_file)
+    monkeypatch.setattr(suredone_upload.time, 'sleep', sleep)
+
+    args = argparse.Namespace(input_glob=str(tmp_path), watch=watch, poll_interval=30, workers=2)
+    return suredone_upload.upload_batch(args, None, no_log), sorted(uploads)
+
+
+def append(path, data):
+    with open(str(path), 'ab') as appended:
+        appended.write(data)
+
+
+def nothing():
+    pass
+
+
+def test_batch_uploads_every_file_once(tmp_path, monkeypatch):
+    for name in ('a.csv', 'b.csv', 'notes.txt'):
+        (tmp_path / name).write_bytes(b'action,guid\nedit,A\n')
+
+    results, uploads = run_batch(tmp_path, monkeypatch, [], failing={'b.csv'}, watch=False)
+
+    assert uploads == [(1, 'a.csv'), (1, 'b.csv')]
+    assert sorted((os.path.basename(result['file']), result['status']) for result in results) == [('a.csv', 'success'), ('b.csv', 'failed')]
+
+
+def test_watch_uploads_files_once_they_stop_changing(tmp_path, monkeypatch):
+    (tmp_path / 'a.csv').write_bytes(b'action,guid\nedit,A\n')
+    (tmp_path / 'b.csv').write_bytes(b'action,guid\n')
+
+    results, uploads = run_batch(tmp_path, monkeypatch, [
+        lambda: append(tmp_path / 'b.csv', b'edit,B\n'),  # b is still being written
+        nothing,
+        lambda: append(tmp_path / 'a.csv', b'edit,C\n'),  # a changes after its upload
+        nothing,
+        nothing,
+    ])
+
+    assert uploads == [(2, 'a.csv'), (3, 'b.csv'), (5, 'a.csv')]
+    assert [result['status'] for result in results] == ['success'] * 3
+
+
+def test_watch_uploads_a_failed_file_again_only_after_it_changed(tmp_path, monkeypatch):
+    (tmp_path / 'a.csv').write_bytes(b'action,guid\nedit,A\n')
+    (tmp_path / 'b.csv').write_bytes(b'action,guid\nedit,B\n')
+
+    results, uploads = run_batch(tmp_path, monkeypatch, [
+        nothing,
+        nothing,
+        lambda: append(tmp_path / 'a.csv', b'edit,C\n'),  # a is written again
+        nothing,
+        nothing,
+    ], failing={'a.csv'})
+
+    assert uploads == [(2, 'a.csv'), (2, 'b.csv'), (5, 'a.csv')]
+    assert sorted((os.path.basename(result['file']), result['status']) for result in results) == [
+        ('a.csv', 'failed'), ('a.csv', 'failed'), ('b.csv', 'success')]
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, body=b'', content_type='text/csv'):
+        self.status_code = status_code
+        self.body = body
+        self.headers = {'Content-Type': content_type}
+
+    def json(self):
+        return json.loads(self.body.decode('utf-8'))
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeSession(object):
+    """Answers every url with its responses in turn, the last one again once they are used up."""
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def request(self, method, url, headers=None, **kwargs):
+        self.requests.append((url, headers))
+        responses = self.responses[url]
+        return responses.pop(0) if len(responses) > 1 else responses[0]
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+
+def poll_results(tmp_path, session, result_files, result_timeout=60):
+    args = argparse.Namespace(log=str(tmp_path / 'log'), result_timeout=result_timeout)
+    client = SureDone('user', 'token', 30)
+    client.session = session
+    poller = suredone_upload.ResultPoller(args, client, no_log)
+    poller.initial_delay = 0
+    for number, result_file in enumerate(result_files):
+        poller.track({'bulk_name': 'job{0}'.format(number), 'result_file': result_file, 'submitted_at': time.time(), 'bytes': 100})
+    return sorted(poller.close_and_wait(), key=lambda job: job['bulk_name'])
+
+
+RESULT_CSV = b'action,guid,result\nedit,A,success\nedit,B,Failure: bad price\nedit,C,OK\n'
+
+
+def test_poller_fetches_the_result_once_it_is_ready(tmp_path):
+    url = API_ENDPOINT + suredone_upload.ResultPoller.results_endpoint + 'result-1.csv'
+    session = FakeSession({url: [FakeResponse(404), FakeResponse(404), FakeResponse(200, RESULT_CSV)]})
+
+    jobs = poll_results(tmp_path, session, ['result-1.csv'])
+
+    assert [(job['status'], job['rows'], job['succeeded'], job['failed']) for job in jobs] == [('done', 3, 2, 1)]
+    with open(jobs[0]['result_path'], 'rb') as result_file:
+        assert result_file.read() == RESULT_CSV
+    assert jobs[0]['result_path'] == str(tmp_path / 'log' / 'job0_result.csv')
+    assert len(session.requests) == 3
+    assert session.requests[0][1]['x-auth-token'] == 'token'
+
+
+def test_poller_follows_the_download_url_of_a_json_answer(tmp_path):
+    url = API_ENDPOINT + suredone_upload.ResultPoller.results_endpoint + 'result-1.csv'
+    download_url = 'https://downloads.example.com/result-1.csv'
+    session = FakeSession({
+        url: [FakeResponse(200, b'{"result": "success", "url": "' + download_url.encode('utf-8') + b'"}', 'application/json')],
+        download_url: [FakeResponse(200, RESULT_CSV)]
+    })
+
+    jobs = poll_results(tmp_path, session, ['result-1.csv'])
+
+    assert jobs[0]['status'] == 'done' and jobs[0]['failed'] == 1
+    assert [request_url for request_url, _ in session.requests] == [url, download_url]
+    # the storage url is fetched without the API credentials
+    assert session.requests[1][1] is None
+
+
+def test_poller_gives_up_after_the_result_timeout(tmp_path):
+    url = API_ENDPOINT + suredone_upload.ResultPoller.results_endpoint + 'result-1.csv'
+    session = FakeSession({url: [FakeResponse(404)]})
+
+    jobs = poll_results(tmp_path, session, ['result-1.csv'], result_timeout=0)
+
+    assert [job['status'] for job in jobs] == ['timeout']
+
+
+@pytest.mark.parametrize('new_value, old_value, column, match', [
+    ('5', '5.00', 'title', True),
+    ('-1.50', '-1.5', 'title', True),
+    ('012345', '12345', 'mpn', False),
+    ('1e3', '1000', 'title', False),
+    ('nan', 'nan', 'title', True),
+    ('1e3', '1000', 'weight', True),
+    ('007', '7', 'stock', True),
+    ('n/a', '0', 'price', False),
+])
+def test_only_plain_decimals_and_numeric_columns_match_by_value(new_value, old_value, column, match):
+    assert suredone_upload.values_match(new_value, old_value, column) is match
+
+
+def test_diff_keeps_a_value_that_only_lost_its_leading_zero(tmp_path):
+    snapshot_path = tmp_path / 'export.csv'
+    snapshot_path.write_text('guid,mpn,stock\nA,12345,3\n')
+    input_path = write_input(tmp_path, b'action,guid,mpn,stock\nedit,A,012345,03\n')
+    args = argparse.Namespace(diff_against=str(snapshot_path), diff_delimiter=',')
+
+    diff_path = suredone_upload.diff_input_file(args, no_log, input_path)
+
+    with open(diff_path) as diff_file:
+        assert diff_file.read() == 'action,guid,mpn\nedit,A,012345\n'
+
+
+def test_result_rows_are_counted_by_their_status(tmp_path):
+    result_path = tmp_path / 'result.csv'
+    result_path.write_text('action,guid,Status\nedit,A,ok\nedit,B,error\n\nedit,C\n')
+
+    assert suredone_upload.count_result_rows(str(result_path)) == {'rows': 3, 'succeeded': 1, 'failed': 1, 'unknown': 1}
+
+
+def test_result_rows_without_a_status_are_unknown(tmp_path):
+    result_path = tmp_path / 'result.csv'
+    result_path.write_text('action,guid\nedit,A\nedit,B\n')
+
+    assert suredone_upload.count_result_rows(str(result_path)) == {'rows': 2, 'succeeded': 0, 'failed': 0, 'unknown': 2}
+
+
+def test_validation_counts_every_kind_of_error(tmp_path):
+    input_path = write_input(tmp_path, (
+        b'\xef\xbb\xbfguid,action,title\n'
+        b'A,edit,x\n'
+        b'B,edit\n'
+        b',edit,y\n'
+        b'A,edit,"z\nz"\n'
+        b'C,edit,\xff\n'
+        b'C,edit,w\n'
+    ))
+    report = suredone_upload.validate_input_file(input_path, no_log)
+
+    assert report['rows'] == 6
+    assert report['missing_headers'] == []
+    assert report['column_count']['samples'] == ['line 3: 2 values, the header has 3']
+    assert report['empty_guid']['samples'] == ['line 4']
+    assert report['encoding']['count'] == 1
+    assert report['duplicate_guid']['samples'] == ['A (lines 2 and 5)', 'C (lines 7 and 8)']
+
+
+def test_duplicate_guids_are_only_an_error_when_rejected(tmp_path):
+    input_path = write_input(tmp_path, b'action,guid,title\nedit,A,x\nedit,B,y\nedit,A,z\nedit,A,w\n')
+    report = suredone_upload.validate_input_file(input_path, no_log)
+
+    assert report['duplicate_guid']['count'] == 2
+    assert report['duplicate_guid']['samples'] == ['A (lines 2 and 4)', 'A (lines 2 and 5)']
+    assert not suredone_upload.has_validation_errors(report)
+    assert suredone_upload.has_validation_errors(report, reject_duplicates=True)
+
+
+def test_duplicates_are_counted_from_the_hashes_and_sampled_up_to_the_limit(tmp_path):
+    rows = b''.join(b'edit,G%d\n' % (number % 50) for number in range(200))
+    input_path = write_input(tmp_path, b'action,guid\n' + rows)
+    report = suredone_upload.validate_input_file(input_path, no_log, max_samples=3)
+
+    assert report['duplicate_guid']['count'] == 150
+    # three different guids, each with the line of its first repeat
+    samples = report['duplicate_guid']['samples']
+    guids = [int(sample.split()[0][1:]) for sample in samples]
+    assert len(set(guids)) == 3
+    assert samples == ['G{0} (lines {1} and {2})'.format(guid, guid + 2, guid + 52) for guid in guids]
+
+
+def test_validation_reports_missing_headers(tmp_path):
+    input_path = write_input(tmp_path, b'title,price\nx,1\n')
+    report = suredone_upload.validate_input_file(input_path, no_log)
+
+    assert report['missing_headers'] == ['action', 'guid']
+    assert suredone_upload.has_validation_errors(report)
+
+
+@pytest.fixture(params=[False, True], ids=['streamed export', 'indexed export'])
+def snapshot(request, tmp_path):
+    snapshot_path = str(tmp_path / 'export.csv')
+    shutil.copy(os.path.join(FIXTURES, 'export.csv'), snapshot_path)
+    if request.param:
+        buildIndexFromFile(snapshot_path)
+    return argparse.Namespace(diff_against=snapshot_path, diff_delimiter=',')
+
+
+def test_diff_keeps_only_changed_rows_and_columns(tmp_path, snapshot):
+    input_path = str(tmp_path / 'edit.csv')
+    shutil.copy(os.path.join(FIXTURES, 'edit.csv'), input_path)
+
+    diff_path = suredone_upload.diff_input_file(snapshot, no_log, input_path)
+
+    assert diff_path == str(tmp_path / 'edit_diff.csv')
+    with open(diff_path) as diff_file:
+        assert diff_file.read() == 'action,guid,price\nedit,B,8\n'
+
+
+def test_diff_keeps_new_guids_and_other_actions_whole(tmp_path, snapshot):
+    input_path = write_input(tmp_path, b'action,guid,title,price\nedit,A,Alpha,5\nedit,N,New,1\ndelete,C,,\n')
+
+    diff_path = suredone_upload.diff_input_file(snapshot, no_log, input_path)
+
+    with open(diff_path) as diff_file:
+        assert diff_file.read() == 'action,guid,title,price\nedit,N,New,1\ndelete,C,,\n'
+
+
+def test_diff_without_changes_returns_none(tmp_path, snapshot):
+    input_path = write_input(tmp_path, b'action,guid,price,stock\nedit,A,5.0,3\nedit,C,9,0\n')
+
+    assert suredone_upload.diff_input_file(snapshot, no_log, input_path) is None
+    assert not os.path.exists(str(tmp_path / 'input_diff.csv'))